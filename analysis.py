@@ -0,0 +1,156 @@
+import asyncio
+import multiprocessing
+import os
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+import chess
+import chess.pgn
+
+# Worker side. Each worker process keeps the boards of the games routed to it,
+# so a follow-up task for the same game only replays the moves played since.
+BOARDS: OrderedDict = OrderedDict()
+MAX_BOARDS = 2000
+
+def warm_board(game_id: str, history: List[str]) -> chess.Board:
+    cached = BOARDS.pop(game_id, None)
+    if cached and len(cached[1]) <= len(history) and cached[1][-1:] == history[len(cached[1]) - 1:len(cached[1])]:
+        board, played = cached
+    else:
+        board, played = chess.Board(), []
+    BOARDS[game_id] = (board, played)
+    while len(BOARDS) > MAX_BOARDS:
+        BOARDS.popitem(last=False)
+    for san in history[len(played):]:
+        board.push_san(san)
+        played.append(san)
+    return board
+
+def analyze(board: chess.Board) -> dict:
+    outcome = board.outcome(claim_draw=True)
+    return {
+        'fen': board.fen(),
+        'plies': len(board.move_stack),
+        'turn': 'white' if board.turn == chess.WHITE else 'black',
+        'check': board.is_check(),
+        'legal_moves': board.legal_moves.count(),
+        'outcome': {
+            'termination': outcome.termination.name.lower(),
+            'winner': None if outcome.winner is None else ('white' if outcome.winner == chess.WHITE else 'black'),
+            'result': outcome.result()
+        } if outcome else None
+    }
+
+def pgn(board: chess.Board, headers: Dict[str, str]) -> str:
+    game = chess.pgn.Game.from_board(board)
+    for key, value in headers.items():
+        game.headers[key] = value
+    if 'Result' not in headers:
+        outcome = board.outcome(claim_draw=True)
+        game.headers['Result'] = outcome.result() if outcome else '*'
+    return str(game)
+
+TASKS = {'analyze': lambda board, _: analyze(board), 'pgn': pgn}
+
+def run_batch(tasks: List[Tuple[str, str, List[str], object]]) -> List[object]:
+    results = []
+    for kind, game_id, history, arg in tasks:
+        try:
+            results.append(TASKS[kind](warm_board(game_id, history), arg))
+        except ValueError as e:
+            # The history itself does not replay; drop the board so the next task starts clean.
+            BOARDS.pop(game_id, None)
+            results.append(ValueError(f"Invalid history for game {game_id}: {e}"))
+    return results
+
+def warm_up():
+    chess.Board().legal_moves.count()
+
+class CpuExecutor:
+    """Runs chess work beyond applying moves (end-of-game analysis, PGN) in worker processes.
+
+    Each game is pinned to one worker by a hash of its id, so that worker
+    keeps a warm board for it. Tasks arriving within `batch_window` seconds
+    are sent to a worker as one batch, which amortizes the inter-process
+    round trip; throughput grows with `workers` (all CPUs by default).
+    """
+
+    def __init__(self, workers: Optional[int] = None, batch_window: float = 0.002, max_batch: int = 256):
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.pools: List[ProcessPoolExecutor] = []
+        self.pending: Dict[int, list] = {}
+        self.scheduled: Dict[int, asyncio.TimerHandle] = {}
+        self.batches = 0
+        self.tasks = 0
+
+    def start(self):
+        if self.pools:
+            return
+        # spawn, not fork: the server process has an event loop and threads that must not be copied.
+        context = multiprocessing.get_context('spawn')
+        self.pools = [ProcessPoolExecutor(1, mp_context=context, initializer=warm_up) for _ in range(self.workers)]
+
+    def shard(self, game_id: str) -> int:
+        return zlib.crc32(game_id.encode()) % self.workers
+
+    def submit(self, kind: str, game_id: str, history: List[str], arg=None) -> asyncio.Future:
+        self.start()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        shard = self.shard(game_id)
+        batch = self.pending.setdefault(shard, [])
+        batch.append(((kind, game_id, list(history), arg), future))
+        if len(batch) >= self.max_batch:
+            self._dispatch(shard)
+        elif shard not in self.scheduled:
+            self.scheduled[shard] = loop.call_later(self.batch_window, self._dispatch, shard)
+        return future
+
+    def _dispatch(self, shard: int):
+        handle = self.scheduled.pop(shard, None)
+        if handle:
+            handle.cancel()
+        batch = self.pending.pop(shard, [])
+        if batch:
+            self.batches += 1
+            self.tasks += len(batch)
+            asyncio.ensure_future(self._run(shard, batch))
+
+    async def _run(self, shard: int, batch: list):
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(self.pools[shard], run_batch, [task for task, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def analyze(self, game_id: str, history: List[str]) -> dict:
+        return await self.submit('analyze', game_id, history)
+
+    async def pgn(self, game_id: str, history: List[str], headers: Optional[Dict[str, str]] = None) -> str:
+        return await self.submit('pgn', game_id, history, headers or {})
+
+    def stats(self) -> dict:
+        return {
+            'workers': self.workers,
+            'batches': self.batches,
+            'tasks': self.tasks,
+            'mean_batch': round(self.tasks / self.batches, 2) if self.batches else None
+        }
+
+    def close(self):
+        for pool in self.pools:
+            pool.shutdown(wait=False, cancel_futures=True)
+        self.pools = []
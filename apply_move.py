@@ -3,6 +3,33 @@ import chess
 class InvalidMoveException(Exception):
     pass
 
+def parse_move(board, move):
+    try:
+        chess_move = board.parse_san(move)
+    except ValueError:
+        try:
+            chess_move = board.parse_uci(move)
+        except ValueError:
+            raise InvalidMoveException('Invalid move notation')
+
+    if chess_move not in board.legal_moves:
+        raise InvalidMoveException('Illegal move')
+
+    return chess_move
+
+def push_move(board, move, player_color, positions=None, position=None):
+    if board.turn != player_color:
+        raise InvalidMoveException('It is not your turn')
+
+    # With the board's cached Position, moves already played from it are not parsed again.
+    if position is not None:
+        chess_move, san = positions.move(board, move, position)
+    else:
+        chess_move = parse_move(board, move)
+        san = board.san(chess_move)
+    board.push(chess_move)
+    return san
+
 def apply_move(game_state, move, player_id, player1_id, player2_id):
     board_fen = game_state.get('board')
     history = game_state.get('history', [])
@@ -17,25 +44,14 @@ def apply_move(game_state, move, player_id, player1_id, player2_id):
     else:
         player_color = chess.BLACK
 
-    if board.turn != player_color:
-        raise InvalidMoveException('It is not your turn')
-
-    try:
-        chess_move = board.parse_san(move)
-    except ValueError:
-        raise InvalidMoveException('Invalid move notation')
-
-    if chess_move not in board.legal_moves:
-        raise InvalidMoveException('Illegal move')
-
-    board.push(chess_move)
+    san = push_move(board, move, player_color)
 
     next_turn = player1_id if player_id == player2_id else player2_id
 
     new_game_state = {
         'board': board.fen(),
         'turn': next_turn,
-        'history': history + [move]
+        'history': history + [san]
     }
 
-    return new_game_state
\ No newline at end of file
+    return new_game_state
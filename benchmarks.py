@@ -0,0 +1,931 @@
+import argparse
+import asyncio
+import random
+import importlib
+import os
+import time
+import uuid
+import chess
+import httpx
+import json
+import multiprocessing
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from apply_move import apply_move
+from live_games import LiveGame, LiveGameRegistry
+from position_cache import PositionCache
+from journal import MoveJournal
+from timer_wheel import TimerWheel
+import metrics
+import loadtest
+from lobby import LobbyIndex
+from matchmaking import MatchmakingQueue
+from connection_manager import ConnectionManager, Session
+from pubsub import BrokerBus, serve
+import encoding
+from leaderboard import Leaderboard
+from repository import InMemoryRepository, RepositoryError
+from cache import CachedRepository
+import mock_data_generator
+import export
+import analysis
+from analysis import CpuExecutor
+
+# Morphy vs. Duke Karl / Count Isouard, Paris 1858 (the "Opera Game"):
+OPERA_GAME = [
+    'e4', 'e5', 'Nf3', 'd6', 'd4', 'Bg4', 'dxe5', 'Bxf3', 'Qxf3', 'dxe5',
+    'Bc4', 'Nf6', 'Qb3', 'Qe7', 'Nc3', 'c6', 'Bg5', 'b5', 'Nxb5', 'cxb5',
+    'Bxb5+', 'Nbd7', 'O-O-O', 'Rd8', 'Rxd7', 'Rxd7', 'Rd1', 'Qe6', 'Bxd7+', 'Nxd7',
+    'Qb8+', 'Nxb8', 'Rd8#'
+]
+
+# A small corpus of real games for bench_positions; set BENCH_PGN to a PGN file to replay a larger one.
+REAL_GAMES = [OPERA_GAME] + [game.split() for game in (
+    # Anderssen vs. Kieseritzky, London 1851 (the "Immortal Game")
+    'e4 e5 f4 exf4 Bc4 Qh4+ Kf1 b5 Bxb5 Nf6 Nf3 Qh6 d3 Nh5 Nh4 Qg5 Nf5 c6 g4 Nf6 Rg1 cxb5 h4 Qg6 h5 Qg5 Qf3 Ng8 '
+    'Bxf4 Qf6 Nc3 Bc5 Nd5 Qxb2 Bd6 Bxg1 e5 Qxa1+ Ke2 Na6 Nxg7+ Kd8 Qf6+ Nxf6 Be7#',
+    # Anderssen vs. Dufresne, Berlin 1852 (the "Evergreen Game")
+    'e4 e5 Nf3 Nc6 Bc4 Bc5 b4 Bxb4 c3 Ba5 d4 exd4 O-O d3 Qb3 Qf6 e5 Qg6 Re1 Nge7 Ba3 b5 Qxb5 Rb8 Qa4 Bb6 Nbd2 Bb7 '
+    'Ne4 Qf5 Bxd3 Qh5 Nf6+ gxf6 exf6 Rg8 Rad1 Qxf3 Rxe7+ Nxe7 Qxd7+ Kxd7 Bf5+ Ke8 Bd7+ Kf8 Bxe7#',
+    # D. Byrne vs. Fischer, New York 1956 (the "Game of the Century")
+    'Nf3 Nf6 c4 g6 Nc3 Bg7 d4 O-O Bf4 d5 Qb3 dxc4 Qxc4 c6 e4 Nbd7 Rd1 Nb6 Qc5 Bg4 Bg5 Na4 Qa3 Nxc3 bxc3 Nxe4 '
+    'Bxe7 Qb6 Bc4 Nxc3 Bc5 Rfe8+ Kf1 Be6 Bxb6 Bxc4+ Kg1 Ne2+ Kf1 Nxd4+ Kg1 Ne2+ Kf1 Nc3+ Kg1 axb6 Qb4 Ra4 Qxb6 '
+    'Nxd1 h3 Rxa2 Kh2 Nxf2 Re1 Rxe1 Qd8+ Bf8 Nxe1 Bd5 Nf3 Ne4 Qb8 b5 h4 h5 Ne5 Kg7 Kg1 Bc5+ Kf1 Ng3+ Ke1 Bb4+ '
+    'Kd1 Bb3+ Kc1 Ne2+ Kb1 Nc3+ Kc1 Rc2#',
+    # Légal vs. Saint Brie, Paris 1750 (Légal's mate)
+    'e4 e5 Nf3 d6 Bc4 Bg4 Nc3 g6 Nxe5 Bxd1 Bxf7+ Ke7 Nd5#',
+    # Réti vs. Tartakower, Vienna 1910
+    'e4 c6 d4 d5 Nc3 dxe4 Nxe4 Nf6 Qd3 e5 dxe5 Qa5+ Bd2 Qxe5 O-O-O Nxe4 Qd8+ Kxd8 Bg5+ Kc7 Bd8#',
+)]
+
+def report(name, count, elapsed, unit='ops'):
+    rate = count / elapsed if elapsed else float('inf')
+    print(f"{name:<40} {count:>10} {unit} in {elapsed:8.3f}s  {rate:12.0f} {unit}/s")
+
+def bench_moves(games=200):
+    # Current path: rebuild the board from FEN and copy the state on every move.
+    start = time.perf_counter()
+    for _ in range(games):
+        game_state = {'board': chess.Board().fen(), 'turn': 'p1', 'history': []}
+        for ply, move in enumerate(OPERA_GAME):
+            player_id = 'p1' if ply % 2 == 0 else 'p2'
+            game_state = apply_move(game_state, move, player_id, 'p1', 'p2')
+    report('apply_move (FEN per move)', games * len(OPERA_GAME), time.perf_counter() - start, 'moves')
+
+    # Resident boards in the live-game registry.
+    async def persist(states, versions=None):
+        pass
+
+    registry = LiveGameRegistry(persist=persist)
+    start = time.perf_counter()
+    for i in range(games):
+        game_id = str(i)
+        registry.start(game_id, 'p1', 'p2')
+        for ply, move in enumerate(OPERA_GAME):
+            player_id = 'p1' if ply % 2 == 0 else 'p2'
+            registry.apply_move(game_id, move, player_id)
+    asyncio.run(registry.flush())
+    report('LiveGameRegistry (resident boards)', games * len(OPERA_GAME), time.perf_counter() - start, 'moves')
+
+def load_app(**env):
+    # Import main against the in-memory backend so no network is involved.
+    os.environ.setdefault('DATA_BACKEND', 'memory')
+    os.environ.update({k: str(v) for k, v in env.items()})
+    return importlib.import_module('main')
+
+class BlockingRepository(InMemoryRepository):
+    # Mimics the old synchronous client: the round trip blocks the event loop.
+    async def _delay(self):
+        time.sleep(self.latency)
+
+def bench_concurrency(clients=200, requests_per_client=5, latency=0.005):
+    main = load_app()
+
+    async def seed(repo):
+        game_ids = []
+        for _ in range(clients):
+            game = await repo.insert_game({'game_id': str(uuid.uuid4()), 'player1_id': 'p1', 'status': 'pending', 'bet': 10})
+            game_ids.append(game['game_id'])
+        return game_ids
+
+    async def client(http, game_ids):
+        for game_id in game_ids:
+            response = await http.get(f'/games/{game_id}')
+            response.raise_for_status()
+
+    async def run(repo):
+        main.repo = repo
+        game_ids = await seed(repo)
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench') as http:
+            start = time.perf_counter()
+            await asyncio.gather(*(
+                client(http, [game_ids[(i + j) % clients] for j in range(requests_per_client)]) for i in range(clients)
+            ))
+            return time.perf_counter() - start
+
+    total = clients * requests_per_client
+    report(f'blocking repository ({clients} clients)', total, asyncio.run(run(BlockingRepository(latency=latency))), 'requests')
+    report(f'async repository ({clients} clients)', total, asyncio.run(run(InMemoryRepository(latency=latency))), 'requests')
+
+def bench_lobby(games=2000, lookups=200, latency=0.0002):
+    rng = random.Random(1)
+
+    async def run():
+        repo = InMemoryRepository(latency=latency)
+        for i in range(games):
+            user = await repo.insert_user({'id': f'u{i}', 'username': f'user{i}', 'rating': rng.randint(800, 2400)})
+            await repo.insert_game({'game_id': f'g{i}', 'player1_id': user['id'], 'status': 'pending', 'bet': 10})
+
+        ratings = [rng.randint(800, 2400) for _ in range(lookups)]
+
+        # Old path: one users query per pending game, filtered in Python.
+        start = time.perf_counter()
+        for rating in ratings[:1]:
+            for game in await repo.list_games('pending'):
+                creator = await repo.get_user(game['player1_id'])
+                abs(creator['rating'] - rating) <= 100
+        report('N+1 creator lookups', 1, time.perf_counter() - start, 'lookups')
+
+        start = time.perf_counter()
+        for rating in ratings:
+            await repo.list_lobby(rating - 100, rating + 100, limit=50)
+        report('single joined lobby query', lookups, time.perf_counter() - start, 'lookups')
+
+        index = LobbyIndex()
+        index.load(await repo.list_lobby())
+        start = time.perf_counter()
+        for _ in range(100):
+            for rating in ratings:
+                index.window(rating, 100, limit=50)
+        report(f'LobbyIndex.window ({games} games)', 100 * lookups, time.perf_counter() - start, 'lookups')
+
+    asyncio.run(run())
+
+def bench_matchmaking(players=50000, bets=(10, 50, 100)):
+    rng = random.Random(2)
+    queue = MatchmakingQueue(on_match=None)
+
+    start = time.perf_counter()
+    for i in range(players):
+        queue.enqueue(f'u{i}', int(rng.gauss(1500, 300)), rng.choice(bets), now=0.0)
+    report('enqueue', players, time.perf_counter() - start, 'players')
+
+    # Simulated ticks, one second apart, so the windows widen between them.
+    for second in range(1, 4):
+        depth = len(queue)
+        start = time.perf_counter()
+        pairs = queue.pair(now=float(second))
+        report(f'tick {second} (depth {depth}, {len(pairs)} pairs)', depth, time.perf_counter() - start, 'tickets')
+    print(queue.stats())
+
+class FakeWebSocket:
+    def __init__(self, delay=0.0, on_send=None):
+        self.delay = delay
+        self.on_send = on_send
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, data):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.on_send:
+            self.on_send()
+
+    async def send_json(self, data):
+        await self.send_text(json.dumps(data))
+
+    async def close(self, code=1000):
+        pass
+
+def bench_fanout(spectators=10000, slow=10, slow_delay=0.05):
+    message = {'type': 'move_made', 'player_id': 'p1', 'move': 'e4', 'game_state': {'board': chess.Board().fen(), 'history': OPERA_GAME}}
+
+    async def sequential():
+        # Old path: await each recipient in turn, serializing every time.
+        websockets = [FakeWebSocket(slow_delay if i < slow else 0.0) for i in range(spectators)]
+        start = time.perf_counter()
+        for websocket in websockets:
+            await websocket.send_json(message)
+        return time.perf_counter() - start
+
+    async def fanout():
+        # Time until every fast consumer has its frame; slow ones drain on their own.
+        delivered = asyncio.Event()
+        pending = [spectators - slow]
+        def on_send():
+            pending[0] -= 1
+            if not pending[0]:
+                delivered.set()
+
+        manager = ConnectionManager(max_queue=16)
+        for i in range(spectators):
+            websocket = FakeWebSocket(slow_delay) if i < slow else FakeWebSocket(on_send=on_send)
+            await manager.connect(f'u{i}', websocket)
+        for i in range(spectators):
+            manager.add_spectator('g', f'u{i}')
+        manager.set_players('g', None, None)
+
+        start = time.perf_counter()
+        await manager.broadcast_to_game('g', message)
+        await delivered.wait()
+        elapsed = time.perf_counter() - start
+        for i in range(spectators):
+            manager.disconnect(f'u{i}')
+        return elapsed
+
+    report(f'sequential broadcast ({slow} slow sockets)', spectators, asyncio.run(sequential()), 'sends')
+    report(f'fan-out broadcast ({slow} slow sockets)', spectators, asyncio.run(fanout()), 'sends')
+
+def bench_spectators(events=100000, games=1000):
+    rng = random.Random(3)
+
+    async def run():
+        manager = ConnectionManager()
+        online = []
+        start = time.perf_counter()
+        for i in range(events):
+            if online and rng.random() < 0.5:
+                user_id = online.pop(rng.randrange(len(online)))
+                manager.disconnect(user_id)
+            else:
+                user_id = f'u{i}'
+                await manager.connect(user_id, FakeWebSocket())
+                for _ in range(rng.randint(1, 3)):
+                    manager.add_spectator(f'g{rng.randrange(games)}', user_id)
+                online.append(user_id)
+        elapsed = time.perf_counter() - start
+        for user_id in online:
+            manager.disconnect(user_id)
+        assert not manager.game_spectators and not manager.user_games
+        return elapsed
+
+    report('spectator connect/disconnect churn', events, asyncio.run(run()), 'events')
+
+def pubsub_worker(address, index, spectators, messages, barrier, results):
+    async def run():
+        received = [0]
+        done = asyncio.Event()
+        def on_send():
+            received[0] += 1
+            if received[0] == spectators * messages:
+                done.set()
+
+        bus = BrokerBus(address)
+        manager = ConnectionManager(bus=bus, max_queue=messages)
+        await bus.start()
+        for i in range(spectators):
+            user_id = f'w{index}-u{i}'
+            await manager.connect(user_id, FakeWebSocket(on_send=on_send))
+            manager.add_spectator('g', user_id)
+        manager.set_players('g', None, None)
+        await bus.flush()
+        await asyncio.to_thread(barrier.wait)
+
+        start = time.perf_counter()
+        if index == 0:
+            for seq in range(messages):
+                await manager.broadcast_to_game('g', {'type': 'move_made', 'seq': seq})
+        try:
+            await asyncio.wait_for(done.wait(), 30)
+        except asyncio.TimeoutError:
+            pass
+        results.put((index, received[0], time.perf_counter() - start))
+        await bus.close()
+
+    asyncio.run(run())
+
+def bench_pubsub(workers=4, spectators=500, messages=100):
+    # Spectators are spread over worker processes; worker 0 broadcasts and
+    # every worker must deliver each message to each of its own spectators.
+    address = f'unix://{tempfile.mkdtemp()}/broker.sock'
+    broker = multiprocessing.Process(target=serve, args=(address,), daemon=True)
+    broker.start()
+    time.sleep(0.5)
+
+    barrier = multiprocessing.Barrier(workers)
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=pubsub_worker, args=(address, i, spectators, messages, barrier, results))
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    outcomes = sorted(results.get(timeout=60) for _ in processes)
+    for process in processes:
+        process.join()
+    broker.terminate()
+
+    expected = spectators * messages
+    for index, received, elapsed in outcomes:
+        status = 'ok' if received == expected else f'MISSING {expected - received}'
+        report(f'worker {index} deliveries ({status})', received, elapsed, 'frames')
+    # A correctness check as much as a benchmark: lost deliveries fail the run.
+    missing = sum(expected - received for _, received, _ in outcomes)
+    if missing:
+        raise SystemExit(f"pubsub: {missing} of {expected * workers} deliveries missing")
+
+def bench_encoding(rounds=200):
+    boards = []
+    board = chess.Board()
+    for move in OPERA_GAME:
+        board.push_san(move)
+        boards.append(board.copy(stack=False))
+    fens = [b.fen() for b in boards]
+    packed = [encoding.pack_board(b) for b in boards]
+    count = rounds * len(boards)
+
+    def timed(name, fn):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            fn()
+        report(name, count, time.perf_counter() - start, 'ops')
+
+    timed('board.fen()', lambda: [b.fen() for b in boards])
+    timed('encoding.pack_board()', lambda: [encoding.pack_board(b) for b in boards])
+    timed('chess.Board(fen)', lambda: [chess.Board(f) for f in fens])
+    timed('encoding.unpack_board()', lambda: [encoding.unpack_board(p) for p in packed])
+
+    def parse_san():
+        b = chess.Board()
+        for move in OPERA_GAME:
+            b.push(b.parse_san(move))
+
+    codes = [encoding.encode_move(m) for m in board.move_stack]
+    def decode_codes():
+        b = chess.Board()
+        for code in codes:
+            b.push(encoding.decode_move(code))
+
+    timed('SAN replay (parse_san)', parse_san)
+    timed('move-code replay (decode_move)', decode_codes)
+
+    fen_state = json.dumps({'board': board.fen(), 'turn': str(uuid.uuid4()), 'history': OPERA_GAME})
+    compact_state = json.dumps(encoding.encode_game_state(board, str(uuid.uuid4())))
+    game_id = str(uuid.uuid4())
+    move_json = json.dumps({'type': 'move_made', 'game_id': game_id, 'seq': 33, 'player_id': str(uuid.uuid4()), 'move': 'Rd8#'})
+    print(f"game_state after {len(OPERA_GAME)} plies: FEN+SAN {len(fen_state)} bytes, compact {len(compact_state)} bytes")
+    print(f"move_made message: JSON {len(move_json)} bytes, binary {len(encoding.move_frame(game_id, 33, board.peek()))} bytes")
+    print(f"board: FEN {len(board.fen())} bytes, packed {len(encoding.pack_board(board))} bytes")
+
+def bench_leaderboard(users=50000, hits=20, latency=0.002):
+    rng = random.Random(4)
+
+    async def run():
+        repo = InMemoryRepository(latency=latency)
+        for i in range(users):
+            repo.users[f'u{i}'] = {'id': f'u{i}', 'username': f'user{i}', 'rating': rng.randint(800, 2800), 'wins': rng.randint(0, 50), 'losses': rng.randint(0, 50), 'draws': 0}
+
+        # Old path: query top 100 and compute percentages on every hit (the stand-in sorts all users per query).
+        start = time.perf_counter()
+        for _ in range(hits):
+            [Leaderboard.render(Leaderboard.entry(u), i + 1) for i, u in enumerate(await repo.top_users(100))]
+        report('repository top 100 per request', hits, time.perf_counter() - start, 'requests')
+
+        index = Leaderboard()
+        index.load(list(repo.users.values()))
+        start = time.perf_counter()
+        for i in range(hits * 100):
+            if i % 100 == 0:
+                index.record_result(f'u{rng.randrange(users)}', rng.randint(800, 2800), 1)
+            index.cached_page(0, 100)
+        report('Leaderboard top 100 (1% writes)', hits * 100, time.perf_counter() - start, 'requests')
+
+        start = time.perf_counter()
+        for _ in range(hits * 100):
+            index.rank(f'u{rng.randrange(users)}')
+        report(f'Leaderboard.rank ({users} users)', hits * 100, time.perf_counter() - start, 'lookups')
+
+    asyncio.run(run())
+
+def bench_cache(users=1000, reads=2000, write_ratio=0.05, latency=0.001):
+    rng = random.Random(5)
+    # Skewed access: a few players (those in live games) are looked up far more often.
+    keys = [f'u{min(int(rng.paretovariate(1.2)) - 1, users - 1)}' for _ in range(reads)]
+    writes = [rng.random() < write_ratio for _ in range(reads)]
+
+    async def run(repo):
+        for i in range(users):
+            await repo.insert_user({'id': f'u{i}', 'username': f'user{i}', 'rating': 1500})
+        start = time.perf_counter()
+        for key, write in zip(keys, writes):
+            if write:
+                await repo.update_user(key, {'status': 'in_game'})
+            else:
+                await repo.get_user(key)
+        return time.perf_counter() - start
+
+    report('uncached get_user', reads, asyncio.run(run(InMemoryRepository(latency=latency))), 'requests')
+    cached = CachedRepository(InMemoryRepository(latency=latency))
+    report(f'cached get_user ({write_ratio:.0%} writes)', reads, asyncio.run(run(cached)), 'requests')
+    print(f"{'hit rate':<40} {cached.stats()['users']['hit_rate']:>10}")
+
+def bench_journal(games=100, latency=0.002):
+    # Each game plays the Opera Game; its moves arrive one at a time, like make_move requests.
+    async def play(registry, game_id, acknowledge):
+        for ply, move in enumerate(OPERA_GAME):
+            registry.apply_move(game_id, move, 'p1' if ply % 2 == 0 else 'p2')
+            await acknowledge(game_id)
+
+    async def run(acknowledge, journal=None):
+        repo = InMemoryRepository(latency=latency)
+        registry = LiveGameRegistry(persist=repo.save_game_states, journal=journal)
+        if journal:
+            journal.start()
+        for i in range(games):
+            await repo.insert_game({'game_id': str(i), 'player1_id': 'p1', 'player2_id': 'p2', 'status': 'in_progress', 'bet': 10})
+            registry.start(str(i), 'p1', 'p2')
+        start = time.perf_counter()
+        await asyncio.gather(*(play(registry, str(i), acknowledge(registry, repo)) for i in range(games)))
+        elapsed = time.perf_counter() - start
+        await registry.flush()
+        if journal:
+            await journal.close()
+        return elapsed
+
+    def row_update(registry, repo):
+        async def acknowledge(game_id):
+            await repo.update_game(game_id, {'game_state': registry.get(game_id).game_state()})
+        return acknowledge
+
+    def journal_sync(registry, repo):
+        async def acknowledge(game_id):
+            await registry.sync()
+        return acknowledge
+
+    moves = games * len(OPERA_GAME)
+    report(f'row update per move ({latency * 1000:g}ms db)', moves, asyncio.run(run(row_update)), 'moves')
+    for mode in MoveJournal.MODES:
+        with tempfile.TemporaryDirectory() as directory:
+            journal = MoveJournal(directory, mode=mode)
+            elapsed = asyncio.run(run(journal_sync, journal))
+        report(f'journal ({mode}, {moves / max(journal.commits, 1):.0f} moves per write)', moves, elapsed, 'moves')
+
+    async def recover():
+        with tempfile.TemporaryDirectory() as directory:
+            repo = InMemoryRepository()
+            journal = MoveJournal(directory, mode='buffered')
+            journal.start()
+            registry = LiveGameRegistry(persist=repo.save_game_states, journal=journal)
+            for i in range(games):
+                await repo.insert_game({'game_id': str(i), 'player1_id': 'p1', 'player2_id': 'p2', 'status': 'in_progress', 'bet': 10})
+                registry.start(str(i), 'p1', 'p2')
+                await play(registry, str(i), journal_sync(registry, repo))
+            await journal.close()
+
+            # A fresh process: nothing was flushed, so every move comes from the journal.
+            journal = MoveJournal(directory)
+            journal.start()
+            registry = LiveGameRegistry(persist=repo.save_game_states, journal=journal)
+            start = time.perf_counter()
+            recovered = await registry.recover(repo.get_game)
+            elapsed = time.perf_counter() - start
+            await journal.close()
+            assert recovered == moves and all(len(g['game_state']['history']) == len(OPERA_GAME) for g in repo.games.values())
+            assert not journal.replay()
+            return elapsed
+
+    report('journal replay on restart', moves, asyncio.run(recover()), 'moves')
+
+    async def failed_recovery():
+        # The first recovery fails on the database and a periodic flush runs before the retry.
+        with tempfile.TemporaryDirectory() as directory:
+            repo = InMemoryRepository()
+            journal = MoveJournal(directory, mode='buffered')
+            registry = LiveGameRegistry(persist=repo.save_game_states, journal=journal)
+            await repo.insert_game({'game_id': 'g', 'player1_id': 'p1', 'player2_id': 'p2', 'status': 'in_progress', 'bet': 10})
+            registry.start('g', 'p1', 'p2')
+            await play(registry, 'g', journal_sync(registry, repo))
+            await journal.close()
+
+            journal = MoveJournal(directory)
+            journal.start()
+            registry = LiveGameRegistry(persist=repo.save_game_states, journal=journal)
+
+            async def unreachable(game_id):
+                raise RepositoryError('unreachable')
+
+            try:
+                await registry.recover(unreachable)
+            except RepositoryError:
+                pass
+            await registry.flush()
+            assert len(journal.replay()) == len(OPERA_GAME)
+            assert await registry.recover(repo.get_game) == len(OPERA_GAME)
+            await journal.close()
+            assert repo.games['g']['game_state']['history'] == OPERA_GAME and not journal.replay()
+
+    asyncio.run(failed_recovery())
+    print(f"{'journal kept until a failed recovery is retried':<40} ok")
+
+def bench_seeding(users=5000, games=500, latency=0.002):
+    scenario = mock_data_generator.load_scenario(seed=1, users=users, completed_games=games, in_progress_games=games // 2, pending_games=games // 2)
+    start = time.perf_counter()
+    user_rows, game_rows = mock_data_generator.build_dataset(scenario)
+    report('build scenario (move histories)', len(user_rows) + len(game_rows), time.perf_counter() - start, 'rows')
+
+    async def one_by_one():
+        repo = InMemoryRepository(latency=latency)
+        start = time.perf_counter()
+        for row in user_rows:
+            await repo.insert_user(row)
+        for row in game_rows:
+            await repo.insert_game(row)
+        return time.perf_counter() - start
+
+    async def bulk():
+        repo = InMemoryRepository(latency=latency)
+        start = time.perf_counter()
+        await mock_data_generator.insert_batches(repo.insert_users, user_rows, 1000, 8)
+        await mock_data_generator.insert_batches(repo.insert_games, game_rows, 1000, 8)
+        return time.perf_counter() - start
+
+    rows = len(user_rows) + len(game_rows)
+    report(f'one insert per row ({latency * 1000:g}ms db)', rows, asyncio.run(one_by_one()), 'rows')
+    report('batched concurrent inserts', rows, asyncio.run(bulk()), 'rows')
+
+STARTUP_PROBE = """
+import asyncio, json, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+
+async def run():
+    async with main.lifespan(main.app):
+        started = time.perf_counter()
+        # Indexes and journal recovery load in the background after the lifespan has started.
+        while (await main.ready(main.Response()))['status'] != 'ready':
+            await asyncio.sleep(0.001)
+        return started, time.perf_counter()
+
+started, ready = asyncio.run(run())
+print(json.dumps({'import': imported - start, 'startup': started - imported, 'ready': ready - imported}))
+"""
+
+def bench_startup(runs=3, latency=0.005):
+    # Fresh interpreters, so import time is part of the measurement; the memory backend stands in for the database.
+    for seeding in ('off', 'background', 'blocking'):
+        samples = []
+        for _ in range(runs):
+            with tempfile.TemporaryDirectory() as directory:
+                env = dict(os.environ, DATA_BACKEND='memory', MEMORY_BACKEND_LATENCY=str(latency), SEED_ON_STARTUP=seeding, MOVE_JOURNAL_DIR=directory)
+                output = subprocess.run([sys.executable, '-c', STARTUP_PROBE], env=env, capture_output=True, text=True, check=True).stdout
+                samples.append(json.loads(output.strip().splitlines()[-1]))
+        imported = min(s['import'] for s in samples)
+        started = min(s['startup'] for s in samples)
+        ready = min(s['ready'] for s in samples)
+        print(f"{'startup, seeding ' + seeding:<40} import {imported * 1000:7.1f}ms  lifespan {started * 1000:7.1f}ms  ready {ready * 1000:7.1f}ms")
+
+def bench_cpu(games=400, plies=60):
+    rng = random.Random(6)
+    histories = {str(i): mock_data_generator.play_random_game(rng, plies)[1] for i in range(games)}
+
+    # Every pass analyses each game one ply after the previous pass, as after a move.
+    for game_id, history in histories.items():
+        analysis.warm_board(game_id, history[:-1])
+    start = time.perf_counter()
+    for game_id, history in histories.items():
+        analysis.analyze(analysis.warm_board(game_id, history))
+    report('inline analysis (blocks the event loop)', games, time.perf_counter() - start, 'games')
+    analysis.BOARDS.clear()
+
+    async def run(executor):
+        await asyncio.gather(*(executor.analyze(game_id, history[:-1]) for game_id, history in histories.items()))
+        start = time.perf_counter()
+        await asyncio.gather(*(executor.analyze(game_id, history) for game_id, history in histories.items()))
+        return time.perf_counter() - start
+
+    for workers in sorted({1, os.cpu_count() or 1}):
+        for max_batch in (1, 256):
+            executor = CpuExecutor(workers=workers, max_batch=max_batch)
+            elapsed = asyncio.run(run(executor))
+            executor.close()
+            report(f'CpuExecutor ({workers} workers, batch <= {max_batch})', games, elapsed, 'games')
+
+def bench_termination(games=100, plies=120):
+    rng = random.Random(7)
+    histories = [mock_data_generator.play_random_game(rng, plies)[1] for _ in range(games)]
+    moves = sum(len(h) for h in histories)
+
+    # Full re-analysis after every move, as a client-side or post-hoc check would do it.
+    start = time.perf_counter()
+    for history in histories:
+        board = chess.Board()
+        for san in history:
+            board.push_san(san)
+            board.outcome(claim_draw=True)
+    report('push + outcome(claim_draw=True)', moves, time.perf_counter() - start, 'moves')
+
+    start = time.perf_counter()
+    for history in histories:
+        board = chess.Board()
+        for san in history:
+            board.push_san(san)
+    baseline = time.perf_counter() - start
+    report('push only', moves, baseline, 'moves')
+
+    # LiveGame.apply validates the move and runs the incremental termination checks.
+    start = time.perf_counter()
+    for history in histories:
+        game = LiveGame('g', 'p1', 'p2')
+        for ply, san in enumerate(history):
+            game.apply(san, 'p1' if ply % 2 == 0 else 'p2')
+    report('LiveGame.apply (incremental checks)', moves, time.perf_counter() - start, 'moves')
+
+def bench_timers(games=100000, moves=10, duration=600.0):
+    rng = random.Random(11)
+    deadlines = [rng.uniform(1, duration) for _ in range(games)]
+
+    # One asyncio task per game, restarted on every move.
+    async def run_tasks():
+        async def flag():
+            await asyncio.sleep(duration)
+        start = time.perf_counter()
+        tasks = [asyncio.create_task(flag()) for _ in range(games)]
+        for _ in range(moves):
+            for i in range(games):
+                tasks[i].cancel()
+                tasks[i] = asyncio.create_task(flag())
+        await asyncio.sleep(0)
+        elapsed = time.perf_counter() - start
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return elapsed
+
+    report('task per game: start + restart', games * (moves + 1), asyncio.run(run_tasks()))
+
+    # One wheel; virtual time, so the whole duration is advanced tick by tick.
+    wheel = TimerWheel(tick=0.1, now=0.0)
+    start = time.perf_counter()
+    for i, deadline in enumerate(deadlines):
+        wheel.schedule(('flag', i), deadline)
+    for _ in range(moves):
+        for i, deadline in enumerate(deadlines):
+            wheel.schedule(('flag', i), deadline)
+    report('TimerWheel: schedule + reschedule', games * (moves + 1), time.perf_counter() - start)
+
+    expired = 0
+    slowest = 0.0
+    start = time.perf_counter()
+    for tick in range(1, int(duration / wheel.tick) + 2):
+        tick_start = time.perf_counter()
+        expired += len(wheel.advance(tick * wheel.tick))
+        slowest = max(slowest, time.perf_counter() - tick_start)
+    report('TimerWheel: advance through expiries', expired, time.perf_counter() - start, 'timers')
+    print(f"{'':<40} slowest tick {slowest * 1000:.2f}ms, {len(wheel)} timers left")
+
+def bench_metrics(observations=1000000, requests=3000):
+    registry = metrics.Registry()
+    histogram = metrics.Histogram('bench_seconds', 'Benchmark histogram', ('route',), registry=registry)
+    counter = metrics.Counter('bench_total', 'Benchmark counter', ('reason',), registry=registry)
+
+    start = time.perf_counter()
+    for i in range(observations):
+        histogram.observe(i * 1e-7, '/make_move')
+    report('Histogram.observe', observations, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(observations):
+        counter.inc('illegal_move')
+    report('Counter.inc', observations, time.perf_counter() - start)
+
+    # A bare ASGI app, so the middleware is the only thing measured on top of the call itself.
+    async def app(scope, receive, send):
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b'ok'})
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        pass
+
+    async def run(handler):
+        scope = {'type': 'http', 'method': 'GET', 'path': '/health'}
+        start = time.perf_counter()
+        for _ in range(requests * 100):
+            await handler(scope, receive, send)
+        return time.perf_counter() - start
+
+    bare = asyncio.run(run(app))
+    timed = asyncio.run(run(metrics.MetricsMiddleware(app, histogram)))
+    report('ASGI call', requests * 100, bare, 'requests')
+    report('ASGI call + MetricsMiddleware', requests * 100, timed, 'requests')
+    print(f"{'':<40} middleware overhead {(timed - bare) / (requests * 100) * 1e6:.2f}us per request")
+
+    start = time.perf_counter()
+    for _ in range(100):
+        registry.render()
+    report('Registry.render (scrape)', 100, time.perf_counter() - start, 'scrapes')
+
+def bench_load(players=100, spectators=200, plies=30):
+    # The end-to-end harness in loadtest.py at a small size; run it directly for larger ones or --profile.
+    # One process per transport, since the app module keeps state from the first run.
+    for transport, route in [('http', 'POST /make_move'), ('ws', 'WS move')]:
+        output = subprocess.run([
+            sys.executable, loadtest.__file__, '--players', str(players), '--spectators', str(spectators),
+            '--plies', str(plies), '--transport', transport
+        ], capture_output=True, text=True, check=True).stdout
+        result = json.loads(output[output.index('\n{') + 1:])
+        report(f"load test, {transport} moves ({result['games']} games)", result['moves'], result['play_seconds'], 'moves')
+        for name, latency in [('move', result['routes'][route]), ('broadcast', result['broadcast'])]:
+            print(f"{'':<40} {name} p50 {latency['p50_ms']}ms  p99 {latency['p99_ms']}ms")
+    print(f"{'':<40} {result['bytes_per_connection']} bytes per WebSocket connection")
+
+    output = subprocess.run([sys.executable, loadtest.__file__, '--disconnect'], capture_output=True, text=True, check=True).stdout
+    result = json.loads(output[output.index('\n{') + 1:])
+    assert result == {'status': 'completed', 'resident': False}, result
+    print(f"{'mating WS move, then disconnect':<40} settled")
+
+def bench_contention(clients=50, plies=40, latency=0.002):
+    # Two processes holding the same game: the second write is detected by the version check, not lost silently.
+    async def two_writers():
+        repo = InMemoryRepository()
+        await repo.insert_game({'game_id': 'g', 'player1_id': 'p1', 'player2_id': 'p2', 'status': 'in_progress', 'bet': 10})
+        first, second = LiveGameRegistry(persist=repo.save_game_states), LiveGameRegistry(persist=repo.save_game_states)
+        for registry, move in ((first, 'e4'), (second, 'd4')):
+            registry.start('g', 'p1', 'p2', version=repo.games['g']['version'])
+            registry.apply_move('g', move, 'p1')
+        await first.flush()
+        await second.flush()
+        return repo.games['g'], second.get('g')
+
+    row, resident = asyncio.run(two_writers())
+    assert row['game_state']['history'] == ['e4'] and row['version'] == 1 and resident is None
+
+    # The stress test in loadtest.py, in its own process like bench_load.
+    output = subprocess.run([
+        sys.executable, loadtest.__file__, '--hammer', str(clients), '--plies', str(plies), '--latency', str(latency)
+    ], capture_output=True, text=True, check=True).stdout
+    result = json.loads(output[output.index('\n{') + 1:])
+    report(f'{clients} clients racing on one game', result['requests'], result['seconds'], 'requests')
+    checks = ['resident_matches', 'stored_matches', 'move_made_in_order']
+    consistent = all(result[check] for check in checks) and result['plies_with_one_accepted_move'] == result['plies']
+    print(f"{'':<40} {result['plies_with_one_accepted_move']}/{result['plies']} plies with exactly one accepted move, "
+          f"{'consistent' if consistent else 'INCONSISTENT'}")
+    if not consistent:
+        failed = [check for check in checks if not result[check]]
+        raise SystemExit(f"contention: inconsistent result ({', '.join(failed) or 'several moves accepted for one ply'})")
+
+def load_pgn(path, limit=10000):
+    import chess.pgn
+
+    games = []
+    with open(path) as pgn:
+        while len(games) < limit:
+            game = chess.pgn.read_game(pgn)
+            if game is None:
+                break
+            board = game.board()
+            history = []
+            for move in game.mainline_moves():
+                history.append(board.san(move))
+                board.push(move)
+            games.append(history)
+    return games
+
+def bench_positions(games=600, random_games=200, cache_size=20000):
+    # Each corpus game is replayed by many games at once, as popular openings are; random games show the worst case.
+    corpus = load_pgn(os.environ['BENCH_PGN']) if os.getenv('BENCH_PGN') else REAL_GAMES
+    rng = random.Random(5)
+    workloads = [
+        (f'{len(corpus)} real games', [corpus[i % len(corpus)] for i in range(games)]),
+        ('random games', [mock_data_generator.play_random_game(rng, 80)[1] for _ in range(random_games)])
+    ]
+
+    def replay(histories, positions):
+        start = time.perf_counter()
+        results = []
+        for i, history in enumerate(histories):
+            game = LiveGame(str(i), 'p1', 'p2', positions=positions)
+            for ply, move in enumerate(history):
+                if game.termination:
+                    break
+                game.apply(move, 'p1' if ply % 2 == 0 else 'p2')
+            results.append((game.history, game.termination))
+        return time.perf_counter() - start, results
+
+    for name, histories in workloads:
+        moves = sum(len(history) for history in histories)
+        positions = PositionCache(cache_size)
+        uncached, expected = replay(histories, None)
+        cached, results = replay(histories, positions)
+        assert results == expected
+        report(f'{name}, no position cache', moves, uncached, 'moves')
+        report(f'{name}, position cache', moves, cached, 'moves')
+        stats = positions.stats()
+        print(f"{'':<40} position hit rate {stats['hit_rate']:.1%}, move hit rate {stats['move_hit_rate']:.1%}, {stats['size']} positions")
+
+    # What the cache costs per position held.
+    positions = PositionCache(cache_size)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    replay(workloads[1][1], positions)
+    print(f"{'':<40} {(tracemalloc.get_traced_memory()[0] - before) / len(positions):.0f} bytes per cached position")
+    tracemalloc.stop()
+
+def bench_export(sizes=(2000, 8000, 32000), page_size=500):
+    # Completed games replaying the corpus; peak memory should depend on the page size, not on the export size.
+    async def run(games, fmt, pgn):
+        repo = InMemoryRepository()
+        await repo.insert_users([{'id': f'p{i}', 'username': f'player{i}', 'rating': 1500} for i in range(100)])
+        await repo.insert_games([{
+            'game_id': str(uuid.UUID(int=i)), 'player1_id': f'p{i % 100}', 'player2_id': f'p{(i + 1) % 100}',
+            'status': 'completed', 'bet': 1, 'game_state': {'history': REAL_GAMES[i % len(REAL_GAMES)], 'result': '1-0'}
+        } for i in range(games)])
+        tracemalloc.start()
+        start = time.perf_counter()
+        written = exported = 0
+        async for chunk in export.export_games(repo, fmt, pgn, page_size, status='completed'):
+            written += len(chunk)
+            exported += chunk.count('\n') if fmt == 'ndjson' else chunk.count('[Event ')
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        assert exported == games
+        return elapsed, written, peak
+
+    for games in sizes:
+        elapsed, written, peak = asyncio.run(run(games, 'ndjson', None))
+        report(f'ndjson export, {games} games', games, elapsed, 'games')
+        print(f"{'':<40} {written / 1e6:.1f} MB streamed, peak {peak / 1e6:.1f} MB traced")
+
+    executor = CpuExecutor()
+    elapsed, written, peak = asyncio.run(run(sizes[0], 'pgn', executor.pgn))
+    executor.close()
+    report(f'pgn export, {sizes[0]} games ({executor.workers} workers)', sizes[0], elapsed, 'games')
+    print(f"{'':<40} {written / 1e6:.1f} MB streamed, peak {peak / 1e6:.1f} MB traced")
+
+# Server-side bytes an idle WebSocket may cost: its Connection, Session and index entries.
+CONNECTION_MEMORY_BUDGET = 1024
+
+def bench_connections(connections=20000):
+    user_ids = [str(uuid.uuid4()) for _ in range(connections)]
+    websockets = [FakeWebSocket() for _ in range(connections)]
+    # As read from the users table, so the traced bytes include the session's own copies.
+    users = [{'id': user_id, 'username': f'player{i}', 'rating': 1500 + i % 400, 'status': 'online'}
+             for i, user_id in enumerate(user_ids)]
+
+    async def run():
+        manager = ConnectionManager()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        for user, websocket in zip(users, websockets):
+            await manager.connect(user['id'], websocket, session=Session.from_user(user))
+        elapsed = time.perf_counter() - start
+        idle = (tracemalloc.get_traced_memory()[0] - before) / connections
+
+        # One frame each: queues and writers exist only until it is sent.
+        await manager.send_many(user_ids, {'type': 'ping'})
+        await asyncio.sleep(0.01)
+        drained = (tracemalloc.get_traced_memory()[0] - before) / connections
+        tracemalloc.stop()
+        return elapsed, idle, drained
+
+    elapsed, idle, drained = asyncio.run(run())
+    report(f'connect with session ({connections} sockets)', connections, elapsed, 'connections')
+    for name, size in [('idle', idle), ('after one frame', drained)]:
+        verdict = 'within' if size <= CONNECTION_MEMORY_BUDGET else 'OVER'
+        print(f"{'':<40} {size:.0f} bytes per connection {name} ({verdict} the {CONNECTION_MEMORY_BUDGET} byte budget)")
+
+BENCHMARKS = {
+    'moves': bench_moves,
+    'concurrency': bench_concurrency,
+    'lobby': bench_lobby,
+    'matchmaking': bench_matchmaking,
+    'fanout': bench_fanout,
+    'connections': bench_connections,
+    'contention': bench_contention,
+    'positions': bench_positions,
+    'export': bench_export,
+    'spectators': bench_spectators,
+    'pubsub': bench_pubsub,
+    'encoding': bench_encoding,
+    'leaderboard': bench_leaderboard,
+    'cache': bench_cache,
+    'journal': bench_journal,
+    'seeding': bench_seeding,
+    'startup': bench_startup,
+    'cpu': bench_cpu,
+    'termination': bench_termination,
+    'timers': bench_timers,
+    'metrics': bench_metrics,
+    'load': bench_load,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run performance benchmarks.')
+    parser.add_argument('names', nargs='*', help=f"benchmarks to run, any of {', '.join(BENCHMARKS)} (default: all)")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark: {', '.join(unknown)}")
+
+    for name in args.names or BENCHMARKS:
+        BENCHMARKS[name]()
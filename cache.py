@@ -0,0 +1,161 @@
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional
+
+class TTLCache:
+    """Bounded LRU cache whose entries also expire `ttl` seconds after being stored."""
+
+    def __init__(self, max_size: int = 10000, ttl: float = 30.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.data: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Bumped on every invalidation, so a read that raced with a write can tell its row may be stale.
+        self.generation = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key):
+        item = self.data.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self.data[key]
+            self.misses += 1
+            return None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key, value):
+        self.data[key] = (time.monotonic() + self.ttl, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, keys: Iterable):
+        self.generation += 1
+        for key in keys:
+            self.data.pop(key, None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'size': len(self.data),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / total, 4) if total else None
+        }
+
+class CachedRepository:
+    """Read-through cache of user and game rows in front of a repository.
+
+    Write methods invalidate the rows they touch and publish the invalidation
+    on `bus` so other processes drop their copies too. Methods that are not
+    cached pass straight through to the wrapped repository.
+    """
+
+    def __init__(self, repo, bus=None, max_size: int = 10000, ttl: float = 30.0):
+        self.repo = repo
+        self.bus = bus
+        self.users = TTLCache(max_size, ttl)
+        self.games = TTLCache(max_size, ttl)
+        if bus:
+            bus.subscribe(self.handle_event)
+
+    def __getattr__(self, name):
+        return getattr(self.repo, name)
+
+    def handle_event(self, event: dict):
+        if event['kind'] == 'invalidate':
+            self.users.invalidate(event.get('users', ()))
+            self.games.invalidate(event.get('games', ()))
+
+    def invalidate(self, users: List[str] = (), games: List[str] = ()):
+        event = {'kind': 'invalidate', 'users': list(users), 'games': list(games)}
+        if self.bus:
+            self.bus.publish(event)
+        else:
+            self.handle_event(event)
+
+    # Users:
+    async def get_user(self, user_id: str) -> Optional[dict]:
+        user = self.users.get(user_id)
+        if user is None:
+            generation = self.users.generation
+            user = await self.repo.get_user(user_id)
+            if user and generation == self.users.generation:
+                self.users.set(user_id, user)
+        return dict(user) if user else None
+
+    async def get_users(self, user_ids: List[str]) -> List[dict]:
+        found = {}
+        missing = []
+        for user_id in user_ids:
+            user = self.users.get(user_id)
+            if user is None:
+                missing.append(user_id)
+            else:
+                found[user_id] = user
+        if missing:
+            generation = self.users.generation
+            for user in await self.repo.get_users(missing):
+                if generation == self.users.generation:
+                    self.users.set(user['id'], user)
+                found[user['id']] = user
+        return [dict(found[uid]) for uid in user_ids if uid in found]
+
+    async def insert_user(self, row: dict) -> dict:
+        user = await self.repo.insert_user(row)
+        self.invalidate(users=[row['id']])
+        return user
+
+    async def update_user(self, user_id: str, fields: dict):
+        await self.repo.update_user(user_id, fields)
+        self.invalidate(users=[user_id])
+
+    async def update_users(self, user_ids: List[str], fields: dict):
+        await self.repo.update_users(user_ids, fields)
+        self.invalidate(users=user_ids)
+
+    # Games:
+    async def get_game(self, game_id: str) -> Optional[dict]:
+        game = self.games.get(game_id)
+        if game is None:
+            generation = self.games.generation
+            game = await self.repo.get_game(game_id)
+            if game and generation == self.games.generation:
+                self.games.set(game_id, game)
+        return dict(game) if game else None
+
+    async def insert_game(self, row: dict) -> dict:
+        game = await self.repo.insert_game(row)
+        self.invalidate(games=[row['game_id']])
+        return game
+
+    async def update_game(self, game_id: str, fields: dict, status: Optional[str] = None) -> bool:
+        updated = await self.repo.update_game(game_id, fields, status)
+        self.invalidate(games=[game_id])
+        return updated
+
+    async def save_game_states(self, states: Dict[str, dict], versions: Optional[Dict[str, int]] = None) -> List[str]:
+        conflicts = await self.repo.save_game_states(states, versions)
+        self.invalidate(games=list(states))
+        return conflicts
+
+    async def settle_games(self, results: List[dict]) -> List[dict]:
+        outcomes = await self.repo.settle_games(results)
+        completed = [o for o in outcomes if o['status'] == 'completed']
+        self.invalidate(
+            users=[o[k] for o in completed for k in ('player1_id', 'player2_id')],
+            games=[o['game_id'] for o in completed]
+        )
+        return outcomes
+
+    def stats(self) -> dict:
+        return {'users': self.users.stats(), 'games': self.games.stats()}
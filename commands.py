@@ -0,0 +1,81 @@
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Hashable, Set
+from fastapi import HTTPException
+from metrics import Histogram
+
+COMMAND_LATENCY = Histogram('ws_command_duration_seconds', 'WebSocket command latency', ('command', 'outcome'))
+
+class CommandPipeline:
+    """Runs the commands of one WebSocket: in order per key (a game), concurrently across keys.
+
+    Clients may send commands without waiting for replies. Each is executed
+    by `dispatch(command)` and answered through `reply(frame)` with a 'reply'
+    frame carrying the command's `id`: {'ok': true, 'result': ...}, or the
+    status and detail of the HTTPException it raised. At most `max_pending`
+    commands may be queued or running; like a connection's writer, a key's
+    worker task exists only while that key has commands. `close()` drops the
+    queued commands of a client that is gone; those already running finish,
+    since a move half handled would be applied but never broadcast or
+    settled, and only their replies are dropped.
+    """
+
+    __slots__ = ('dispatch', 'reply', 'max_pending', 'pending', 'queues', 'tasks', 'closed')
+
+    def __init__(self, dispatch: Callable[[dict], Awaitable], reply: Callable[[dict], Awaitable], max_pending: int = 64):
+        self.dispatch = dispatch
+        self.reply = reply
+        self.max_pending = max_pending
+        self.pending = 0
+        self.queues: Dict[Hashable, Deque[dict]] = {}
+        # The loop holds tasks only weakly; these references keep running workers alive.
+        self.tasks: Set[asyncio.Task] = set()
+        self.closed = False
+
+    def submit(self, key: Hashable, command: dict) -> bool:
+        if self.closed or self.pending >= self.max_pending:
+            return False
+        self.pending += 1
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = deque([command])
+            task = asyncio.ensure_future(self._run(key, queue))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        else:
+            queue.append(command)
+        return True
+
+    async def _run(self, key: Hashable, queue: Deque[dict]):
+        # Nothing is awaited between the last check and the removal, so no command is left behind.
+        while queue:
+            await self._execute(queue[0])
+            queue.popleft()
+            self.pending -= 1
+        del self.queues[key]
+
+    def close(self):
+        # Each queue's first command is running, or about to; the rest are dropped.
+        self.closed = True
+        for queue in self.queues.values():
+            while len(queue) > 1:
+                queue.pop()
+                self.pending -= 1
+
+    async def _execute(self, command: dict):
+        start = time.perf_counter()
+        try:
+            frame = {'type': 'reply', 'id': command.get('id'), 'ok': True, 'result': await self.dispatch(command)}
+        except HTTPException as e:
+            frame = {'type': 'reply', 'id': command.get('id'), 'ok': False, 'status': e.status_code, 'detail': e.detail}
+        except Exception as e:
+            print(f"Command {command.get('type')} failed: {e}")
+            frame = {'type': 'reply', 'id': command.get('id'), 'ok': False, 'status': 500, 'detail': 'Internal error'}
+        COMMAND_LATENCY.observe(time.perf_counter() - start, command.get('type'), 'ok' if frame['ok'] else frame['status'])
+        if self.closed:
+            return
+        try:
+            await self.reply(frame)
+        except Exception as e:
+            print(f"Failed to reply to command {command.get('type')}: {e}")
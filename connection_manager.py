@@ -0,0 +1,298 @@
+import asyncio
+import base64
+import json
+import sys
+import time
+from collections import deque
+from typing import Deque, Dict, Iterable, Optional, Set, Tuple, Union
+from fastapi import WebSocket
+from metrics import Counter, Histogram
+from pubsub import InProcessBus
+
+FANOUT_SECONDS = Histogram('ws_fanout_seconds', 'Time to queue a bus event on every local recipient', ('kind',))
+FRAMES_DROPPED = Counter('ws_frames_dropped_total', 'Frames not queued because the connection queue was full')
+
+def serialize(message) -> str:
+    if isinstance(message, dict):
+        return json.dumps(message, separators=(',', ':'))
+    return message
+
+def encode_binary(binary: Optional[bytes]) -> Optional[str]:
+    # Bus events are JSON, so binary frames travel base64-encoded.
+    return base64.b64encode(binary).decode() if binary is not None else None
+
+class Session:
+    """What the server knows about a connected user, so handlers need not read `users`.
+
+    Filled from the users row on connect and kept current by 'session' and
+    'leaderboard' bus events. Ids are interned, so the one string is shared
+    by every index holding it.
+    """
+
+    __slots__ = ('user_id', 'username', 'rating', 'status', 'game_id')
+
+    def __init__(self, user_id: str, username: Optional[str] = None, rating: Optional[int] = None,
+                 status: Optional[str] = None, game_id: Optional[str] = None):
+        self.user_id = sys.intern(user_id)
+        self.username = username
+        self.rating = rating
+        self.status = status
+        self.game_id = sys.intern(game_id) if game_id else None
+
+    @classmethod
+    def from_user(cls, user: dict) -> 'Session':
+        return cls(user['id'], user.get('username'), user.get('rating'), user.get('status'))
+
+    def as_user(self) -> dict:
+        return {'id': self.user_id, 'username': self.username, 'rating': self.rating, 'status': self.status}
+
+class Connection:
+    """A WebSocket with a bounded outgoing queue, drained by a writer task while it is not empty.
+
+    A connection that negotiated binary frames gets the binary form of a
+    message whenever one exists, and the JSON text otherwise. An idle
+    connection holds no queue and no task, only this object and its session.
+    """
+
+    __slots__ = ('websocket', 'binary', 'max_queue', 'frames', 'writer', 'session')
+
+    def __init__(self, websocket: WebSocket, max_queue: int, binary: bool = False, session: Optional[Session] = None):
+        self.websocket = websocket
+        self.binary = binary
+        self.max_queue = max_queue
+        self.frames: Optional[Deque[Union[str, bytes]]] = None
+        self.writer: Optional[asyncio.Task] = None
+        self.session = session
+
+    def offer(self, frame: str, binary: Optional[bytes] = None) -> bool:
+        if self.frames is None:
+            self.frames = deque()
+        elif len(self.frames) >= self.max_queue:
+            return False
+        self.frames.append(binary if self.binary and binary is not None else frame)
+        return True
+
+    async def write(self):
+        # Returns once the queue is empty; nothing can be queued between the last check and the reset.
+        frames = self.frames
+        while frames:
+            frame = frames.popleft()
+            if isinstance(frame, bytes):
+                await self.websocket.send_bytes(frame)
+            else:
+                await self.websocket.send_text(frame)
+        self.frames = None
+
+class ConnectionManager:
+    """Tracks WebSocket connections and fans messages out to them.
+
+    Messages are serialized once and queued on every recipient's connection;
+    each connection's writer sends independently, so one slow socket never
+    delays the others. A consumer whose queue is full is disconnected
+    (`slow_consumer='disconnect'`) or misses that message (`'drop'`).
+    Game participants are cached in `game_players`; `load_players(game_id)`
+    is awaited to fill the cache on a miss. Spectators are indexed both ways
+    (`game_spectators` and `user_games`), so joining, leaving and
+    disconnecting cost O(1) per membership; empty entries are removed.
+
+    Anything that must reach sockets or membership held by other processes is
+    published on `bus` as an event and applied by `handle_event` in every
+    process, each of which delivers only to its own connections. Users
+    connecting and disconnecting are published too ('connect', 'disconnect'),
+    as are changes to sessions ('session').
+    """
+
+    def __init__(self, load_players=None, max_queue: int = 256, slow_consumer: str = 'disconnect', bus=None):
+        self.active_connections: Dict[str, Connection] = {}
+        self.game_spectators: Dict[str, Set[str]] = {}
+        self.user_games: Dict[str, Set[str]] = {}
+        self.game_players: Dict[str, Tuple[Optional[str], Optional[str]]] = {}
+        self.load_players = load_players
+        self.max_queue = max_queue
+        self.slow_consumer = slow_consumer
+        self.dropped = 0
+        self.bus = bus or InProcessBus()
+        self.bus.subscribe(self.handle_event)
+
+    async def connect(self, user_id: str, websocket: WebSocket, binary: bool = False, session: Optional[Session] = None):
+        await websocket.accept()
+        user_id = sys.intern(user_id)
+        previous = self.active_connections.get(user_id)
+        if previous:
+            self._close(user_id, previous)
+        self.active_connections[user_id] = Connection(websocket, self.max_queue, binary, session)
+        self.bus.publish({'kind': 'connect', 'user_id': user_id})
+
+    def session(self, user_id: str) -> Optional[Session]:
+        connection = self.active_connections.get(user_id)
+        return connection.session if connection else None
+
+    def update_sessions(self, user_ids: Iterable[str], **fields):
+        # Applied wherever the users are connected, like any other event.
+        self.bus.publish({'kind': 'session', 'user_ids': list(user_ids), 'fields': fields})
+
+    def disconnect(self, user_id: str, websocket: Optional[WebSocket] = None):
+        connection = self.active_connections.get(user_id)
+        if connection and websocket is not None and connection.websocket is not websocket:
+            # A newer connection for this user replaced the one that closed.
+            return
+        if connection:
+            self.active_connections.pop(user_id, None)
+            if connection.writer:
+                connection.writer.cancel()
+        self.bus.publish({'kind': 'disconnect', 'user_id': user_id})
+
+    async def _run_writer(self, user_id: str, connection: Connection):
+        try:
+            await connection.write()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # The socket went away; the receive loop will see the disconnect too.
+            if self.active_connections.get(user_id) is connection:
+                self.active_connections.pop(user_id, None)
+        finally:
+            connection.writer = None
+
+    def _close(self, user_id: str, connection: Connection):
+        if self.active_connections.get(user_id) is connection:
+            self.active_connections.pop(user_id, None)
+        if connection.writer:
+            connection.writer.cancel()
+        asyncio.ensure_future(self._close_socket(connection.websocket))
+
+    async def _close_socket(self, websocket: WebSocket):
+        try:
+            await websocket.close(code=1013)
+        except Exception:
+            pass
+
+    def set_binary(self, user_id: str, binary: bool):
+        connection = self.active_connections.get(user_id)
+        if connection:
+            connection.binary = binary
+
+    def _deliver(self, user_id: str, frame: str, binary: Optional[bytes] = None):
+        connection = self.active_connections.get(user_id)
+        if connection is None:
+            return
+        if not connection.offer(frame, binary):
+            self.dropped += 1
+            FRAMES_DROPPED.inc()
+            if self.slow_consumer == 'disconnect':
+                self._close(user_id, connection)
+        elif connection.writer is None:
+            connection.writer = asyncio.ensure_future(self._run_writer(user_id, connection))
+
+    @staticmethod
+    def _discard(index: Dict[str, Set[str]], key: str, value: str):
+        members = index.get(key)
+        if members is not None:
+            members.discard(value)
+            if not members:
+                del index[key]
+
+    def add_spectator(self, game_id: str, user_id: str) -> bool:
+        if user_id in self.game_spectators.get(game_id, ()):
+            return False
+        self.bus.publish({'kind': 'spectate', 'game_id': game_id, 'user_id': user_id})
+        return True
+
+    def remove_spectator(self, game_id: str, user_id: str) -> bool:
+        if user_id not in self.game_spectators.get(game_id, ()):
+            return False
+        self.bus.publish({'kind': 'unspectate', 'game_id': game_id, 'user_id': user_id})
+        return True
+
+    def set_players(self, game_id: str, player1_id: Optional[str], player2_id: Optional[str]):
+        self.game_players[sys.intern(game_id)] = (player1_id and sys.intern(player1_id), player2_id and sys.intern(player2_id))
+
+    def forget_game(self, game_id: str):
+        self.bus.publish({'kind': 'forget', 'game_id': game_id})
+
+    def handle_event(self, event: dict):
+        kind = event['kind']
+        if kind in ('deliver', 'all', 'game'):
+            start = time.perf_counter()
+            self._fan_out(kind, event)
+            FANOUT_SECONDS.observe(time.perf_counter() - start, kind)
+        elif kind == 'spectate':
+            game_id, user_id = sys.intern(event['game_id']), sys.intern(event['user_id'])
+            self.game_spectators.setdefault(game_id, set()).add(user_id)
+            self.user_games.setdefault(user_id, set()).add(game_id)
+        elif kind == 'unspectate':
+            self._discard(self.game_spectators, event['game_id'], event['user_id'])
+            self._discard(self.user_games, event['user_id'], event['game_id'])
+        elif kind == 'disconnect':
+            for game_id in self.user_games.pop(event['user_id'], ()):
+                self._discard(self.game_spectators, game_id, event['user_id'])
+        elif kind == 'forget':
+            self.game_players.pop(event['game_id'], None)
+            for user_id in self.game_spectators.pop(event['game_id'], ()):
+                self._discard(self.user_games, user_id, event['game_id'])
+        elif kind == 'session':
+            fields = event['fields']
+            if fields.get('game_id'):
+                fields = {**fields, 'game_id': sys.intern(fields['game_id'])}
+            for user_id in event['user_ids']:
+                session = self.session(user_id)
+                if session:
+                    for name, value in fields.items():
+                        setattr(session, name, value)
+        elif kind == 'leaderboard':
+            # New ratings of settled games, published for the leaderboard.
+            for user_id, rating, _ in event['results']:
+                session = self.session(user_id)
+                if session:
+                    session.rating = rating
+
+    def _fan_out(self, kind: str, event: dict):
+        binary = base64.b64decode(event['binary']) if event.get('binary') else None
+        if kind == 'deliver':
+            for user_id in event['user_ids']:
+                self._deliver(user_id, event['frame'], binary)
+        elif kind == 'all':
+            for user_id in list(self.active_connections):
+                if user_id != event.get('exclude'):
+                    self._deliver(user_id, event['frame'])
+        elif kind == 'game':
+            for user_id in self.game_spectators.get(event['game_id'], ()):
+                self._deliver(user_id, event['frame'], binary)
+            for player_id in event['players']:
+                if player_id:
+                    self._deliver(player_id, event['frame'], binary)
+
+    async def players_of(self, game_id: str) -> Tuple[Optional[str], Optional[str]]:
+        players = self.game_players.get(game_id)
+        if players is None and self.load_players:
+            players = await self.load_players(game_id)
+            if players:
+                self.game_players[game_id] = players
+        return players or (None, None)
+
+    async def send_personal_message(self, user_id: str, message, binary: Optional[bytes] = None):
+        await self.send_many([user_id], message, binary)
+
+    async def send_many(self, user_ids: Iterable[str], message, binary: Optional[bytes] = None):
+        frame = serialize(message)
+        remote = []
+        for user_id in user_ids:
+            if user_id in self.active_connections:
+                self._deliver(user_id, frame, binary)
+            else:
+                remote.append(user_id)
+        if remote:
+            self.bus.publish({'kind': 'deliver', 'user_ids': remote, 'frame': frame, 'binary': encode_binary(binary)})
+
+    async def send_to_all(self, message, exclude: Optional[str] = None):
+        self.bus.publish({'kind': 'all', 'exclude': exclude, 'frame': serialize(message)})
+
+    async def broadcast_to_game(self, game_id: str, message, binary: Optional[bytes] = None):
+        players = await self.players_of(game_id)
+        self.bus.publish({
+            'kind': 'game',
+            'game_id': game_id,
+            'players': list(players),
+            'frame': serialize(message),
+            'binary': encode_binary(binary)
+        })
@@ -0,0 +1,11 @@
+K_FACTOR = 32
+
+def expected_score(rating, opponent_rating):
+    return 1 / (1 + 10 ** ((opponent_rating - rating) / 400))
+
+def new_ratings(rating1, rating2, score1, k=K_FACTOR):
+    # score1 is 1, 0.5 or 0 from player 1's point of view; ratings are truncated like the database does.
+    score2 = 1 - score1
+    new_rating1 = rating1 + k * (score1 - expected_score(rating1, rating2))
+    new_rating2 = rating2 + k * (score2 - expected_score(rating2, rating1))
+    return int(new_rating1), int(new_rating2)
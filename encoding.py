@@ -0,0 +1,109 @@
+import base64
+import struct
+import uuid
+from array import array
+from typing import List, Optional, Tuple
+import chess
+
+# A move fits in 16 bits: from-square (6), to-square (6), promotion piece type (3).
+def encode_move(move: chess.Move) -> int:
+    return move.from_square | (move.to_square << 6) | ((move.promotion or 0) << 12)
+
+def decode_move(code: int) -> chess.Move:
+    return chess.Move(code & 0x3f, (code >> 6) & 0x3f, (code >> 12) or None)
+
+def pack_moves(moves: List[chess.Move]) -> bytes:
+    return array('H', [encode_move(m) for m in moves]).tobytes()
+
+def unpack_moves(data: bytes) -> List[chess.Move]:
+    codes = array('H')
+    codes.frombytes(data)
+    return [decode_move(code) for code in codes]
+
+# Colour and piece bitboards, castling flags, side to move, en passant square, clocks.
+BOARD = struct.Struct('<8QBBBHH')
+CASTLING_SQUARES = (chess.A1, chess.H1, chess.A8, chess.H8)
+NO_SQUARE = 0xff
+
+def pack_board(board: chess.Board) -> bytes:
+    castling = 0
+    for bit, square in enumerate(CASTLING_SQUARES):
+        if board.castling_rights & chess.BB_SQUARES[square]:
+            castling |= 1 << bit
+    return BOARD.pack(
+        board.occupied_co[chess.WHITE], board.occupied_co[chess.BLACK],
+        board.pawns, board.knights, board.bishops, board.rooks, board.queens, board.kings,
+        castling, int(board.turn), NO_SQUARE if board.ep_square is None else board.ep_square,
+        board.halfmove_clock, board.fullmove_number
+    )
+
+def unpack_board(data: bytes) -> chess.Board:
+    (white, black, pawns, knights, bishops, rooks, queens, kings,
+     castling, turn, ep_square, halfmove_clock, fullmove_number) = BOARD.unpack(data)
+
+    board = chess.Board(None)
+    board.occupied_co[chess.WHITE] = white
+    board.occupied_co[chess.BLACK] = black
+    board.occupied = white | black
+    board.pawns, board.knights, board.bishops = pawns, knights, bishops
+    board.rooks, board.queens, board.kings = rooks, queens, kings
+    board.castling_rights = 0
+    for bit, square in enumerate(CASTLING_SQUARES):
+        if castling & (1 << bit):
+            board.castling_rights |= chess.BB_SQUARES[square]
+    board.turn = bool(turn)
+    board.ep_square = None if ep_square == NO_SQUARE else ep_square
+    board.halfmove_clock = halfmove_clock
+    board.fullmove_number = fullmove_number
+    return board
+
+# game_state column:
+def encode_game_state(board: chess.Board, turn: str) -> dict:
+    # The move list is taken from board.move_stack, so the board must have been played from the start position.
+    return {
+        'encoding': 'compact',
+        'board': base64.b64encode(pack_board(board)).decode(),
+        'turn': turn,
+        'moves': base64.b64encode(pack_moves(board.move_stack)).decode()
+    }
+
+def decode_game_state(game_state: dict) -> Tuple[chess.Board, str, List[str]]:
+    # Replays the moves so the returned board carries its move stack; the packed board is the fallback.
+    moves = unpack_moves(base64.b64decode(game_state['moves']))
+    board = chess.Board()
+    history = []
+    for move in moves:
+        history.append(board.san(move))
+        board.push(move)
+    if not moves:
+        board = unpack_board(base64.b64decode(game_state['board']))
+    return board, game_state['turn'], history
+
+# Binary WebSocket frames:
+MOVE_FRAME = 1
+SNAPSHOT_FRAME = 2
+MOVE = struct.Struct('<B16sIH')
+SNAPSHOT = struct.Struct('<B16sI')
+
+def move_frame(game_id: str, seq: int, move: chess.Move) -> bytes:
+    return MOVE.pack(MOVE_FRAME, uuid.UUID(game_id).bytes, seq, encode_move(move))
+
+def snapshot_frame(game_id: str, seq: int, board: chess.Board, moves: Optional[List[chess.Move]] = None) -> bytes:
+    return SNAPSHOT.pack(SNAPSHOT_FRAME, uuid.UUID(game_id).bytes, seq) + pack_board(board) + pack_moves(moves or [])
+
+def parse_frame(data: bytes) -> dict:
+    kind = data[0]
+    if kind == MOVE_FRAME:
+        _, game_id, seq, code = MOVE.unpack(data)
+        return {'type': 'move_made', 'game_id': str(uuid.UUID(bytes=game_id)), 'seq': seq, 'move': decode_move(code)}
+    if kind == SNAPSHOT_FRAME:
+        _, game_id, seq = SNAPSHOT.unpack_from(data)
+        offset = SNAPSHOT.size + BOARD.size
+        return {
+            'type': 'snapshot',
+            'game_id': str(uuid.UUID(bytes=game_id)),
+            'seq': seq,
+            'board': unpack_board(data[SNAPSHOT.size:offset]),
+            'moves': unpack_moves(data[offset:])
+        }
+    raise ValueError(f"Unknown frame type {kind}")
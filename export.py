@@ -0,0 +1,134 @@
+import argparse
+import asyncio
+import json
+import sys
+from datetime import datetime, timezone
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+import dotenv
+from analysis import CpuExecutor
+from encoding import decode_game_state
+from repository import create_repository
+
+FORMATS = {'pgn': 'application/x-chess-pgn', 'ndjson': 'application/x-ndjson'}
+PAGE_SIZE = 500
+
+def utc(value: Optional[datetime]) -> Optional[str]:
+    # Naive datetimes are taken as UTC, the zone created_at is stored in.
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.isoformat()
+
+def stored_history(game_state: Optional[dict]) -> List[str]:
+    game_state = game_state or {}
+    if game_state.get('encoding') == 'compact':
+        return decode_game_state(game_state)[2]
+    return game_state.get('history', [])
+
+def pgn_headers(game: dict, players: Dict[str, str]) -> Dict[str, str]:
+    game_state = game.get('game_state') or {}
+    headers = {
+        'Event': 'SolanaChessChain game',
+        'Site': 'SolanaChessChain',
+        'White': players.get(game['player1_id'], '?'),
+        'Black': players.get(game.get('player2_id'), '?')
+    }
+    if game.get('created_at'):
+        headers['Date'] = game['created_at'][:10].replace('-', '.')
+    headers['GameId'] = game['game_id']
+    # Settled games store their result; otherwise it is read off the final position.
+    if game_state.get('result'):
+        headers['Result'] = game_state['result']
+    if game_state.get('termination'):
+        headers['Termination'] = game_state['termination']
+    return headers
+
+def ndjson_record(game: dict, players: Dict[str, str], history: List[str]) -> dict:
+    game_state = game.get('game_state') or {}
+    return {
+        'game_id': game['game_id'],
+        'status': game['status'],
+        'created_at': game.get('created_at'),
+        'bet': game.get('bet'),
+        'white': {'id': game['player1_id'], 'username': players.get(game['player1_id'])},
+        'black': {'id': game.get('player2_id'), 'username': players.get(game.get('player2_id'))},
+        'result': game_state.get('result'),
+        'termination': game_state.get('termination'),
+        'moves': history
+    }
+
+async def pages(repo, page_size: int = PAGE_SIZE, **filters) -> AsyncIterator[List[dict]]:
+    after = None
+    while True:
+        games = await repo.export_games(after=after, limit=page_size, **filters)
+        if games:
+            yield games
+        if len(games) < page_size:
+            return
+        after = (games[-1]['created_at'], games[-1]['game_id'])
+
+async def export_games(repo, fmt: str, pgn: Callable[[str, List[str], Dict[str, str]], Awaitable[str]],
+                       page_size: int = PAGE_SIZE, **filters) -> AsyncIterator[str]:
+    """Yields the stored games matching `filters` as PGN or NDJSON text, one chunk per page.
+
+    Pages are read by keyset (see `export_games` in repository.py) and each
+    is converted and released before the next is fetched, so memory stays
+    that of one page whatever the size of the export. Usernames come from
+    one `get_users` call per page; `pgn(game_id, history, headers)` renders
+    a game (CpuExecutor.pgn). Games whose history does not replay are
+    skipped.
+    """
+    async for games in pages(repo, page_size, **filters):
+        player_ids = list({uid for g in games for uid in (g['player1_id'], g.get('player2_id')) if uid})
+        players = {u['id']: u['username'] for u in await repo.get_users(player_ids)}
+
+        async def render(game: dict) -> Optional[str]:
+            try:
+                history = stored_history(game.get('game_state'))
+                if fmt == 'ndjson':
+                    return json.dumps(ndjson_record(game, players, history), separators=(',', ':')) + '\n'
+                return await pgn(game['game_id'], history, pgn_headers(game, players)) + '\n\n'
+            except ValueError as e:
+                print(f"Skipping game {game['game_id']} in export: {e}", file=sys.stderr)
+                return None
+
+        # Submitted together, so the executor sends a page's PGN work to the workers in batches.
+        chunks = await asyncio.gather(*(render(game) for game in games))
+        yield ''.join(chunk for chunk in chunks if chunk)
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Stream games from the database as PGN or NDJSON.')
+    parser.add_argument('--format', choices=sorted(FORMATS), default='pgn')
+    parser.add_argument('--status', default='completed', help="game status, or 'any'")
+    parser.add_argument('--player', help='only games this user id played')
+    parser.add_argument('--since', type=datetime.fromisoformat, help='created at or after (ISO 8601, UTC if no zone)')
+    parser.add_argument('--until', type=datetime.fromisoformat, help='created before (ISO 8601, UTC if no zone)')
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE)
+    parser.add_argument('--output', help='file to write (default: stdout)')
+    parser.add_argument('--workers', type=int, help='PGN worker processes (default: all CPUs)')
+    args = parser.parse_args(argv)
+    dotenv.load_dotenv()
+
+    async def run():
+        # The source store is chosen like the app's: DATA_BACKEND=supabase (default) or memory.
+        repo = create_repository()
+        cpu = CpuExecutor(workers=args.workers)
+        out = open(args.output, 'w') if args.output else sys.stdout
+        try:
+            async for chunk in export_games(
+                repo, args.format, cpu.pgn, args.page_size,
+                status=None if args.status == 'any' else args.status, player_id=args.player,
+                since=utc(args.since), until=utc(args.until)
+            ):
+                out.write(chunk)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+            cpu.close()
+            await repo.close()
+
+    asyncio.run(run())
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,4 @@
-from mock_data_generator import generate_mock_data
+from mock_data_generator import main
 
 if __name__ == "__main__":
-    generate_mock_data()
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -0,0 +1,208 @@
+import asyncio
+import fcntl
+import glob
+import json
+import os
+import uuid
+from typing import List, Optional, Tuple
+
+class MoveJournal:
+    """Append-only log of accepted moves, so a move can be acknowledged before the database write.
+
+    Records are JSON lines appended to numbered segment files. Each process
+    writes to its own subdirectory of `directory`, held under an exclusive
+    flock for as long as the journal is open; `rotate()`, `discard()` and
+    `replay()` only see that subdirectory. On start, a process adopts the
+    segments of subdirectories whose lock is free, i.e. of processes that
+    exited without flushing, so their moves are replayed exactly once.
+    `mode` decides what `sync()` waits for:
+
+    - 'sync': the record is fsynced (records arriving during an fsync share the next one),
+    - 'group': records are collected for `interval` seconds and fsynced together,
+    - 'buffered': nothing; records are written every `interval` seconds without fsync.
+
+    `rotate()` seals the current segment so the segments can be deleted with
+    `discard()` once the game states they cover are stored; `replay()` reads
+    back whatever was not discarded.
+    """
+
+    MODES = ('sync', 'group', 'buffered')
+
+    def __init__(self, directory: str, mode: str = 'group', interval: float = 0.005):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown journal mode {mode!r}")
+        self.directory = directory
+        self.owner = os.path.join(directory, uuid.uuid4().hex)
+        self.owner_lock = None
+        self.mode = mode
+        self.interval = 0 if mode == 'sync' else interval
+        self.segment = 0
+        self.file = None
+        self.written = 0
+        self.buffer: List[bytes] = []
+        self.appended = 0
+        self.durable = 0
+        self.commits = 0
+        self.waiters: List[Tuple[int, asyncio.Future]] = []
+        self.lock: Optional[asyncio.Lock] = None
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+        self.closing = False
+
+    def _path(self, segment: int) -> str:
+        return os.path.join(self.owner, f'{segment:08d}.log')
+
+    def segments(self) -> List[str]:
+        return sorted(glob.glob(os.path.join(self.owner, '*.log')))
+
+    def start(self):
+        # Adopted segments are left for replay(); new records go to a fresh one.
+        if self.task:
+            return
+        if self.owner_lock is None:
+            self._claim()
+        segments = self.segments()
+        self.segment = int(os.path.basename(segments[-1]).split('.')[0]) + 1 if segments else 1
+        self.file = open(self._path(self.segment), 'ab')
+        self.lock = asyncio.Lock()
+        self.wakeup = asyncio.Event()
+        self.closing = False
+        self.task = asyncio.create_task(self._run())
+
+    def append(self, record: dict):
+        self.buffer.append(json.dumps(record, separators=(',', ':')).encode() + b'\n')
+        self.appended += 1
+        self.start()
+        self.wakeup.set()
+
+    async def sync(self):
+        # Waits until every record appended so far is durable.
+        if self.mode == 'buffered' or self.durable >= self.appended:
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((self.appended, future))
+        await future
+
+    async def _run(self):
+        while not self.closing:
+            await self.wakeup.wait()
+            if self.interval and not self.closing:
+                await asyncio.sleep(self.interval)
+            self.wakeup.clear()
+            await self.commit()
+
+    async def commit(self):
+        async with self.lock:
+            if not self.buffer or self.file is None:
+                return
+            data, self.buffer = b''.join(self.buffer), []
+            target = self.appended
+            try:
+                await asyncio.to_thread(self._write, data)
+            except OSError as e:
+                # The waiting moves fail; their records are retried with the next commit.
+                print(f"Failed to write move journal: {e}")
+                self.buffer.insert(0, data)
+                self._resolve(target, e)
+                return
+            self.written += len(data)
+            self.commits += 1
+            self.durable = target
+            self._resolve(target)
+
+    def _claim(self):
+        # Under a lock on the whole directory, so no process sees another's subdirectory half made
+        # and no orphan is adopted twice. Segments at the top level predate per-process subdirectories.
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, '.lock'), 'a') as directory_lock:
+            fcntl.flock(directory_lock, fcntl.LOCK_EX)
+            os.makedirs(self.owner, exist_ok=True)
+            self.owner_lock = open(os.path.join(self.owner, '.lock'), 'a')
+            fcntl.flock(self.owner_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            adopted = sorted(glob.glob(os.path.join(self.directory, '*.log')))
+            orphans = []
+            for lock_path in sorted(glob.glob(os.path.join(self.directory, '*', '.lock'))):
+                owner = os.path.dirname(lock_path)
+                if owner == self.owner:
+                    continue
+                with open(lock_path, 'a') as lock:
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        # Its process is still running.
+                        continue
+                adopted.extend(sorted(glob.glob(os.path.join(owner, '*.log'))))
+                orphans.append(owner)
+            for segment, path in enumerate(adopted, 1):
+                os.rename(path, self._path(segment))
+            for owner in orphans:
+                os.remove(os.path.join(owner, '.lock'))
+                os.rmdir(owner)
+
+    def _write(self, data: bytes):
+        self.file.write(data)
+        self.file.flush()
+        if self.mode != 'buffered':
+            os.fsync(self.file.fileno())
+
+    def _resolve(self, target: int, error: Optional[Exception] = None):
+        waiting = []
+        for position, future in self.waiters:
+            if position > target:
+                waiting.append((position, future))
+            elif not future.done():
+                if error:
+                    future.set_exception(error)
+                else:
+                    future.set_result(None)
+        self.waiters = waiting
+
+    async def rotate(self) -> List[str]:
+        # Returns every sealed segment; records still buffered land in the new one.
+        self.start()
+        async with self.lock:
+            if self.written:
+                self.file.close()
+                self.segment += 1
+                self.file = open(self._path(self.segment), 'ab')
+                self.written = 0
+        current = self._path(self.segment)
+        return [path for path in self.segments() if path != current]
+
+    def discard(self, paths: List[str]):
+        for path in paths:
+            os.remove(path)
+
+    def replay(self) -> List[dict]:
+        records = []
+        for path in self.segments():
+            with open(path, 'rb') as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # A torn write at the tail of a segment after a crash.
+                        print(f"Skipping unreadable journal record in {path}")
+        return records
+
+    async def close(self):
+        # Lets a commit in progress finish, rather than cancelling it with its batch out of the buffer.
+        if self.task:
+            self.closing = True
+            self.wakeup.set()
+            await self.task
+            self.task = None
+        if self.file:
+            await self.commit()
+            self.file.close()
+            self.file = None
+        if self.owner_lock:
+            # Nothing left to replay: remove the subdirectory rather than leave it for adoption.
+            segments = self.segments()
+            if not any(os.path.getsize(path) for path in segments):
+                for path in segments:
+                    os.remove(path)
+                os.remove(os.path.join(self.owner, '.lock'))
+                os.rmdir(self.owner)
+            self.owner_lock.close()
+            self.owner_lock = None
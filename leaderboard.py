@@ -0,0 +1,112 @@
+import bisect
+from typing import Dict, List, Optional, Tuple
+
+class Leaderboard:
+    """Users ranked by rating, kept in a sorted key array.
+
+    Keys are (-rating, user_id), so rank lookups are a bisect (O(log n)) and
+    top-N or a page around a user is a slice. `version` changes on every
+    update and is used as the ETag of rendered pages.
+    """
+
+    COUNTERS = ('rating', 'wins', 'losses', 'draws')
+
+    def __init__(self):
+        self.keys: List[Tuple[int, str]] = []
+        self.entries: Dict[str, dict] = {}
+        self.version = 0
+        self.pages: Dict[Tuple[int, int], List[dict]] = {}
+        self.pages_version = 0
+        self.ready = False
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def entry(cls, user: dict) -> dict:
+        entry = {k: user.get(k) or 0 for k in cls.COUNTERS}
+        entry['id'] = user['id']
+        entry['username'] = user['username']
+        return entry
+
+    def load(self, users: List[dict]):
+        self.entries = {u['id']: self.entry(u) for u in users}
+        self.keys = sorted((-e['rating'], user_id) for user_id, e in self.entries.items())
+        self.version += 1
+        self.ready = True
+
+    def _remove_key(self, entry: dict):
+        key = (-entry['rating'], entry['id'])
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            del self.keys[i]
+
+    def upsert(self, user: dict):
+        entry = self.entries.get(user['id'])
+        if entry:
+            self._remove_key(entry)
+            entry.update({k: user[k] for k in self.COUNTERS + ('username',) if k in user})
+        else:
+            entry = self.entry(user)
+            self.entries[user['id']] = entry
+        bisect.insort(self.keys, (-entry['rating'], entry['id']))
+        self.version += 1
+
+    def record_result(self, user_id: str, rating: int, score: float):
+        entry = self.entries.get(user_id)
+        if not entry:
+            return
+        self.upsert({
+            'id': user_id,
+            'rating': rating,
+            'wins': entry['wins'] + (score == 1),
+            'losses': entry['losses'] + (score == 0),
+            'draws': entry['draws'] + (score == 0.5)
+        })
+
+    def rank(self, user_id: str) -> Optional[int]:
+        entry = self.entries.get(user_id)
+        if not entry:
+            return None
+        return bisect.bisect_left(self.keys, (-entry['rating'], user_id)) + 1
+
+    def page(self, offset: int, limit: int) -> List[dict]:
+        return [self.render(self.entries[user_id], offset + i + 1) for i, (_, user_id) in enumerate(self.keys[offset:offset + limit])]
+
+    def cached_page(self, offset: int, limit: int) -> List[dict]:
+        if self.pages_version != self.version:
+            self.pages = {}
+            self.pages_version = self.version
+        page = self.pages.get((offset, limit))
+        if page is None:
+            page = self.pages[(offset, limit)] = self.page(offset, limit)
+        return page
+
+    def around(self, user_id: str, radius: int) -> List[dict]:
+        rank = self.rank(user_id)
+        if rank is None:
+            return []
+        offset = max(0, rank - 1 - radius)
+        return self.page(offset, rank - offset + radius)
+
+    @staticmethod
+    def render(entry: dict, rank: int) -> dict:
+        total_games = entry['wins'] + entry['losses'] + entry['draws']
+        win_percentage = (entry['wins'] / total_games * 100) if total_games > 0 else 0
+        return {
+            'rank': rank,
+            'username': entry['username'],
+            'rating': entry['rating'],
+            'wins': entry['wins'],
+            'losses': entry['losses'],
+            'draws': entry['draws'],
+            'win_percentage': round(win_percentage, 2)
+        }
+
+    def handle_event(self, event: dict):
+        # Rating changes published on the bus by whichever process settled the game.
+        if event['kind'] == 'leaderboard':
+            for user_id, rating, score in event['results']:
+                self.record_result(user_id, rating, score)
+        elif event['kind'] == 'leaderboard_user':
+            self.upsert(event['user'])
@@ -0,0 +1,410 @@
+import asyncio
+import time
+import chess
+from collections import Counter
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from apply_move import InvalidMoveException, push_move
+from encoding import decode_game_state, encode_game_state
+from position_cache import PositionCache, position_key
+import metrics
+
+MOVES_APPLIED = metrics.Counter('moves_applied_total', 'Moves accepted and applied to a resident game')
+MOVES_REJECTED = metrics.Counter('moves_rejected_total', 'Moves rejected, by reason', ('reason',))
+WRITE_CONFLICTS = metrics.Counter('game_write_conflicts_total', 'Resident games dropped because their row was written elsewhere')
+
+def rejection_reason(message: str) -> str:
+    return message.lower().replace(' ', '_')
+
+# Longest time per side, and longest increment, a time control may give.
+MAX_CLOCK_SECONDS = 86400.0
+
+def parse_time_control(text: str) -> Tuple[float, float]:
+    # '600+5': 600 seconds per side plus 5 seconds per move. float() also takes 'inf' and 'nan', which
+    # no deadline can be computed from, so both parts must lie within (0, MAX_CLOCK_SECONDS].
+    initial, _, increment = text.partition('+')
+    initial, increment = float(initial), float(increment or 0)
+    if not 0 < initial <= MAX_CLOCK_SECONDS or not 0 <= increment <= MAX_CLOCK_SECONDS:
+        raise ValueError(f"Invalid time control {text!r}")
+    return initial, increment
+
+def new_clock(time_control: Tuple[float, float], now: Optional[float] = None) -> dict:
+    # Stored in game_state['clock']; times are seconds, last_move_at is a time.time() timestamp.
+    initial, increment = time_control
+    return {
+        'initial': initial,
+        'increment': increment,
+        'white': initial,
+        'black': initial,
+        'last_move_at': time.time() if now is None else now
+    }
+
+class LiveGame:
+    def __init__(self, game_id: str, player1_id: str, player2_id: str, game_state: Optional[dict] = None,
+                 time_control: Optional[Tuple[float, float]] = None, version: int = 0,
+                 positions: Optional[PositionCache] = None):
+        game_state = game_state or {}
+        # Shared with other games; None re-derives every position. `position` is the current board's entry.
+        self.position_cache = positions
+        self.position = None
+
+        self.game_id = game_id
+        self.player1_id = player1_id
+        self.player2_id = player2_id
+        # games.version of the row this game was loaded from, plus the writes made since.
+        self.version = version
+        if game_state.get('encoding') == 'compact':
+            self.board, self.turn, self.history = decode_game_state(game_state)
+        else:
+            board_fen = game_state.get('board')
+            self.board = chess.Board(board_fen) if board_fen else chess.Board()
+            self.history = list(game_state.get('history', []))
+            self.turn = game_state.get('turn', player1_id)
+        # Games stored before clocks existed get a fresh one when `time_control` is given.
+        clock = game_state.get('clock')
+        self.clock = dict(clock) if clock else new_clock(time_control) if time_control else None
+        self.positions = self._count_positions()
+        self.termination = self._termination()
+        self.winner: Optional[str] = None
+        # The player whose draw offer stands; any move declines it.
+        self.draw_offer: Optional[str] = None
+
+    @property
+    def seq(self) -> int:
+        # Number of moves played; move_made messages carry the seq reached by that move.
+        return len(self.history)
+
+    def color_of(self, player_id: str):
+        return chess.WHITE if player_id == self.player1_id else chess.BLACK
+
+    @property
+    def deadline(self) -> Optional[float]:
+        # When the side to move runs out of time; None for untimed or finished games.
+        if not self.clock or self.termination:
+            return None
+        return self.clock['last_move_at'] + self.clock['white' if self.board.turn == chess.WHITE else 'black']
+
+    def apply(self, move: str, player_id: str, now: Optional[float] = None) -> str:
+        if self.termination:
+            raise InvalidMoveException('Game is over')
+        if self.clock:
+            now = time.time() if now is None else now
+            left = self.deadline - now
+            if left <= 0:
+                raise InvalidMoveException('Time is up')
+        san = push_move(self.board, move, self.color_of(player_id), self.position_cache, self.position)
+        if self.clock:
+            side = 'white' if self.color_of(player_id) == chess.WHITE else 'black'
+            self.clock[side] = round(left + self.clock['increment'], 3)
+            self.clock['last_move_at'] = now
+        self.history.append(san)
+        self.turn = self.player1_id if player_id == self.player2_id else self.player2_id
+        self.draw_offer = None
+
+        # Positions before an irreversible move (capture, pawn move) cannot come back.
+        if self.board.halfmove_clock == 0:
+            self.positions.clear()
+        key = position_key(self.board)
+        self.positions[key] += 1
+        self.termination = self._termination(key)
+        return san
+
+    def flag(self, now: Optional[float] = None) -> bool:
+        """Ends the game on time if the side to move has run out; returns whether it did.
+
+        The opponent wins, unless they could not mate with their remaining
+        material, in which case the game is drawn.
+        """
+        deadline = self.deadline
+        if deadline is None or (time.time() if now is None else now) < deadline:
+            return False
+        color = self.board.turn
+        self.clock['white' if color == chess.WHITE else 'black'] = 0
+        loser_id = self.player1_id if color == chess.WHITE else self.player2_id
+        self.forfeit(loser_id, 'timeout', draw=self.board.has_insufficient_material(not color))
+        return True
+
+    def forfeit(self, player_id: str, termination: str, draw: bool = False):
+        self.termination = termination
+        self.winner = None if draw else self.player2_id if player_id == self.player1_id else self.player1_id
+
+    def offer_draw(self, player_id: str) -> bool:
+        """Records a draw offer; returns whether it ended the game, the opponent having offered one too."""
+        if self.termination:
+            raise InvalidMoveException('Game is over')
+        if self.draw_offer and self.draw_offer != player_id:
+            self.forfeit(player_id, 'agreement', draw=True)
+            return True
+        self.draw_offer = player_id
+        return False
+
+    def _count_positions(self) -> Counter:
+        board = self.board.copy()
+        positions = Counter([position_key(board)])
+        while board.move_stack and board.halfmove_clock > 0:
+            board.pop()
+            positions[position_key(board)] += 1
+        return positions
+
+    def _termination(self, key=None) -> Optional[str]:
+        # Checked after every move, cheapest first; one legal-move probe covers mate and stalemate.
+        # Threefold repetition and the fifty-move rule end the game without a claim.
+        board = self.board
+        key = position_key(board) if key is None else key
+        if self.position_cache is not None:
+            self.position = self.position_cache.get(board, key)
+        if self.position is not None:
+            if self.position.status:
+                return self.position.status
+        elif not any(board.generate_legal_moves()):
+            return 'checkmate' if board.is_check() else 'stalemate'
+        elif board.is_insufficient_material():
+            return 'insufficient_material'
+        if board.halfmove_clock >= 100:
+            return 'fifty_moves'
+        if self.positions[key] >= 3:
+            return 'threefold_repetition'
+        return None
+
+    @property
+    def winner_id(self) -> Optional[str]:
+        # Checkmate is won by the side that just moved; a forfeit (time, abandonment) records its winner.
+        if self.termination != 'checkmate':
+            return self.winner
+        return self.player2_id if self.board.turn == chess.WHITE else self.player1_id
+
+    def game_state(self) -> dict:
+        game_state = {
+            'board': self.board.fen(),
+            'turn': self.turn,
+            'history': list(self.history)
+        }
+        if self.clock:
+            game_state['clock'] = dict(self.clock)
+        return game_state
+
+    def stored_state(self, encoding: str = 'fen') -> dict:
+        # Compact storage needs every move on the board's stack; games loaded from a FEN alone stay as FEN.
+        if encoding == 'compact' and len(self.board.move_stack) == len(self.history):
+            game_state = encode_game_state(self.board, self.turn)
+            if self.clock:
+                game_state['clock'] = dict(self.clock)
+            return game_state
+        return self.game_state()
+
+class LiveGameRegistry:
+    """Keeps a resident chess.Board per in-progress game.
+
+    Moves are validated and applied in memory; changed games are written back
+    in one batch through `persist({game_id: game_state})` by `flush()`, which
+    `run()` calls every `flush_interval` seconds. `encoding` selects the stored
+    form of game_state: 'fen' (FEN plus SAN history) or 'compact' (see
+    encoding.py). With a `journal` (see journal.py) each move is also logged
+    locally, and `recover()` replays moves that never reached the database;
+    until a recovery has succeeded, flushes leave the journal's segments be.
+    With `timers` (see timer_wheel.py) the flag-fall of every timed game is
+    kept scheduled under the key ('flag', game_id); `time_control` is the
+    clock given to games stored without one. `positions` (see
+    position_cache.py) is shared by every game to skip re-deriving common
+    positions.
+
+    `lock(game_id)` serializes the handling of one game's moves; other games
+    are not held up; `lock_all(game_ids)` holds several, for settlements.
+    Writes are optimistic: each game carries the version of its row, and a
+    game whose row was written elsewhere in the meantime (another process)
+    is dropped, to be loaded again on its next use. Its moves since the last
+    write were acknowledged but are lost, so `on_conflict(game)` is awaited
+    to tell its players.
+    """
+
+    def __init__(self, persist, flush_interval: float = 0.5, encoding: str = 'fen', journal=None,
+                 timers=None, time_control: Optional[Tuple[float, float]] = None, positions: Optional[PositionCache] = None,
+                 on_conflict=None):
+        self.persist = persist
+        self.on_conflict = on_conflict
+        self.flush_interval = flush_interval
+        self.encoding = encoding
+        self.journal = journal
+        # Segments left by an earlier run hold moves only recover() can store, so none is discarded before it has.
+        self.recovered = journal is None
+        self.timers = timers
+        self.time_control = time_control
+        self.positions = positions
+        self.games: Dict[str, LiveGame] = {}
+        self.player_games: Dict[str, Set[str]] = {}
+        self.dirty: Set[str] = set()
+        # game_id -> [lock, holders and waiters]; removed when the last one leaves.
+        self.locks: Dict[str, list] = {}
+        self.write_lock: Optional[asyncio.Lock] = None
+
+    def start(self, game_id: str, player1_id: str, player2_id: str, game_state: Optional[dict] = None,
+              version: int = 0) -> LiveGame:
+        game = LiveGame(game_id, player1_id, player2_id, game_state, self.time_control, version, self.positions)
+        self.games[game_id] = game
+        for player_id in (player1_id, player2_id):
+            self.player_games.setdefault(player_id, set()).add(game_id)
+        self._schedule(game)
+        return game
+
+    def get(self, game_id: str) -> Optional[LiveGame]:
+        return self.games.get(game_id)
+
+    def games_of(self, player_id: str) -> Set[str]:
+        return self.player_games.get(player_id, set())
+
+    def writing(self) -> asyncio.Lock:
+        # Held while game states are written, so a settlement never races a flush of the same game.
+        if self.write_lock is None:
+            self.write_lock = asyncio.Lock()
+        return self.write_lock
+
+    @asynccontextmanager
+    async def lock(self, game_id: str):
+        entry = self.locks.get(game_id)
+        if entry is None:
+            entry = self.locks[game_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[game_id]
+
+    @asynccontextmanager
+    async def lock_all(self, game_ids: Iterable[str]):
+        # Always taken in id order, so two callers holding several games cannot deadlock.
+        async with AsyncExitStack() as stack:
+            for game_id in sorted(set(game_ids)):
+                await stack.enter_async_context(self.lock(game_id))
+            yield
+
+    async def _conflict(self, game: LiveGame):
+        WRITE_CONFLICTS.inc()
+        print(f"Game {game.game_id} was written elsewhere; its moves since the last write here are lost")
+        if self.on_conflict:
+            await self.on_conflict(game)
+
+    def _schedule(self, game: LiveGame):
+        if self.timers is not None:
+            deadline = game.deadline
+            if deadline is None:
+                self.timers.cancel(('flag', game.game_id))
+            else:
+                self.timers.schedule(('flag', game.game_id), deadline)
+
+    def apply_move(self, game_id: str, move: str, player_id: str, now: Optional[float] = None) -> str:
+        game = self.games[game_id]
+        now = time.time() if now is None else now
+        try:
+            san = game.apply(move, player_id, now)
+        except InvalidMoveException as e:
+            MOVES_REJECTED.inc(rejection_reason(str(e)))
+            raise
+        MOVES_APPLIED.inc()
+        self.dirty.add(game_id)
+        self._schedule(game)
+        if self.journal:
+            self.journal.append({'g': game_id, 's': game.seq, 'm': game.board.peek().uci(), 'p': player_id, 't': now})
+        return san
+
+    async def sync(self):
+        # Waits until the moves applied so far are durable in the journal.
+        if self.journal:
+            await self.journal.sync()
+
+    async def drop(self, game_id: str, persist: bool = True) -> Optional[LiveGame]:
+        game = self.games.pop(game_id, None)
+        if game:
+            for player_id in (game.player1_id, game.player2_id):
+                games = self.player_games.get(player_id)
+                if games is not None:
+                    games.discard(game_id)
+                    if not games:
+                        del self.player_games[player_id]
+            if self.timers is not None:
+                self.timers.cancel(('flag', game_id))
+        if not persist:
+            self.dirty.discard(game_id)
+        elif game and game_id in self.dirty:
+            self.dirty.discard(game_id)
+            async with self.writing():
+                conflicts = await self.persist({game_id: game.stored_state(self.encoding)}, {game_id: game.version})
+            if conflicts:
+                await self._conflict(game)
+            else:
+                game.version += 1
+        return game
+
+    async def _resolve(self, games: Dict[str, LiveGame], conflicts: List[str]):
+        conflicts = set(conflicts)
+        for game_id, game in games.items():
+            if game_id not in conflicts:
+                game.version += 1
+            elif self.games.get(game_id) is game:
+                await self.drop(game_id, persist=False)
+                await self._conflict(game)
+
+    async def flush(self):
+        # Segments sealed before the dirty set is taken only hold moves this flush stores.
+        sealed = await self.journal.rotate() if self.journal and self.recovered else []
+        async with self.writing():
+            dirty, self.dirty = self.dirty, set()
+            games = {game_id: self.games[game_id] for game_id in dirty if game_id in self.games}
+            if games:
+                states = {game_id: game.stored_state(self.encoding) for game_id, game in games.items()}
+                try:
+                    conflicts = await self.persist(states, {game_id: game.version for game_id, game in games.items()})
+                except Exception as e:
+                    print(f"Failed to persist {len(states)} games: {e}")
+                    self.dirty |= states.keys()
+                    return
+                await self._resolve(games, conflicts or [])
+        if sealed:
+            self.journal.discard(sealed)
+
+    async def recover(self, load_game) -> int:
+        """Replays journaled moves on top of the stored games; returns the number of moves recovered.
+
+        `load_game(game_id)` returns the games row; games that are no longer
+        in progress are skipped.
+        """
+        records: Dict[str, list] = {}
+        for record in self.journal.replay():
+            records.setdefault(record['g'], []).append(record)
+
+        recovered = 0
+        for game_id, moves in records.items():
+            # Adopted segments of several processes may hold moves of one game.
+            moves.sort(key=lambda record: record['s'])
+            game = self.games.get(game_id)
+            if not game:
+                row = await load_game(game_id)
+                if not row or row['status'] != 'in_progress':
+                    continue
+                game = self.start(game_id, row['player1_id'], row['player2_id'], row.get('game_state'), row.get('version', 0))
+            for record in moves:
+                if record['s'] <= game.seq:
+                    continue
+                if record['s'] != game.seq + 1:
+                    print(f"Journal for game {game_id} skips from move {game.seq} to {record['s']}")
+                    break
+                try:
+                    game.apply(record['m'], record['p'], record.get('t'))
+                except InvalidMoveException as e:
+                    print(f"Cannot replay move {record['s']} of game {game_id}: {e}")
+                    break
+                self.dirty.add(game_id)
+                recovered += 1
+            self._schedule(game)
+
+        # Every journaled move is now resident, so segments may go once the games are stored.
+        self.recovered = True
+        await self.flush()
+        return recovered
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
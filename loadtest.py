@@ -0,0 +1,415 @@
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from typing import Dict, List, Optional
+import chess
+import httpx
+from live_games import WRITE_CONFLICTS
+
+def percentile(samples: List[float], q: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def summarize(samples: List[float]) -> dict:
+    return {
+        'count': len(samples),
+        'p50_ms': round(percentile(samples, 0.5) * 1000, 3) if samples else None,
+        'p99_ms': round(percentile(samples, 0.99) * 1000, 3) if samples else None,
+        'max_ms': round(max(samples) * 1000, 3) if samples else None
+    }
+
+class InProcessWebSocket:
+    """Client end of a WebSocket served by an ASGI app in this process; `on_message` gets every frame."""
+
+    def __init__(self, app, path: str, on_message=None):
+        self.app = app
+        self.path = path
+        self.on_message = on_message
+        self.incoming: asyncio.Queue = asyncio.Queue()
+        self.accepted = asyncio.Event()
+        self.received = 0
+        self.task: Optional[asyncio.Task] = None
+
+    async def connect(self):
+        scope = {
+            'type': 'websocket',
+            'asgi': {'version': '3.0'},
+            'scheme': 'ws',
+            'path': self.path,
+            'raw_path': self.path.encode(),
+            'root_path': '',
+            'query_string': b'',
+            'headers': [],
+            'client': ('127.0.0.1', 0),
+            'server': ('loadtest', 80),
+            'subprotocols': []
+        }
+        self.incoming.put_nowait({'type': 'websocket.connect'})
+        self.task = asyncio.create_task(self.app(scope, self.incoming.get, self._send))
+        await self.accepted.wait()
+
+    async def _send(self, message: dict):
+        if message['type'] == 'websocket.accept':
+            self.accepted.set()
+        elif message['type'] == 'websocket.send':
+            self.received += 1
+            if self.on_message:
+                self.on_message(message.get('text') or message.get('bytes'))
+
+    def send_text(self, text: str):
+        self.incoming.put_nowait({'type': 'websocket.receive', 'text': text})
+
+    async def close(self):
+        self.incoming.put_nowait({'type': 'websocket.disconnect', 'code': 1000})
+        await self.task
+
+class LoadTest:
+    """Drives the FastAPI app in this process against the in-memory repository.
+
+    `players` players register, pair up (create/join), play random legal moves
+    for up to `plies` plies per game and complete the games the moves did not
+    end, while `spectators` spectators watch the games over WebSockets. Every
+    request is timed per route; spectators time each move from the start of
+    its /make_move request to the arrival of its move_made frame. With
+    `transport='ws'` players send their moves as 'move' commands over their
+    own WebSockets instead, timed until the command's reply.
+    """
+
+    def __init__(self, app_module, players: int = 100, spectators: int = 200, plies: int = 40, seed: int = 0,
+                 transport: str = 'http'):
+        self.main = app_module
+        self.players = players - players % 2
+        self.spectators = spectators
+        self.plies = plies
+        self.transport = transport
+        self.player_sockets: Dict[str, InProcessWebSocket] = {}
+        self.replies: Dict[int, asyncio.Future] = {}
+        self.rng = random.Random(seed)
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.move_started: Dict[tuple, float] = {}
+        self.broadcast_latencies: List[float] = []
+        self.http: Optional[httpx.AsyncClient] = None
+
+    async def request(self, route: str, method: str, url: str, **kwargs) -> dict:
+        start = time.perf_counter()
+        response = await self.http.request(method, url, **kwargs)
+        self.latencies[route].append(time.perf_counter() - start)
+        if response.status_code >= 400:
+            raise RuntimeError(f"{method} {url} failed with {response.status_code}: {response.text}")
+        return response.json()
+
+    async def register(self, name: str) -> str:
+        return (await self.request('POST /register', 'POST', '/register', json={'username': name, 'rating': self.rng.randint(1200, 1800)}))['user_id']
+
+    async def pair(self, white: str, black: str) -> str:
+        game = await self.request('POST /create_game', 'POST', '/create_game', json={'user_id': white, 'bet': 10})
+        await self.request('POST /join_game', 'POST', '/join_game', json={'user_id': black, 'game_id': game['game_id']})
+        return game['game_id']
+
+    async def command(self, player_id: str, command: dict) -> dict:
+        command_id = len(self.replies)
+        reply = self.replies[command_id] = asyncio.get_running_loop().create_future()
+        start = time.perf_counter()
+        self.player_sockets[player_id].send_text(json.dumps({**command, 'id': command_id}))
+        message = await reply
+        self.latencies[f"WS {command['type']}"].append(time.perf_counter() - start)
+        if not message['ok']:
+            raise RuntimeError(f"{command['type']} command failed with {message['status']}: {message['detail']}")
+        return message['result']
+
+    async def move(self, game_id: str, player_id: str, move: str) -> dict:
+        if self.transport == 'ws':
+            return await self.command(player_id, {'type': 'move', 'game_id': game_id, 'move': move})
+        return await self.request('POST /make_move', 'POST', '/make_move', json={'game_id': game_id, 'player_id': player_id, 'move': move})
+
+    def on_frame(self, frame):
+        if not isinstance(frame, str):
+            return
+        if frame.startswith('{"type":"reply"'):
+            message = json.loads(frame)
+            self.replies[message['id']].set_result(message)
+            return
+        if '"move_made"' not in frame:
+            return
+        message = json.loads(frame)
+        started = self.move_started.get((message['game_id'], message['seq']))
+        if started is not None:
+            self.broadcast_latencies.append(time.perf_counter() - started)
+
+    async def play(self, game_id: str, white: str, black: str, rng: random.Random) -> int:
+        board = chess.Board()
+        for ply in range(self.plies):
+            move = rng.choice(list(board.legal_moves))
+            self.move_started[(game_id, ply + 1)] = time.perf_counter()
+            result = await self.move(game_id, white if board.turn == chess.WHITE else black, move.uci())
+            board.push(move)
+            if 'game_over' in result:
+                return ply + 1
+        await self.request('POST /complete_game', 'POST', '/complete_game', json={'game_id': game_id, 'winner_id': None, 'is_draw': True})
+        return self.plies
+
+    async def run(self) -> dict:
+        transport = httpx.ASGITransport(app=self.main.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://loadtest') as self.http:
+            started = time.perf_counter()
+            players = await asyncio.gather(*(self.register(f'player{i}') for i in range(self.players)))
+            pairs = list(zip(players[0::2], players[1::2]))
+            game_ids = await asyncio.gather(*(self.pair(white, black) for white, black in pairs))
+            setup = time.perf_counter() - started
+
+            # Traced only while the sockets connect: the server's connection, session and endpoint coroutine
+            # per socket, plus the small in-process client object.
+            watchers = await asyncio.gather(*(self.register(f'spectator{i}') for i in range(self.spectators)))
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            sockets = [InProcessWebSocket(self.main.app, f'/ws/{user_id}', self.on_frame) for user_id in watchers]
+            for socket in sockets:
+                await socket.connect()
+            per_connection = (tracemalloc.get_traced_memory()[0] - before) / max(1, len(sockets))
+            tracemalloc.stop()
+            if game_ids:
+                await asyncio.gather(*(
+                    self.request('POST /spectate_game', 'POST', '/spectate_game', json={'user_id': user_id, 'game_id': game_ids[i % len(game_ids)]})
+                    for i, user_id in enumerate(watchers)
+                ))
+
+            if self.transport == 'ws':
+                for player_id in players:
+                    self.player_sockets[player_id] = InProcessWebSocket(self.main.app, f'/ws/{player_id}', self.on_frame)
+                    await self.player_sockets[player_id].connect()
+
+            start = time.perf_counter()
+            plies = await asyncio.gather(*(
+                self.play(game_id, white, black, random.Random(self.rng.random()))
+                for game_id, (white, black) in zip(game_ids, pairs)
+            ))
+            elapsed = time.perf_counter() - start
+            # Let the connection writers drain the last frames.
+            await asyncio.sleep(0.05)
+
+            frames = sum(socket.received for socket in sockets)
+            for socket in sockets + list(self.player_sockets.values()):
+                await socket.close()
+
+        return {
+            'transport': self.transport,
+            'players': self.players,
+            'games': len(game_ids),
+            'spectators': self.spectators,
+            'setup_seconds': round(setup, 3),
+            'play_seconds': round(elapsed, 3),
+            'moves': sum(plies),
+            'moves_per_second': round(sum(plies) / elapsed, 1) if elapsed else None,
+            'routes': {route: summarize(samples) for route, samples in sorted(self.latencies.items())},
+            'broadcast': summarize(self.broadcast_latencies),
+            'spectator_frames': frames,
+            'bytes_per_connection': round(per_connection)
+        }
+
+class ContentionTest:
+    """Many clients racing to play the same game, to check that its moves are serialized.
+
+    For every ply all `clients` send a legal move at once, a quarter of them
+    as the player not on move; exactly one may be accepted. Every `reload`
+    plies the resident game is dropped, so the next wave also races to load
+    it from the repository. A spectator checks that move_made frames arrive
+    once each and in order, and at the end the stored game must match.
+    """
+
+    def __init__(self, app_module, clients: int = 50, plies: int = 40, reload: int = 10, seed: int = 0):
+        self.main = app_module
+        self.clients = clients
+        self.plies = plies
+        self.reload = reload
+        self.rng = random.Random(seed)
+        self.seqs: List[int] = []
+
+    def on_frame(self, frame):
+        if isinstance(frame, str) and '"move_made"' in frame:
+            self.seqs.append(json.loads(frame)['seq'])
+
+    async def attempt(self, http, game_id: str, player_id: str, move: str):
+        start = time.perf_counter()
+        response = await http.post('/make_move', json={'game_id': game_id, 'player_id': player_id, 'move': move})
+        return response.status_code, move, time.perf_counter() - start
+
+    async def run(self) -> dict:
+        main = self.main
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://loadtest') as http:
+            white, black, watcher = [
+                (await http.post('/register', json={'username': name, 'rating': 1500})).json()['user_id']
+                for name in ('white', 'black', 'watcher')
+            ]
+            game_id = (await http.post('/create_game', json={'user_id': white, 'bet': 10})).json()['game_id']
+            await http.post('/join_game', json={'user_id': black, 'game_id': game_id})
+            spectator = InProcessWebSocket(main.app, f'/ws/{watcher}', self.on_frame)
+            await spectator.connect()
+            await http.post('/spectate_game', json={'user_id': watcher, 'game_id': game_id})
+
+            board = chess.Board()
+            statuses: Dict[int, int] = defaultdict(int)
+            latencies: List[float] = []
+            accepted_per_ply: List[int] = []
+            start = time.perf_counter()
+            for ply in range(self.plies):
+                if board.is_game_over(claim_draw=True):
+                    break
+                if self.reload and ply % self.reload == 0:
+                    await main.live_games.drop(game_id)
+                mover, other = (white, black) if board.turn == chess.WHITE else (black, white)
+                legal = list(board.legal_moves)
+                results = await asyncio.gather(*(
+                    self.attempt(http, game_id, other if i % 4 == 3 else mover, self.rng.choice(legal).uci())
+                    for i in range(self.clients)
+                ))
+                accepted = [move for status, move, _ in results if status == 200]
+                for status, _, elapsed in results:
+                    statuses[status] += 1
+                    latencies.append(elapsed)
+                accepted_per_ply.append(len(accepted))
+                if len(accepted) != 1:
+                    break
+                board.push_uci(accepted[0])
+            elapsed = time.perf_counter() - start
+
+            await asyncio.sleep(0.05)
+            live_game = main.live_games.get(game_id)
+            resident = live_game.history if live_game else None
+            await main.live_games.flush()
+            stored = (await main.repo.get_game(game_id))['game_state']['history']
+            await spectator.close()
+
+        expected = self._san(board)
+        return {
+            'clients': self.clients,
+            'plies': len(board.move_stack),
+            'requests': sum(statuses.values()),
+            'seconds': round(elapsed, 3),
+            'requests_per_second': round(sum(statuses.values()) / elapsed, 1) if elapsed else None,
+            'latency': summarize(latencies),
+            'statuses': dict(statuses),
+            'plies_with_one_accepted_move': sum(1 for count in accepted_per_ply if count == 1),
+            'resident_matches': resident is None or resident == expected,
+            'stored_matches': stored == expected,
+            'move_made_in_order': self.seqs == list(range(1, len(board.move_stack) + 1)),
+            'write_conflicts': WRITE_CONFLICTS.value()
+        }
+
+    @staticmethod
+    def _san(board: chess.Board) -> List[str]:
+        replay = chess.Board()
+        history = []
+        for move in board.move_stack:
+            history.append(replay.san(move))
+            replay.push(move)
+        return history
+
+def load_app(latency: float, profile: Optional[float], journal_dir: str):
+    # Configure main before importing it: in-memory repository, a throwaway journal, optional profiler.
+    os.environ.update({
+        'DATA_BACKEND': 'memory',
+        'MEMORY_BACKEND_LATENCY': str(latency),
+        'MOVE_JOURNAL_DIR': journal_dir,
+        'SEED_ON_STARTUP': 'off'
+    })
+    if profile:
+        os.environ['PROFILE_SAMPLE_INTERVAL'] = str(profile)
+    return importlib.import_module('main')
+
+async def wait_ready(main):
+    # Startup loads run in the background; measure the app once it reports ready.
+    while (await main.ready(main.Response()))['status'] != 'ready':
+        await asyncio.sleep(0.01)
+
+async def run_load_test(players: int, spectators: int, plies: int, latency: float = 0.0, seed: int = 0,
+                        profile: Optional[float] = None, top: int = 25, transport: str = 'http') -> dict:
+    with tempfile.TemporaryDirectory() as journal_dir:
+        main = load_app(latency, profile, journal_dir)
+        async with main.lifespan(main.app):
+            await wait_ready(main)
+            result = await LoadTest(main, players, spectators, plies, seed, transport).run()
+            if main.profiler:
+                # Commands run under the socket's request, so WebSocket moves are found by its route.
+                label = 'WS /ws/{user_id}' if transport == 'ws' else 'POST /make_move'
+                app_dir = os.path.dirname(os.path.abspath(main.__file__))
+                result['profile'] = {
+                    **main.profiler.stats(),
+                    # Where make_move spends its time: app functions (make_move, broadcast_to_game, ...) by inclusive
+                    # samples, and the functions the samples were taken in.
+                    'make_move_app': main.profiler.top(top, label, 'total', app_dir),
+                    'make_move_self': main.profiler.top(top, label, 'self')
+                }
+        return result
+
+async def run_contention_test(clients: int, plies: int, latency: float = 0.0, seed: int = 0) -> dict:
+    with tempfile.TemporaryDirectory() as journal_dir:
+        main = load_app(latency, None, journal_dir)
+        async with main.lifespan(main.app):
+            await wait_ready(main)
+            return await ContentionTest(main, clients, plies, seed=seed).run()
+
+async def run_disconnect_test(latency: float = 0.01) -> dict:
+    # Black sends the mating move over its WebSocket and hangs up while the move is being settled.
+    with tempfile.TemporaryDirectory() as journal_dir:
+        main = load_app(latency, None, journal_dir)
+        async with main.lifespan(main.app):
+            await wait_ready(main)
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url='http://loadtest') as http:
+                white, black = [
+                    (await http.post('/register', json={'username': name, 'rating': 1500})).json()['user_id']
+                    for name in ('white', 'black')
+                ]
+                game_id = (await http.post('/create_game', json={'user_id': white, 'bet': 10})).json()['game_id']
+                await http.post('/join_game', json={'user_id': black, 'game_id': game_id})
+                for player_id, move in ((white, 'f3'), (black, 'e5'), (white, 'g4')):
+                    response = await http.post('/make_move', json={'game_id': game_id, 'player_id': player_id, 'move': move})
+                    response.raise_for_status()
+
+                socket = InProcessWebSocket(main.app, f'/ws/{black}')
+                await socket.connect()
+                socket.send_text(json.dumps({'type': 'move', 'id': 0, 'game_id': game_id, 'move': 'Qh4#'}))
+                await asyncio.sleep(latency / 2)
+                await socket.close()
+                await asyncio.sleep(latency * 10)
+                game = await main.repo.get_game(game_id)
+                return {'status': game['status'], 'resident': main.live_games.get(game_id) is not None}
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='End-to-end load test of the app in this process, on the in-memory repository.')
+    parser.add_argument('--players', type=int, default=100)
+    parser.add_argument('--spectators', type=int, default=200)
+    parser.add_argument('--plies', type=int, default=40, help='moves per game before it is completed as a draw')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated database round trip in seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--transport', choices=('http', 'ws'), default='http', help='send moves as HTTP requests or WebSocket commands')
+    parser.add_argument('--profile', type=float, nargs='?', const=0.001,
+                        help='sample stacks every PROFILE seconds of CPU time (default 0.001) and report make_move hot spots')
+    parser.add_argument('--top', type=int, default=25, help='functions listed in the profile')
+    parser.add_argument('--hammer', type=int, metavar='CLIENTS',
+                        help='instead, have CLIENTS clients race to play every move of one game (--plies moves)')
+    parser.add_argument('--disconnect', action='store_true',
+                        help='instead, check that a game ended by a WebSocket move is settled when its sender disconnects')
+    args = parser.parse_args(argv)
+
+    if args.disconnect:
+        print(json.dumps(asyncio.run(run_disconnect_test()), indent=2))
+        return
+    if args.hammer:
+        print(json.dumps(asyncio.run(run_contention_test(args.hammer, args.plies, args.latency, args.seed)), indent=2))
+        return
+    result = asyncio.run(run_load_test(args.players, args.spectators, args.plies, args.latency, args.seed, args.profile, args.top, args.transport))
+    print(json.dumps(result, indent=2))
+
+if __name__ == '__main__':
+    main()
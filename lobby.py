@@ -0,0 +1,75 @@
+import bisect
+from typing import Dict, List, Optional, Tuple
+
+class LobbyIndex:
+    """Pending games ordered by creator rating.
+
+    A rating-window lookup is a bisect into the sorted keys followed by a scan
+    of the k matching entries, i.e. O(log n + k). Each process keeps its own;
+    games are added and removed through 'lobby_add' and 'lobby_remove' events
+    on the bus, so every process lists the same games.
+    """
+
+    def __init__(self):
+        self.keys: List[Tuple[int, str]] = []
+        self.entries: Dict[str, dict] = {}
+        self.ready = False
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def entry(game_id: str, creator: dict, bet: float) -> dict:
+        return {
+            'game_id': game_id,
+            'creator_id': creator['id'],
+            'creator_username': creator['username'],
+            'creator_rating': creator['rating'],
+            'bet': bet
+        }
+
+    def add(self, game_id: str, creator: dict, bet: float):
+        self.remove(game_id)
+        entry = self.entry(game_id, creator, bet)
+        self.entries[game_id] = entry
+        bisect.insort(self.keys, (entry['creator_rating'], game_id))
+
+    def remove(self, game_id: str) -> Optional[dict]:
+        entry = self.entries.pop(game_id, None)
+        if entry:
+            key = (entry['creator_rating'], game_id)
+            i = bisect.bisect_left(self.keys, key)
+            if i < len(self.keys) and self.keys[i] == key:
+                del self.keys[i]
+        return entry
+
+    def window(self, rating: int, width: int, exclude_player_id: Optional[str] = None, limit: int = 50, offset: int = 0) -> List[dict]:
+        i = bisect.bisect_left(self.keys, (rating - width, ''))
+        games = []
+        skipped = 0
+        while i < len(self.keys) and len(games) < limit:
+            creator_rating, game_id = self.keys[i]
+            if creator_rating > rating + width:
+                break
+            i += 1
+            entry = self.entries[game_id]
+            if entry['creator_id'] == exclude_player_id:
+                continue
+            if skipped < offset:
+                skipped += 1
+                continue
+            games.append(entry)
+        return games
+
+    def load(self, games: List[dict]):
+        # Rows as returned by the repository's list_lobby().
+        self.entries = {g['game_id']: self.entry(g['game_id'], g['creator'], g['bet']) for g in games}
+        self.keys = sorted((e['creator_rating'], game_id) for game_id, e in self.entries.items())
+        self.ready = True
+
+    def handle_event(self, event: dict):
+        # Published by whichever process created, started or expired the game.
+        if event['kind'] == 'lobby_add':
+            self.add(event['game_id'], event['creator'], event['bet'])
+        elif event['kind'] == 'lobby_remove':
+            self.remove(event['game_id'])
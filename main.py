@@ -1,14 +1,34 @@
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
-from mock_data_generator import generate_mock_data
-from apply_move import apply_move, InvalidMoveException
+from apply_move import InvalidMoveException
+from live_games import LiveGameRegistry, MOVES_REJECTED, new_clock, parse_time_control
+from journal import MoveJournal
+from timer_wheel import TimerWheel
+from position_cache import PositionCache
+from lobby import LobbyIndex
+from matchmaking import MatchmakingQueue
+from connection_manager import ConnectionManager, Session
+from commands import CommandPipeline
+from pubsub import create_bus
+from encoding import move_frame, snapshot_frame
+from export import FORMATS, PAGE_SIZE, export_games, pgn_headers, stored_history, utc
+from analysis import CpuExecutor
+from leaderboard import Leaderboard
+from repository import create_repository, RepositoryError
+from cache import CachedRepository
+from metrics import CONTENT_TYPE, REGISTRY, Counter, Gauge, Histogram, InstrumentedRepository, MetricsMiddleware
+from profiler import ProfilingMiddleware, SamplingProfiler
 from pydantic import BaseModel
-from supabase import create_client, Client
 import uuid
+from datetime import datetime
 from typing import Dict, List, Optional
+import asyncio
 import chess
+import json
 import os
+import time
 import dotenv
 
 dotenv.load_dotenv()
@@ -17,23 +37,44 @@ dotenv.load_dotenv()
 async def lifespan(app: FastAPI):
     # Code to run on startup
     print("Application is starting up...")
-    max_players = 100
-    max_matches = 200
-
-    num_players = 50
-    num_matches = 100
-
-    if num_players > max_players:
-        num_players = max_players
-
-    if num_matches > max_matches:
-        num_matches = max_matches
-
-    generate_mock_data(num_players=num_players, num_matches=num_matches)
+    if SEED_ON_STARTUP == 'blocking':
+        await seed_mock_data()
+
+    # Startup work runs in the background and is retried until it succeeds; /ready reports it meanwhile.
+    startup_tasks['pubsub'] = asyncio.create_task(bus.start())
+    startup_tasks['lobby'] = asyncio.create_task(until_done(load_lobby))
+    startup_tasks['leaderboard'] = asyncio.create_task(until_done(load_leaderboard))
+    if move_journal:
+        startup_tasks['journal'] = asyncio.create_task(until_done(recover_journal))
+    if profiler:
+        profiler.start()
+
+    # Background seeding adds its rows to the loaded indexes when it finishes.
+    seed_task = asyncio.create_task(seed_mock_data()) if SEED_ON_STARTUP == 'background' else None
+    scan_task = asyncio.create_task(until_done(schedule_stored_clocks))
+    timer_task = asyncio.create_task(timers.run(handle_timers))
+    flush_task = asyncio.create_task(live_games.run())
+    matchmaking_task = asyncio.create_task(matchmaking.run())
 
     yield
     # Code to run on shutdown
     print("Application is shutting down...")
+    if profiler:
+        profiler.stop()
+    scan_task.cancel()
+    timer_task.cancel()
+    flush_task.cancel()
+    matchmaking_task.cancel()
+    if seed_task:
+        seed_task.cancel()
+    for task in startup_tasks.values():
+        task.cancel()
+    cpu.close()
+    await live_games.flush()
+    if move_journal:
+        await move_journal.close()
+    await bus.close()
+    await repo.close()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -49,10 +90,37 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-SUPABASE_URL = os.getenv('SUPABASE_URL')
-SUPABASE_KEY = os.getenv('SUPABASE_KEY')
+HTTP_LATENCY = Histogram('http_request_duration_seconds', 'HTTP request latency', ('method', 'route', 'status'))
+DB_LATENCY = Histogram('db_call_duration_seconds', 'Database call latency', ('table', 'operation', 'outcome'))
+JOURNAL_FAILURES = Counter('journal_failures_total', 'Moves applied and broadcast without being journaled')
+app.add_middleware(MetricsMiddleware, histogram=HTTP_LATENCY)
+
+# Opt-in sampling profiler: PROFILE_SAMPLE_INTERVAL is the CPU time between samples (e.g. 0.001); read at /debug/profile.
+PROFILE_SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', '0'))
+profiler = SamplingProfiler(PROFILE_SAMPLE_INTERVAL) if PROFILE_SAMPLE_INTERVAL else None
+if profiler:
+    app.add_middleware(ProfilingMiddleware)
+
+bus = create_bus()
+repo = CachedRepository(
+    InstrumentedRepository(create_repository(), DB_LATENCY),
+    bus=bus,
+    max_size=int(os.getenv('CACHE_MAX_SIZE', '10000')),
+    ttl=float(os.getenv('CACHE_TTL', '30')),
+)
+
+# Mock data is opt-in: 'off', 'background' (serve while seeding) or 'blocking' (seed before serving).
+# For large datasets use the CLI: python mock_data_generator.py --scenario FILE
+SEED_ON_STARTUP = os.getenv('SEED_ON_STARTUP', 'off')
+SEED_PLAYERS = int(os.getenv('SEED_PLAYERS', '50'))
+SEED_MATCHES = int(os.getenv('SEED_MATCHES', '100'))
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Commands a WebSocket may have queued or running before further ones are refused.
+WS_MAX_PENDING_COMMANDS = int(os.getenv('WS_MAX_PENDING_COMMANDS', '64'))
+
+LOBBY_RATING_WINDOW = int(os.getenv('LOBBY_RATING_WINDOW', '100'))
+LEADERBOARD_MAX_LIMIT = 500
+LEADERBOARD_MAX_AGE = int(os.getenv('LEADERBOARD_MAX_AGE', '5'))
 
 class User(BaseModel):
     username: str
@@ -64,6 +132,7 @@ class GameRequest(BaseModel):
 class CreateGameRequest(BaseModel):
     user_id: str
     bet: float
+    time_control: Optional[str] = None
 
 class GameInfo(BaseModel):
     game_id: str
@@ -80,6 +149,14 @@ class CompleteGameRequest(BaseModel):
     game_id: str
     winner_id: Optional[str]
     is_draw: bool = False
+    termination: Optional[str] = None
+
+class MatchmakingRequest(BaseModel):
+    user_id: str
+    bet: float
+
+class AnalyzeGamesRequest(BaseModel):
+    game_ids: List[str]
 
 class SpectateGameRequest(BaseModel):
     user_id: str
@@ -90,71 +167,355 @@ class MoveRequest(BaseModel):
     player_id: str
     move: str
 
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
-        self.game_spectators: Dict[str, List[str]] = {}
-
-    async def connect(self, user_id: str, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections[user_id] = websocket
-
-    def disconnect(self, user_id: str):
-        self.active_connections.pop(user_id, None)
-        for spectators in self.game_spectators.values():
-            if user_id in spectators:
-                spectators.remove(user_id)
-
-    async def send_personal_message(self, user_id: str, message):
-        websocket = self.active_connections.get(user_id)
-        if websocket:
-            if isinstance(message, dict):
-                await websocket.send_json(message)
-            else:
-                await websocket.send_text(message)
-
-    async def broadcast_to_game(self, game_id:str, message: str):
-        spectators = self.game_spectators.get(game_id, [])
-        for user_id in spectators:
-            await self.send_personal_message(user_id, message)
-        game_response = supabase.table('games').select('*').eq('game_id', game_id).execute()
-        if game_response.data:
-            game = game_response.data[0]
-            player1_id = game.get('player1_id')
-            player2_id = game.get('player2_id')
-            if player1_id:
-                await self.send_personal_message(player1_id, message)
-            if player2_id:
-                await self.send_personal_message(player2_id, message)
-
-manager = ConnectionManager()
+async def load_players(game_id: str):
+    game = await repo.get_game(game_id)
+    if game:
+        return game.get('player1_id'), game.get('player2_id')
+
+manager = ConnectionManager(
+    load_players=load_players,
+    max_queue=int(os.getenv('WS_SEND_QUEUE_SIZE', '256')),
+    slow_consumer=os.getenv('WS_SLOW_CONSUMER', 'disconnect'),
+    bus=bus,
+)
+
+async def persist_game_states(states: dict, versions: Optional[dict] = None) -> List[str]:
+    return await repo.save_game_states(states, versions)
+
+lobby = LobbyIndex()
+bus.subscribe(lobby.handle_event)
+
+def publish_lobby_add(game_id: str, creator: dict, bet: float):
+    bus.publish({'kind': 'lobby_add', 'game_id': game_id, 'creator': {k: creator[k] for k in ('id', 'username', 'rating')}, 'bet': bet})
+
+def publish_lobby_remove(game_id: str):
+    bus.publish({'kind': 'lobby_remove', 'game_id': game_id})
+
+STARTUP_RETRY = 5.0
+startup_tasks: Dict[str, asyncio.Task] = {}
+
+async def until_done(load):
+    # `load()` returns whether it succeeded; a failed load is tried again after STARTUP_RETRY seconds.
+    while not await load():
+        await asyncio.sleep(STARTUP_RETRY)
+
+async def load_lobby(page_size: int = 1000) -> bool:
+    rows = []
+    try:
+        while True:
+            page = await repo.list_lobby(limit=page_size, offset=len(rows))
+            rows.extend(page)
+            if len(page) < page_size:
+                break
+    except RepositoryError as e:
+        # list_games falls back to querying the database until the index is loaded.
+        print(f"Failed to load lobby index: {e}")
+        return False
+    lobby.load(rows)
+    if LOBBY_TTL:
+        for row in rows:
+            timers.schedule(('lobby', row['game_id']), parse_timestamp(row.get('created_at')) + LOBBY_TTL)
+    return True
+
+leaderboard_index = Leaderboard()
+
+async def load_leaderboard(page_size: int = 1000) -> bool:
+    users = []
+    try:
+        while True:
+            page = await repo.top_users(page_size, offset=len(users))
+            users.extend(page)
+            if len(page) < page_size:
+                break
+    except RepositoryError as e:
+        # /leaderboard queries the database until the index is loaded.
+        print(f"Failed to load leaderboard: {e}")
+        return False
+    leaderboard_index.load(users)
+    return True
+
+bus.subscribe(leaderboard_index.handle_event)
+
+async def seed_mock_data():
+    # Imported here so the generator only loads when seeding is enabled.
+    from mock_data_generator import generate_mock_data
+
+    try:
+        users, games = await generate_mock_data(repo, num_players=SEED_PLAYERS, num_matches=SEED_MATCHES)
+    except RepositoryError as e:
+        print(f"Failed to seed mock data: {e}")
+        return
+
+    # Indexes loaded before seeding finished do not have these rows yet.
+    if leaderboard_index.ready:
+        for user in users:
+            bus.publish({'kind': 'leaderboard_user', 'user': {k: user[k] for k in Leaderboard.COUNTERS + ('id', 'username')}})
+    if lobby.ready:
+        creators = {u['id']: u for u in users}
+        for game in games:
+            if game['status'] == 'pending':
+                publish_lobby_add(game['game_id'], creators[game['player1_id']], game['bet'])
+                if LOBBY_TTL:
+                    timers.schedule(('lobby', game['game_id']), time.time() + LOBBY_TTL)
+
+# Moves are acknowledged once journaled locally; set MOVE_JOURNAL_DIR empty to rely on the flush alone.
+MOVE_JOURNAL_DIR = os.getenv('MOVE_JOURNAL_DIR', 'journal')
+move_journal = MoveJournal(
+    MOVE_JOURNAL_DIR,
+    mode=os.getenv('MOVE_JOURNAL_MODE', 'sync'),
+    interval=float(os.getenv('MOVE_JOURNAL_INTERVAL', '0.005')),
+) if MOVE_JOURNAL_DIR else None
+
+# Clocks: GAME_TIME_CONTROL ('<seconds>+<increment>') applies to games created without one; empty means untimed.
+GAME_TIME_CONTROL = os.getenv('GAME_TIME_CONTROL', '600+5')
+DEFAULT_TIME_CONTROL = parse_time_control(GAME_TIME_CONTROL) if GAME_TIME_CONTROL else None
+# A player disconnected for DISCONNECT_GRACE seconds forfeits; pending games expire after LOBBY_TTL. 0 disables either.
+DISCONNECT_GRACE = float(os.getenv('DISCONNECT_GRACE', '60'))
+LOBBY_TTL = float(os.getenv('LOBBY_TTL', '3600'))
+SETTLE_RETRY = 5.0
+
+# One wheel holds every deadline: ('flag', game_id), ('grace', user_id) and ('lobby', game_id).
+timers = TimerWheel(tick=float(os.getenv('TIMER_TICK', '0.1')))
+
+# Positions reached by resident games, with the moves played from them; POSITION_CACHE_SIZE=0 disables it.
+POSITION_CACHE_SIZE = int(os.getenv('POSITION_CACHE_SIZE', '20000'))
+position_cache = PositionCache(POSITION_CACHE_SIZE) if POSITION_CACHE_SIZE else None
+
+async def report_conflict(live_game):
+    # The game's row moved on elsewhere: moves acknowledged here since the last write are gone, so clients resync.
+    await manager.broadcast_to_game(live_game.game_id, {
+        'type': 'game_conflict',
+        'game_id': live_game.game_id,
+        'detail': 'Game was changed concurrently; resync to get its stored state'
+    })
+
+async def recover_journal() -> bool:
+    move_journal.start()
+    try:
+        recovered = await live_games.recover(repo.get_game)
+    except RepositoryError as e:
+        print(f"Failed to recover journaled moves: {e}")
+        return False
+    if recovered:
+        print(f"Recovered {recovered} journaled moves")
+    return True
+
+live_games = LiveGameRegistry(
+    persist=persist_game_states,
+    flush_interval=float(os.getenv('GAME_FLUSH_INTERVAL', '0.5')),
+    encoding=os.getenv('GAME_STATE_ENCODING', 'fen'),
+    journal=move_journal,
+    timers=timers,
+    time_control=DEFAULT_TIME_CONTROL,
+    positions=position_cache,
+    on_conflict=report_conflict,
+)
+
+def handle_presence(event: dict):
+    if event['kind'] == 'disconnect' and DISCONNECT_GRACE and live_games.games_of(event['user_id']):
+        timers.schedule(('grace', event['user_id']), time.time() + DISCONNECT_GRACE)
+    elif event['kind'] == 'connect':
+        timers.cancel(('grace', event['user_id']))
+
+bus.subscribe(handle_presence)
+
+def parse_timestamp(value: Optional[str]) -> float:
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return time.time()
+
+def stored_deadline(game: dict) -> Optional[float]:
+    # From the stored clock, which lags resident games; the flag handler loads the game and checks again.
+    game_state = game.get('game_state') or {}
+    clock = game_state.get('clock')
+    if not clock:
+        return time.time() + DEFAULT_TIME_CONTROL[0] if DEFAULT_TIME_CONTROL else None
+    side = 'white' if game_state.get('turn') == game['player1_id'] else 'black'
+    return clock['last_move_at'] + clock[side]
+
+async def schedule_stored_clocks(page_size: int = 1000) -> bool:
+    # Timers are not stored: after a restart, schedule the flag of every in-progress game that is not resident.
+    offset = 0
+    while True:
+        try:
+            page = await repo.list_games('in_progress', limit=page_size, offset=offset)
+        except RepositoryError as e:
+            print(f"Failed to load in-progress games for clocks: {e}")
+            return False
+        for game in page:
+            deadline = stored_deadline(game)
+            if deadline is not None and not live_games.get(game['game_id']):
+                timers.schedule(('flag', game['game_id']), deadline)
+        offset += len(page)
+        if len(page) < page_size:
+            return True
+
+async def handle_timers(keys: list):
+    flags = [key for kind, key in keys if kind == 'flag']
+    absent = [key for kind, key in keys if kind == 'grace' and key not in manager.active_connections]
+    # Games are checked and settled under their locks, so no move lands between the check and the settlement.
+    locked = set(flags) | {game_id for user_id in absent for game_id in live_games.games_of(user_id)}
+    async with live_games.lock_all(locked):
+        now = time.time()
+        requests = {}
+        for game_id in flags:
+            live_game = live_games.get(game_id)
+            if not live_game:
+                try:
+                    live_game = await load_live_game(game_id)
+                except HTTPException:
+                    continue
+            # A game that already ended but failed to settle is retried here too.
+            if live_game.termination or live_game.flag(now):
+                requests[game_id] = forfeit_request(live_game)
+        for user_id in absent:
+            for game_id in live_games.games_of(user_id) & locked:
+                live_game = live_games.get(game_id)
+                if not live_game.termination:
+                    live_game.forfeit(user_id, 'abandoned')
+                requests[game_id] = forfeit_request(live_game)
+
+        requests = list(requests.values())
+        for i in range(0, len(requests), 1000):
+            await settle_forfeits(requests[i:i + 1000])
+    await asyncio.gather(*(expire_lobby(key) for kind, key in keys if kind == 'lobby'))
+
+def forfeit_request(live_game) -> CompleteGameRequest:
+    winner_id = live_game.winner_id
+    return CompleteGameRequest(
+        game_id=live_game.game_id, winner_id=winner_id, is_draw=winner_id is None, termination=live_game.termination
+    )
+
+async def settle_forfeits(requests: List[CompleteGameRequest]):
+    try:
+        outcomes = await finish_games(requests)
+    except HTTPException as e:
+        print(f"Failed to settle {len(requests)} expired games: {e.detail}")
+        for r in requests:
+            timers.schedule(('flag', r.game_id), time.time() + SETTLE_RETRY)
+        return
+    for outcome in outcomes:
+        if outcome['status'] in ('not_found', 'not_in_progress'):
+            # Settled elsewhere in the meantime.
+            await live_games.drop(outcome['game_id'], persist=False)
+
+async def expire_lobby(game_id: str):
+    try:
+        # Under the lock join_game holds, and only while the row is pending, so a game started
+        # meanwhile, here or in another process, is never overwritten.
+        async with live_games.lock(game_id):
+            game = await repo.get_game(game_id)
+            expired = game and await repo.update_game(game_id, {'status': 'expired'}, status='pending')
+            # Started or cancelled elsewhere; it must not stay listed either way.
+            publish_lobby_remove(game_id)
+        if not expired:
+            return
+        creator = await load_user(game['player1_id'])
+        if creator and creator['status'] == 'waiting':
+            await repo.update_user(creator['id'], {'status': 'online'})
+            manager.update_sessions([creator['id']], status='online')
+    except RepositoryError as e:
+        print(f"Failed to expire game {game_id}: {e}")
+        return
+    await manager.send_personal_message(game['player1_id'], {'type': 'game_expired', 'game_id': game_id})
 
 # Connecting WebSocket:
 @app.websocket("/ws/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, user_id: str):
-    await manager.connect(user_id, websocket)
+async def websocket_endpoint(websocket: WebSocket, user_id: str, encoding: str = 'json'):
+    try:
+        user = await repo.get_user(user_id)
+    except RepositoryError:
+        user = None
+    await manager.connect(user_id, websocket, binary=encoding == 'binary', session=Session.from_user(user) if user else None)
+    pipeline = CommandPipeline(
+        lambda command: run_command(user_id, command),
+        lambda frame: manager.send_personal_message(user_id, frame),
+        max_pending=WS_MAX_PENDING_COMMANDS
+    )
     try:
         while True:
             data = await websocket.receive_text()
+            await handle_client_message(user_id, data, pipeline)
     except WebSocketDisconnect:
-        manager.disconnect(user_id)
+        pass
+    finally:
+        # However the loop ended, the connection goes; commands already running finish without a reply.
+        pipeline.close()
+        manager.disconnect(user_id, websocket)
+
+async def handle_client_message(user_id: str, data: str, pipeline: Optional[CommandPipeline] = None):
+    try:
+        message = json.loads(data)
+    except ValueError:
+        return
+    if not isinstance(message, dict):
+        return
+    game_id = message.get('game_id')
+    if message.get('type') in COMMANDS or message.get('type') == 'resync':
+        if not isinstance(game_id, str):
+            # Used as a dict key below; a list or object would raise.
+            await manager.send_personal_message(user_id, {
+                'type': 'reply', 'id': message.get('id'), 'ok': False, 'status': 400, 'detail': 'Invalid game id'
+            } if message['type'] in COMMANDS else {'type': 'error', 'detail': 'Invalid game id'})
+            return
+
+    if message.get('type') in COMMANDS and pipeline is not None:
+        # Commands on the same game run in the order sent; the reply carries the command's id.
+        if not pipeline.submit(game_id, message):
+            await manager.send_personal_message(user_id, {
+                'type': 'reply', 'id': message.get('id'), 'ok': False, 'status': 429, 'detail': 'Too many commands in flight'
+            })
+
+    elif message.get('type') == 'hello':
+        # Clients opt in to binary move/snapshot frames (see encoding.py).
+        manager.set_binary(user_id, message.get('encoding') == 'binary')
+
+    elif message.get('type') == 'resync':
+        # Client saw a gap after `from_seq`: send the missing moves, or a snapshot if they are not at hand.
+        try:
+            live_game = await load_live_game(game_id)
+        except HTTPException as e:
+            await manager.send_personal_message(user_id, {'type': 'error', 'game_id': game_id, 'detail': e.detail})
+            return
+
+        from_seq = message.get('from_seq')
+        if isinstance(from_seq, int) and 0 <= from_seq <= live_game.seq:
+            await manager.send_personal_message(user_id, {
+                'type': 'moves',
+                'game_id': game_id,
+                'from_seq': from_seq,
+                'seq': live_game.seq,
+                'moves': live_game.history[from_seq:]
+            })
+        else:
+            await send_snapshot(user_id, live_game)
 
 # User registration:
 @app.post('/register')
 async def register_user(user: User):
     user_id = str(uuid.uuid4())
-    response = supabase.table('users').insert({
-        'id': user_id,
-        'username': user.username,
-        'rating': user.rating,
-        'status': 'online'
-    }).execute()
-
-    if response.error:
-        raise HTTPException(status_code=400, detail=response.error.message)
+    try:
+        await repo.insert_user({
+            'id': user_id,
+            'username': user.username,
+            'rating': user.rating,
+            'status': 'online'
+        })
+    except RepositoryError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    bus.publish({'kind': 'leaderboard_user', 'user': {'id': user_id, 'username': user.username, 'rating': user.rating}})
     
     return {'user_id': user_id}
 
+async def load_user(user_id: str) -> Optional[dict]:
+    # Connected users are answered from their session, everyone else from the repository.
+    session = manager.session(user_id)
+    if session and session.status is not None:
+        return session.as_user()
+    return await repo.get_user(user_id)
+
 # User creates a game:
 @app.post('/create_game')
 async def create_game(request: CreateGameRequest):
@@ -162,268 +523,457 @@ async def create_game(request: CreateGameRequest):
     bet = request.bet
 
     # Check if user exists:
-    user_response = supabase.table('users').select('*').eq('id', user_id).execute()
-    if not user_response.data:
+    user = await load_user(user_id)
+    if not user:
         raise HTTPException(status_code=404, detail='User not found')
-    
-    user = user_response.data[0]
+
+    if request.time_control:
+        try:
+            parse_time_control(request.time_control)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
 
     # Create a game:
     game_id = str(uuid.uuid4())
-    game_response = supabase.table('games').insert({
-        'game_id': game_id,
-        'player1_id': user_id,
-        'status': 'pending',
-        'bet': bet,
-    }).execute()
-
-    if game_response.error:
-        raise HTTPException(status_code=400, detail=game_response.error.message)
+    try:
+        await repo.insert_game({
+            'game_id': game_id,
+            'player1_id': user_id,
+            'status': 'pending',
+            'bet': bet,
+            # Until the game starts, game_state only carries the requested time control.
+            'game_state': {'time_control': request.time_control} if request.time_control else None,
+        })
+    except RepositoryError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
-    supabase.table('users').update({'status': 'waiting'}).eq('id', user_id).execute()
+    await repo.update_user(user_id, {'status': 'waiting'})
+    manager.update_sessions([user_id], status='waiting')
+    # Waiting on this game now; a matchmaking ticket left behind would pair them into a second one.
+    matchmaking.cancel(user_id)
+
+    publish_lobby_add(game_id, user, bet)
+    if LOBBY_TTL:
+        timers.schedule(('lobby', game_id), time.time() + LOBBY_TTL)
 
-    for uid in manager.active_connections.keys():
-        if uid != user_id:
-            await manager.send_personal_message(uid, f"New game available with bet {bet}")
+    await manager.send_to_all(f"New game available with bet {bet}", exclude=user_id)
     
     return {'message': 'Game created successfully', 'game_id': game_id, 'creator': user['username'], 'bet': bet}
 
 # Get a list of legible games:
 @app.get('/list_games')
-async def list_games(request:GameRequest):
+async def list_games(request:GameRequest, window: Optional[int] = None, limit: int = 50, offset: int = 0):
     user_id = request.user_id
+    window = LOBBY_RATING_WINDOW if window is None else window
+    limit = max(1, min(limit, 500))
+    offset = max(0, offset)
 
     # Check if user exists:
-    user_response = supabase.table('users').select('*').eq('id', user_id).execute()
-    if not user_response.data:
+    user = await load_user(user_id)
+    if not user:
         raise HTTPException(status_code=404, detail='User not found')
     
-    user = user_response.data[0]
     user_rating = user['rating']
 
-    games_response = supabase.table('games').select('*').eq('status', 'pending').neq('player1_id', user_id).execute()
-    games = games_response.data
-
-    game_list = []
-    for game in games:
-        creator_response = supabase.table('users').select('*').eq('id', game['player1_id']).execute()
-        if not creator_response.data:
-            continue
+    if lobby.ready:
+        games = lobby.window(user_rating, window, exclude_player_id=user_id, limit=limit, offset=offset)
+    else:
+        rows = await repo.list_lobby(user_rating - window, user_rating + window, exclude_player_id=user_id, limit=limit, offset=offset)
+        games = [LobbyIndex.entry(row['game_id'], row['creator'], row['bet']) for row in rows]
 
-        creator = creator_response.data[0]
-        creator_rating = creator['rating']
+    game_list = [GameInfo(**game) for game in games]
 
-        if abs(creator_rating - user_rating) <= 100:
-            game_info = GameInfo(
-                game_id=game['game_id'],
-                creator_id=creator['id'],
-                creator_username=creator['username'],
-                creator_rating=creator_rating,
-                bet=game['bet']
-            )
-            game_list.append(game_info)
+    if not game_list:
+        return {'message': 'No games available now'}
 
-        if not game_list:
-            return {'message': 'No games available now'}
-        
-        return game_list
-    
-# Joining game:
-@app.post('/join_game')
-async def join_game(request: JoinGameRequest):
-    user_id = request.user_id
-    game_id = request.game_id
-
-    user_response = supabase.table('games').select('*').eq('id', user_id).execute()
-    if not user_response.data:
-        raise HTTPException(status_code=404, detail='User not found')
-    
-    user = user_response.data[0]
-    
-    game_response = supabase.table('games').select('*').eq('game_id', game_id).execute()
-    if not game_response.data:
-        raise HTTPException(status_code=404, detail='Game not found')
+    return game_list
     
-    game = game_response.data[0]
+async def start_game(game: dict, user: dict):
+    game_id = game['game_id']
+    user_id = user['id']
 
-    if game['status'] != 'pending':
-        raise HTTPException(status_code=400, detail='Game is not available')
-    
-    update_response = supabase.table('games').update({
-        'player2_id': user_id,
-        'status': 'in_progress'
-    }).eq('game_id', game_id).execute()
-
-    if update_response.error:
-        raise HTTPException(status_code=400, detail=update_response.error.message)
-    
-    users_update_response = supabase.table('users').update({'status': 'in_game'}).in_('id', [user_id, game['player1_id']]).execute()
-    if users_update_response.error:
-        raise HTTPException(status_code=500, detail='Failed to update users status')
-    
     board = chess.Board()
     initial_game_state = {
         'board': board.fen(),
         'turn': game['player1_id'],
         'history': []
     }
+    requested = (game.get('game_state') or {}).get('time_control')
+    try:
+        time_control = parse_time_control(requested) if requested else DEFAULT_TIME_CONTROL
+    except ValueError as e:
+        # Stored before create_game bounded time controls; refused before the row is touched.
+        raise HTTPException(status_code=400, detail=str(e))
+    if time_control:
+        initial_game_state['clock'] = new_clock(time_control)
 
-    supabase.table('games').update({
-        'game_state': initial_game_state
-    }).eq('game_id', game_id).execute()
+    try:
+        started = await repo.update_game(game_id, {
+            'player2_id': user_id,
+            'status': 'in_progress',
+            'game_state': initial_game_state
+        }, status='pending')
+    except RepositoryError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not started:
+        # Joined, cancelled or expired since it was read.
+        raise HTTPException(status_code=400, detail='Game is not available')
+
+    publish_lobby_remove(game_id)
+    timers.cancel(('lobby', game_id))
+    for player_id in (user_id, game['player1_id']):
+        matchmaking.cancel(player_id)
+    
+    try:
+        await repo.update_users([user_id, game['player1_id']], {'status': 'in_game'})
+    except RepositoryError:
+        raise HTTPException(status_code=500, detail='Failed to update users status')
+    manager.update_sessions([user_id, game['player1_id']], status='in_game', game_id=game_id)
+
+    live_games.start(game_id, game['player1_id'], user_id, initial_game_state, game.get('version', 0))
+    manager.set_players(game_id, game['player1_id'], user_id)
 
     await manager.broadcast_to_game(game_id, {
         'type': 'game_started',
         'game_id': game_id,
+        'seq': 0,
         'game_state': initial_game_state
     })
 
     creator_id = game['player1_id']
     await manager.send_personal_message(creator_id, f"{user['username']} has joined your game.")
 
-    return {'message': 'Game joined successfully', 'game_id': game_id}
-
-# Finish game:
-@app.post('/complete_game')
-async def complete_game(request: CompleteGameRequest):
+# Joining game:
+@app.post('/join_game')
+async def join_game(request: JoinGameRequest):
+    user_id = request.user_id
     game_id = request.game_id
-    winner_id = request.winner_id
-    is_draw = request.is_draw
-
-    game_response = supabase.table('games').select('*').eq('game_id', game_id).execute()
-    if not game_response.data:
-        raise HTTPException(status_code=404, detail='Game not found')
-    
-    game = game_response.data[0]
-
-    if game['status'] != 'in_progress':
-        raise HTTPException(status_code=400, detail='Game is not in progress')
-    
-    player1_id = game['player1_id']
-    player2_id = game['player2_id']
 
-    if winner_id not in [player1_id, player2_id]:
-        raise HTTPException(status_code=400, detail='Invalid winner id')
-    
-    players_response = supabase.table('users').select('*').in_('id', [player1_id, player2_id]).execute()
-    if len(players_response.data) != 2:
-        raise HTTPException(status_code=404, detail='Players not found')
+    user = await load_user(user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail='User not found')
     
-    player1 = next((p for p in players_response.data if p['id'] == player1_id), None)
-    player2 = next((p for p in players_response.data if p['id'] == player2_id), None)
-
-    rating1 = player1['rating']
-    rating2 = player2['rating']
-
-    expected_score1 = 1 / (1 + 10 ** ((rating2 - rating1) / 400))
-    expected_score2 = 1 / (1 + 10 ** ((rating1 - rating2) / 400))
+    # Serialized with expire_lobby and other joins of the game.
+    async with live_games.lock(game_id):
+        game = await repo.get_game(game_id)
+        if not game:
+            raise HTTPException(status_code=404, detail='Game not found')
 
-    k = 32
+        if game['status'] != 'pending':
+            raise HTTPException(status_code=400, detail='Game is not available')
 
-    if is_draw:
-        score1 = 0.5
-        score2 = 0.5
-
-        supabase.table('users').update({'draws': player1['draws'] + 1}).eq('id', player1_id).execute()
-        supabase.table('users').update({'draws': player2['draws'] + 1}).eq('id', player2_id).execute()
-    else:
-        if winner_id == player1_id:
-            score1 = 1
-            score2 = 0
-
-            supabase.table('users').update({'wins': player1['wins'] + 1}).eq('id', player1_id).execute()
-            supabase.table('users').update({'losses': player2['losses'] + 1}).eq('id', player2_id).execute()
-        elif winner_id == player2_id:
-            score1 = 0
-            score2 = 1
-
-            supabase.table('users').update({'losses': player1['losses'] + 1}).eq('id', player1_id).execute()
-            supabase.table('users').update({'wins': player2['wins'] + 1}).eq('id', player2_id).execute()
-        else:
-            raise HTTPException(status_code=400, detail='Winner ID is invalid')
+        await start_game(game, user)
 
-    new_rating1 = rating1 + k * (score1 - expected_score1)
-    new_rating2 = rating2 + k * (score2 - expected_score2)
+    return {'message': 'Game joined successfully', 'game_id': game_id}
 
-    supabase.table('users').update({'rating': int(new_rating1), 'status': 'online'}).eq('id', player1_id).execute()
-    supabase.table('users').update({'rating': int(new_rating2), 'status': 'online'}).eq('id', player2_id).execute()
+SETTLE_ERRORS = {
+    'not_found': (404, 'Game not found'),
+    'not_in_progress': (400, 'Game is not in progress'),
+    'invalid_winner': (400, 'Invalid winner id'),
+    'players_not_found': (404, 'Players not found'),
+    'conflict': (409, 'Game was changed concurrently'),
+}
+
+RESULTS = {1: '1-0', 0: '0-1', 0.5: '1/2-1/2'}
+
+async def finish_games(requests: List[CompleteGameRequest]) -> List[dict]:
+    # Counters, ratings, statuses and the final game_state of resident games go to the database in one call.
+    # Resident games are settled only if their row still has the version they were loaded with.
+    async with live_games.writing():
+        results = []
+        for r in requests:
+            result = {'game_id': r.game_id, 'winner_id': r.winner_id, 'is_draw': r.is_draw}
+            live_game = live_games.get(r.game_id)
+            if live_game:
+                game_state = live_game.stored_state(live_games.encoding)
+                termination = r.termination or live_game.termination
+                if termination:
+                    game_state['termination'] = termination
+                game_state['result'] = RESULTS[0.5 if r.is_draw else 1 if r.winner_id == live_game.player1_id else 0]
+                result['game_state'] = game_state
+                result['version'] = live_game.version
+            results.append(result)
+
+        try:
+            outcomes = await repo.settle_games(results)
+        except RepositoryError as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+    completed = [o for o in outcomes if o['status'] == 'completed']
+    if completed:
+        bus.publish({'kind': 'leaderboard', 'results': [
+            result for o in completed for result in (
+                (o['player1_id'], o['player1_rating'], float(o['player1_score'])),
+                (o['player2_id'], o['player2_rating'], 1 - float(o['player1_score']))
+            )
+        ]})
+
+    for outcome, result in zip(outcomes, results):
+        if outcome['status'] == 'conflict':
+            # Moved on elsewhere: load the game afresh on its next use.
+            live_game = await live_games.drop(outcome['game_id'], persist=False)
+            if live_game:
+                await report_conflict(live_game)
+        if outcome['status'] != 'completed':
+            continue
+        game_id = outcome['game_id']
+        score = float(outcome['player1_score'])
+        await live_games.drop(game_id, persist='game_state' not in result)
+        await manager.broadcast_to_game(game_id, {
+            'type': 'game_over',
+            'game_id': game_id,
+            'result': RESULTS[score],
+            'termination': result.get('game_state', {}).get('termination'),
+            'winner_id': None if score == 0.5 else outcome['player1_id'] if score == 1 else outcome['player2_id'],
+            'ratings': {outcome['player1_id']: outcome['player1_rating'], outcome['player2_id']: outcome['player2_rating']}
+        })
+        manager.update_sessions([outcome['player1_id'], outcome['player2_id']], status='online', game_id=None)
+        manager.forget_game(game_id)
 
-    supabase.table('games').update({'status': 'completed'}).eq('game_id', game_id).execute()
+    return outcomes
 
-    await manager.send_personal_message(player1_id, f"Game completed. Your new rating is {int(new_rating1)}")
-    await manager.send_personal_message(player2_id, f"Game completed. Your new rating is {int(new_rating2)}")
+# Finish game:
+@app.post('/complete_game')
+async def complete_game(request: CompleteGameRequest):
+    async with live_games.lock(request.game_id):
+        outcome = (await finish_games([request]))[0]
+    if outcome['status'] != 'completed':
+        status_code, detail = SETTLE_ERRORS[outcome['status']]
+        raise HTTPException(status_code=status_code, detail=detail)
 
     return {'message': 'Game completed successfully', 'new_ratings': {
-        player1['username']: int(new_rating1),
-        player2['username']: int(new_rating2)
+        outcome['player1_username']: outcome['player1_rating'],
+        outcome['player2_username']: outcome['player2_rating']
     }}
 
+# Finish many games at once (e.g. at the end of a tournament round):
+@app.post('/complete_games')
+async def complete_games(requests: List[CompleteGameRequest]):
+    if len(requests) > 1000:
+        raise HTTPException(status_code=400, detail='At most 1000 games per call')
+
+    async with live_games.lock_all(r.game_id for r in requests):
+        outcomes = await finish_games(requests)
+    return {'results': [
+        {**outcome, 'detail': SETTLE_ERRORS[outcome['status']][1]} if outcome['status'] in SETTLE_ERRORS else outcome
+        for outcome in outcomes
+    ]}
+
 # Get the Leaderboard:
 @app.get('/leaderboard')
-async def leaderboard(limit: int = 100):
-    users_response = supabase.table('users').select('username, rating, wins, losses, draws').order('rating', desc=True).limit(limit).execute()
-
-    if users_response.error:
-        raise HTTPException(status_code=500, detail='Failed to retrieve leaderboard')
-
-    users = users_response.data
-
-    leaderboard = []
-    for user in users:
-        total_games = user['wins'] + user['losses'] + user['draws']
-        win_percentage = (user['wins'] / total_games * 100) if total_games > 0 else 0
-
-        leaderboard.append({
-            'username': user['username'],
-            'rating': user['rating'],
-            'wins': user['wins'],
-            'losses': user['losses'],
-            'draws': user['draws'],
-            'win_percentage': round(win_percentage, 2)
-        })
+async def leaderboard(request: Request, response: Response, limit: int = 100, offset: int = 0):
+    limit = max(1, min(limit, LEADERBOARD_MAX_LIMIT))
+    offset = max(0, offset)
+
+    if not leaderboard_index.ready:
+        try:
+            users = await repo.top_users(limit, offset)
+        except RepositoryError:
+            raise HTTPException(status_code=500, detail='Failed to retrieve leaderboard')
+        return {'leaderboard': [Leaderboard.render(Leaderboard.entry(u), offset + i + 1) for i, u in enumerate(users)]}
+
+    etag = f'"{leaderboard_index.version}-{offset}-{limit}"'
+    if request.headers.get('if-none-match') == etag:
+        return Response(status_code=304, headers={'ETag': etag})
+
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = f'max-age={LEADERBOARD_MAX_AGE}'
+    return {'leaderboard': leaderboard_index.cached_page(offset, limit)}
+
+def require_leaderboard():
+    # Ranks only exist in the index; until it is loaded, a missing user is not known to be missing.
+    if not leaderboard_index.ready:
+        raise HTTPException(status_code=503, detail='Leaderboard is loading', headers={'Retry-After': str(int(STARTUP_RETRY))})
+
+# Get a user's rank:
+@app.get('/leaderboard/rank/{user_id}')
+async def leaderboard_rank(user_id: str):
+    require_leaderboard()
+    rank = leaderboard_index.rank(user_id)
+    if rank is None:
+        raise HTTPException(status_code=404, detail='User not found')
 
-    return {'leaderboard': leaderboard}
+    return {'rank': rank, 'total': len(leaderboard_index), 'entry': Leaderboard.render(leaderboard_index.entries[user_id], rank)}
+
+# Get the Leaderboard around a user:
+@app.get('/leaderboard/around/{user_id}')
+async def leaderboard_around(user_id: str, radius: int = 10):
+    require_leaderboard()
+    radius = max(0, min(radius, 100))
+    page = leaderboard_index.around(user_id, radius)
+    if not page:
+        raise HTTPException(status_code=404, detail='User not found')
+
+    return {'leaderboard': page}
+
+# Stream stored games as PGN or NDJSON; declared before /games/{game_id} so 'export' is not taken for an id.
+@app.get('/games/export')
+async def export(format: str = 'pgn', status: str = 'completed', player_id: Optional[str] = None,
+                 since: Optional[datetime] = None, until: Optional[datetime] = None, page_size: int = PAGE_SIZE):
+    if format not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format; use one of: {', '.join(sorted(FORMATS))}")
+    if player_id:
+        try:
+            player_id = str(uuid.UUID(player_id))
+        except ValueError:
+            raise HTTPException(status_code=400, detail='Invalid player id')
+
+    chunks = export_games(
+        repo, format, cpu.pgn, max(1, min(page_size, 1000)),
+        status=None if status == 'any' else status, player_id=player_id, since=utc(since), until=utc(until)
+    )
+    return StreamingResponse(chunks, media_type=FORMATS[format])
 
 # Get game information:
 @app.get('/games/{game_id}')
 async def get_game(game_id: str):
-    game_response = supabase.table('games').select('*').eq('game_id', game_id).execute()
-    if not game_response.data:
+    game = await repo.get_game(game_id)
+    if not game:
         raise HTTPException(status_code=404, detail='Game not found')
-    
-    game = game_response.data[0]
+
+    # The stored game_state lags resident games by up to one flush interval.
+    live_game = live_games.get(game_id)
+    if live_game:
+        game['game_state'] = live_game.game_state()
+
     return game
 
+ANALYZE_MAX_GAMES = 100
+
+# Chess work beyond applying a move (analysis, PGN) runs in worker processes; 0 means one per CPU.
+cpu = CpuExecutor(workers=int(os.getenv('CPU_WORKERS', '0')) or None)
+
+async def game_history(game_id: str):
+    live_game = live_games.get(game_id)
+    game = await repo.get_game(game_id)
+    if not game:
+        raise HTTPException(status_code=404, detail='Game not found')
+
+    if live_game:
+        return game, list(live_game.history)
+    return game, stored_history(game.get('game_state'))
+
+@app.get('/games/{game_id}/pgn')
+async def get_game_pgn(game_id: str):
+    game, history = await game_history(game_id)
+    player_ids = [uid for uid in (game['player1_id'], game.get('player2_id')) if uid]
+    players = {u['id']: u['username'] for u in await repo.get_users(player_ids)}
+
+    try:
+        pgn = await cpu.pgn(game_id, history, pgn_headers(game, players))
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    return Response(content=pgn, media_type='application/x-chess-pgn')
+
+@app.post('/games/analyze')
+async def analyze_games(request: AnalyzeGamesRequest):
+    if len(request.game_ids) > ANALYZE_MAX_GAMES:
+        raise HTTPException(status_code=400, detail=f"At most {ANALYZE_MAX_GAMES} games per request")
+
+    async def analyze(game_id: str):
+        try:
+            _, history = await game_history(game_id)
+            return await cpu.analyze(game_id, history)
+        except HTTPException as e:
+            return {'error': e.detail}
+        except ValueError as e:
+            return {'error': str(e)}
+
+    # Submitted together, so the executor sends them to the workers in batches.
+    results = await asyncio.gather(*(analyze(game_id) for game_id in request.game_ids))
+    return {'analysis': dict(zip(request.game_ids, results))}
+
+@app.get('/cache/stats')
+async def cache_stats():
+    return {**repo.stats(), 'positions': position_cache.stats() if position_cache is not None else None}
+
+# Gauges are read when /metrics is scraped, so they cost nothing in between.
+Gauge('ws_active_connections', 'WebSocket connections held by this process', read=lambda: len(manager.active_connections))
+Gauge('ws_spectators', 'Spectator memberships known to this process',
+      read=lambda: sum(len(users) for users in manager.game_spectators.values()))
+Gauge('ws_spectated_games', 'Games with at least one spectator', read=lambda: len(manager.game_spectators))
+Gauge('live_games', 'Resident in-progress games', read=lambda: len(live_games.games))
+Gauge('live_games_dirty', 'Resident games changed since the last flush', read=lambda: len(live_games.dirty))
+Gauge('timers', 'Scheduled flag, grace and lobby timers', read=lambda: len(timers))
+Gauge('lobby_games', 'Pending games in the lobby index', read=lambda: len(lobby))
+Gauge('matchmaking_queue', 'Players waiting for automatic pairing', read=lambda: len(matchmaking))
+Counter('cache_requests_total', 'Row cache lookups by table and result', ('table', 'result'), read=lambda: {
+    (table, result): stats[result] for table, stats in repo.stats().items() for result in ('hits', 'misses')
+})
+if position_cache is not None:
+    Gauge('position_cache_entries', 'Positions held by the position cache', read=lambda: len(position_cache))
+    Counter('position_cache_requests_total', 'Position cache lookups by kind and result', ('kind', 'result'), read=lambda: {
+        ('position', 'hit'): position_cache.hits,
+        ('position', 'miss'): position_cache.misses,
+        ('move', 'hit'): position_cache.move_hits,
+        ('move', 'miss'): position_cache.move_misses
+    })
+
+@app.get('/metrics')
+async def metrics():
+    return Response(content=REGISTRY.render(), media_type=CONTENT_TYPE)
+
+# Profile, e.g. /debug/profile?route=POST%20/make_move&sort=total&app_only=true, or format=collapsed for flame graph tools:
+@app.get('/debug/profile')
+async def debug_profile(format: str = 'top', route: Optional[str] = None, sort: str = 'self', app_only: bool = False,
+                        limit: int = 30, reset: bool = False):
+    if not profiler:
+        raise HTTPException(status_code=404, detail='Profiling is disabled; set PROFILE_SAMPLE_INTERVAL')
+
+    if format == 'collapsed':
+        response = Response(content=profiler.collapsed(route), media_type='text/plain')
+    else:
+        path = os.path.dirname(os.path.abspath(__file__)) if app_only else None
+        response = {**profiler.stats(), 'top': profiler.top(max(1, min(limit, 200)), route, sort, path)}
+    if reset:
+        profiler.reset()
+    return response
+
+# Probes:
+@app.get('/health')
+async def health():
+    return {'status': 'ok'}
+
+@app.get('/ready')
+async def ready(response: Response):
+    checks = {
+        'lobby': lobby.ready,
+        'leaderboard': leaderboard_index.ready,
+        'pubsub': bus.is_connected()
+    }
+    if 'journal' in startup_tasks:
+        checks['journal'] = startup_tasks['journal'].done()
+    if not all(checks.values()):
+        response.status_code = 503
+    return {'status': 'ready' if all(checks.values()) else 'starting', 'checks': checks}
+
 # Spectate a game:
 @app.post('/spectate_game')
 async def spectate_game(request: SpectateGameRequest):
     user_id = request.user_id
     game_id = request.game_id
 
-    user_response = supabase.table('users').select('*').eq('id', user_id).execute()
-    if not user_response.data:
+    user = await load_user(user_id)
+    if not user:
         raise HTTPException(status_code=404, detail='User not found')
 
-    game_response = supabase.table('games').select('*').eq('game_id', game_id).execute()
-    if not game_response.data:
+    game = await repo.get_game(game_id)
+    if not game:
         raise HTTPException(status_code=404, detail='Game not found')
     
-    game = game_response.data[0]
     if game['status'] != 'in_progress':
         raise HTTPException(status_code=400, detail='Game is not in progress')
     
-    supabase.table('spectators').insert({
-        'game_id': game_id,
-        'user_id': user_id
-    }).execute()
+    await repo.add_spectator(game_id, user_id)
 
-    if game_id not in manager.game_spectators:
-        manager.game_spectators[game_id] = []
-    if user_id not in manager.game_spectators[game_id]:
-        manager.game_spectators[game_id].append(user_id)
+    manager.add_spectator(game_id, user_id)
 
     await manager.broadcast_to_game(game_id, f"User {user_id} is now spectating the game.")
 
+    live_game = await load_live_game(game_id)
+    await send_snapshot(user_id, live_game)
+
     return {'message': f"You are now spectating the game {game_id}"}
 
 # Leave spectating mdoe:
@@ -432,74 +982,237 @@ async def leave_spectate(request: SpectateGameRequest):
     user_id = request.user_id
     game_id = request.game_id
 
-    supabase.table('spectators').delete().eq('game_id', game_id).eq('user_id', user_id).execute()
+    await repo.remove_spectator(game_id, user_id)
 
-    if game_id in manager.game_spectators:
-        if user_id in manager.game_spectators[game_id]:
-            manager.game_spectators[game_id].remove(user_id)
+    manager.remove_spectator(game_id, user_id)
 
     await manager.broadcast_to_game(game_id, f"User {user_id} has stopped spectating the game.")
 
     return {'message': f"You have left spectating the game {game_id}"}
 
-@app.post('/make_move')
-async def make_move(request: MoveRequest):
-    game_id = request.game_id
-    player_id = request.player_id
-    move = request.move
-
-    move = chess.Move.from_uci(move)
-
-    game_response = supabase.table('games').select('*').eq('game_id', game_id).execute()
-    if not game_response.data:
+async def load_live_game(game_id: str):
+    live_game = live_games.get(game_id)
+    if live_game:
+        return live_game
+
+    # Journaled moves are replayed before any game is loaded, or a new move could take the place of one.
+    recovery = startup_tasks.get('journal')
+    if recovery and not recovery.done():
+        await asyncio.shield(recovery)
+        live_game = live_games.get(game_id)
+        if live_game:
+            return live_game
+
+    # Not resident yet (e.g. after a restart), load it once from the database:
+    game = await repo.get_game(game_id)
+    if not game:
         raise HTTPException(status_code=404, detail='Game not found')
-    game = game_response.data[0]
 
     if game['status'] != 'in_progress':
         raise HTTPException(status_code=400, detail='Game is not in progress')
-    
-    player1_id = game.get('player1_id')
-    player2_id = game.get('player2_id')
-    if player_id not in [player1_id, player2_id]:
-        raise HTTPException(status_code=403, detail='You are not a participant of this game')
 
     game_state = game.get('game_state')
     if not game_state:
         raise HTTPException(status_code=400, detail='Game state is not initialized')
 
-    current_turn = game_state.get('turn')
-    if current_turn != player_id:
+    # Another request may have loaded it while this one waited for the row.
+    live_game = live_games.get(game_id)
+    if live_game:
+        return live_game
+
+    live_game = live_games.start(game_id, game.get('player1_id'), game.get('player2_id'), game_state, game.get('version', 0))
+    manager.set_players(game_id, live_game.player1_id, live_game.player2_id)
+    return live_game
+
+async def send_snapshot(user_id: str, live_game):
+    board = live_game.board
+    moves = board.move_stack if len(board.move_stack) == live_game.seq else []
+    await manager.send_personal_message(user_id, {
+        'type': 'snapshot',
+        'game_id': live_game.game_id,
+        'seq': live_game.seq,
+        'game_state': live_game.game_state()
+    }, binary=snapshot_frame(live_game.game_id, live_game.seq, board, moves))
+
+@app.post('/make_move')
+async def make_move(request: MoveRequest):
+    return await play_move(request.game_id, request.player_id, request.move)
+
+async def play_move(game_id: str, player_id: str, move: str) -> dict:
+    # One move of a game at a time, from loading to broadcast; other games proceed in parallel.
+    async with live_games.lock(game_id):
+        return await apply_and_broadcast(game_id, player_id, move)
+
+async def apply_and_broadcast(game_id: str, player_id: str, move: str) -> dict:
+    live_game = await load_live_game(game_id)
+
+    player1_id = live_game.player1_id
+    player2_id = live_game.player2_id
+    if player_id not in [player1_id, player2_id]:
+        raise HTTPException(status_code=403, detail='You are not a participant of this game')
+
+    if live_game.turn != player_id:
+        MOVES_REJECTED.inc('it_is_not_your_turn')
         raise HTTPException(status_code=400, detail='It is not your turn')
 
     try:
-        new_game_state = apply_move(game_state, move, player_id, player1_id, player2_id)
-        other_player = player1_id if player_id == player2_id else player2_id
-        await manager.send_personal_message(other_player, f"Move {move} by {player_id} made successfully.")
+        san = live_games.apply_move(game_id, move, player_id)
     except InvalidMoveException as e:
         raise HTTPException(status_code=400, detail=str(e))
+    seq, played = live_game.seq, live_game.board.peek()
+    termination = live_game.termination
+    clock = dict(live_game.clock) if live_game.clock else None
 
-    update_response = supabase.table('games').update({
-        'game_state': new_game_state
-    }).eq('game_id', game_id).execute()
+    # The move is on the resident board and stored at the next flush either way, so it is broadcast
+    # even if the journal fails; only the mover is told it would not survive a crash before that flush.
+    durable = True
+    try:
+        await live_games.sync()
+    except OSError as e:
+        print(f"Move {seq} of game {game_id} was not journaled: {e}")
+        JOURNAL_FAILURES.inc()
+        durable = False
 
-    if update_response.error:
-        raise HTTPException(status_code=500, detail='Failed to update the game state')
+    other_player = player1_id if player_id == player2_id else player2_id
+    await manager.send_personal_message(other_player, f"Move {san} by {player_id} made successfully.")
 
     await manager.broadcast_to_game(game_id, {
         'type': 'move_made',
+        'game_id': game_id,
+        'seq': seq,
         'player_id': player_id,
-        'move': move,
-        'game_state': new_game_state
-    })
+        'move': san,
+        'clock': clock
+    }, binary=move_frame(game_id, seq, played))
+
+    result = {'message': 'Move made successfully'}
+    if not durable:
+        result['durable'] = False
+    if termination:
+        # The move ended the game: settle it now instead of waiting for a /complete_game call.
+        result['game_over'] = await settle_ended_game(live_game)
+    return result
+
+async def settle_ended_game(live_game) -> dict:
+    # A game that failed to settle is retried by the timer wheel, like an expired clock.
+    try:
+        outcome = (await finish_games([forfeit_request(live_game)]))[0]
+    except HTTPException as e:
+        print(f"Failed to settle game {live_game.game_id} after {live_game.termination}: {e.detail}")
+        timers.schedule(('flag', live_game.game_id), time.time() + SETTLE_RETRY)
+        outcome = {'status': 'error'}
+    if outcome['status'] == 'conflict':
+        # The game's row moved on elsewhere, so neither the ending nor the moves since the last write were stored.
+        status_code, detail = SETTLE_ERRORS['conflict']
+        raise HTTPException(status_code=status_code, detail=detail)
+    return {
+        'termination': live_game.termination,
+        'winner_id': live_game.winner_id,
+        'completed': outcome['status'] == 'completed'
+    }
 
-    return {'message': 'Move made successfully'}
+async def participant_game(game_id: str, player_id: str):
+    live_game = await load_live_game(game_id)
+    if player_id not in (live_game.player1_id, live_game.player2_id):
+        raise HTTPException(status_code=403, detail='You are not a participant of this game')
+    if live_game.termination:
+        raise HTTPException(status_code=400, detail='Game is over')
+    return live_game
+
+async def resign(game_id: str, player_id: str) -> dict:
+    async with live_games.lock(game_id):
+        live_game = await participant_game(game_id, player_id)
+        live_game.forfeit(player_id, 'resignation')
+        return {'message': 'Game resigned', 'game_over': await settle_ended_game(live_game)}
+
+async def offer_draw(game_id: str, player_id: str) -> dict:
+    async with live_games.lock(game_id):
+        live_game = await participant_game(game_id, player_id)
+        if live_game.offer_draw(player_id):
+            return {'message': 'Draw agreed', 'game_over': await settle_ended_game(live_game)}
+    opponent = live_game.player1_id if player_id == live_game.player2_id else live_game.player2_id
+    await manager.send_personal_message(opponent, {'type': 'draw_offered', 'game_id': game_id, 'player_id': player_id})
+    return {'message': 'Draw offered'}
+
+# WebSocket commands: {'type': ..., 'id': ..., 'game_id': ..., ...}, acting as the socket's user.
+COMMANDS = {
+    'move': lambda user_id, command: play_move(command['game_id'], user_id, command['move']),
+    'resign': lambda user_id, command: resign(command['game_id'], user_id),
+    'offer_draw': lambda user_id, command: offer_draw(command['game_id'], user_id),
+    'spectate': lambda user_id, command: spectate_game(SpectateGameRequest(user_id=user_id, game_id=command['game_id'])),
+    'leave': lambda user_id, command: leave_spectate(SpectateGameRequest(user_id=user_id, game_id=command['game_id'])),
+}
+
+async def run_command(user_id: str, command: dict):
+    if not isinstance(command.get('game_id'), str) or (command['type'] == 'move' and not isinstance(command.get('move'), str)):
+        raise HTTPException(status_code=400, detail='Invalid command')
+    return await COMMANDS[command['type']](user_id, command)
 
 # Get random pending game:
 @app.get('/random_game')
 async def get_random_game():
-    game_response = supabase.table('games').select('*').eq('status', 'pending').limit(1).execute()
-    if not game_response.data:
+    games = await repo.list_games('pending', limit=1)
+    if not games:
         raise HTTPException(status_code=404, detail='No pending games found')
-    
-    game = game_response.data[0]
-    return game
\ No newline at end of file
+
+    return games[0]
+
+def available(user: Optional[dict]) -> bool:
+    return user is not None and user['status'] != 'in_game' and not live_games.games_of(user['id'])
+
+async def start_matched_game(ticket1, ticket2):
+    # Tickets can outlive their users' availability: gone, or in a game started since they queued.
+    users = [await load_user(ticket.user_id) for ticket in (ticket1, ticket2)]
+    if not all(available(user) for user in users):
+        for ticket, user in zip((ticket1, ticket2), users):
+            if available(user):
+                # Back in the queue with the time already waited.
+                matchmaking.enqueue(ticket.user_id, ticket.rating, ticket.bet, now=ticket.enqueued_at)
+        return
+
+    game = await repo.insert_game({
+        'game_id': str(uuid.uuid4()),
+        'player1_id': ticket1.user_id,
+        'status': 'pending',
+        'bet': ticket1.bet,
+    })
+    await start_game(game, users[1])
+
+matchmaking = MatchmakingQueue(
+    on_match=start_matched_game,
+    base_window=LOBBY_RATING_WINDOW,
+    widen_per_second=float(os.getenv('MATCHMAKING_WIDEN_PER_SECOND', '25')),
+    max_window=int(os.getenv('MATCHMAKING_MAX_WINDOW', '800')),
+    tick_interval=float(os.getenv('MATCHMAKING_TICK_INTERVAL', '1.0')),
+)
+
+# Queue for automatic pairing:
+@app.post('/matchmaking/enqueue')
+async def enqueue(request: MatchmakingRequest):
+    user = await load_user(request.user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail='User not found')
+
+    if user['status'] == 'in_game':
+        raise HTTPException(status_code=400, detail='User is already in a game')
+
+    matchmaking.enqueue(user['id'], user['rating'], request.bet)
+    await repo.update_user(user['id'], {'status': 'waiting'})
+    manager.update_sessions([user['id']], status='waiting')
+
+    return {'message': 'Queued for matchmaking', 'queue_depth': len(matchmaking)}
+
+# Leave the matchmaking queue:
+@app.post('/matchmaking/cancel')
+async def cancel_matchmaking(request: GameRequest):
+    if not matchmaking.cancel(request.user_id):
+        raise HTTPException(status_code=404, detail='User is not queued')
+
+    await repo.update_user(request.user_id, {'status': 'online'})
+    manager.update_sessions([request.user_id], status='online')
+
+    return {'message': 'Left the matchmaking queue'}
+
+@app.get('/matchmaking/stats')
+async def matchmaking_stats():
+    return matchmaking.stats()
@@ -0,0 +1,113 @@
+import asyncio
+import bisect
+import time
+from collections import deque
+from typing import Dict, List, Tuple
+
+class Ticket:
+    __slots__ = ('user_id', 'rating', 'bet', 'enqueued_at')
+
+    def __init__(self, user_id: str, rating: int, bet: float, enqueued_at: float):
+        self.user_id = user_id
+        self.rating = rating
+        self.bet = bet
+        self.enqueued_at = enqueued_at
+
+class MatchmakingQueue:
+    """Pairs queued players with the same bet and a close enough rating.
+
+    Each bet has its own pool sorted by rating. Every tick walks the pools once
+    and pairs neighbours whose rating gap fits both players' search windows; a
+    window starts at `base_window` and widens by `widen_per_second` while the
+    player waits, up to `max_window`. Pairs are handed to `on_match(t1, t2)`.
+    """
+
+    def __init__(self, on_match, base_window: int = 100, widen_per_second: float = 25,
+                 max_window: int = 800, tick_interval: float = 1.0):
+        self.on_match = on_match
+        self.base_window = base_window
+        self.widen_per_second = widen_per_second
+        self.max_window = max_window
+        self.tick_interval = tick_interval
+        self.pools: Dict[float, List[Tuple[int, float, str]]] = {}
+        self.tickets: Dict[str, Ticket] = {}
+        self.matched = 0
+        self.wait_times = deque(maxlen=1000)
+
+    def __len__(self):
+        return len(self.tickets)
+
+    def enqueue(self, user_id: str, rating: int, bet: float, now: float = None) -> Ticket:
+        self.cancel(user_id)
+        ticket = Ticket(user_id, rating, bet, time.monotonic() if now is None else now)
+        self.tickets[user_id] = ticket
+        bisect.insort(self.pools.setdefault(bet, []), (rating, ticket.enqueued_at, user_id))
+        return ticket
+
+    def cancel(self, user_id: str) -> bool:
+        ticket = self.tickets.pop(user_id, None)
+        if not ticket:
+            return False
+        pool = self.pools[ticket.bet]
+        key = (ticket.rating, ticket.enqueued_at, user_id)
+        i = bisect.bisect_left(pool, key)
+        if i < len(pool) and pool[i] == key:
+            del pool[i]
+        if not pool:
+            del self.pools[ticket.bet]
+        return True
+
+    def window(self, ticket: Ticket, now: float) -> float:
+        return min(self.max_window, self.base_window + self.widen_per_second * (now - ticket.enqueued_at))
+
+    def pair(self, now: float = None) -> List[Tuple[Ticket, Ticket]]:
+        now = time.monotonic() if now is None else now
+        pairs = []
+        for bet in list(self.pools):
+            pool = self.pools[bet]
+            remaining = []
+            i = 0
+            while i < len(pool):
+                if i + 1 < len(pool):
+                    t1 = self.tickets[pool[i][2]]
+                    t2 = self.tickets[pool[i + 1][2]]
+                    if t2.rating - t1.rating <= min(self.window(t1, now), self.window(t2, now)):
+                        pairs.append((t1, t2))
+                        i += 2
+                        continue
+                remaining.append(pool[i])
+                i += 1
+            if remaining:
+                self.pools[bet] = remaining
+            else:
+                del self.pools[bet]
+
+        for t1, t2 in pairs:
+            del self.tickets[t1.user_id]
+            del self.tickets[t2.user_id]
+            self.wait_times.append(now - t1.enqueued_at)
+            self.wait_times.append(now - t2.enqueued_at)
+        self.matched += len(pairs)
+        return pairs
+
+    async def tick(self):
+        pairs = self.pair()
+        results = await asyncio.gather(*(self.on_match(t1, t2) for t1, t2 in pairs), return_exceptions=True)
+        for (t1, t2), result in zip(pairs, results):
+            if isinstance(result, Exception):
+                print(f"Failed to start game for {t1.user_id} and {t2.user_id}: {result}")
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.tick_interval)
+            await self.tick()
+
+    def stats(self) -> dict:
+        waits = sorted(self.wait_times)
+        return {
+            'queue_depth': len(self.tickets),
+            'pools': len(self.pools),
+            'matched': self.matched,
+            'wait_p50': round(waits[len(waits) // 2], 3) if waits else None,
+            'wait_p99': round(waits[int(len(waits) * 0.99)], 3) if waits else None,
+        }
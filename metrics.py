@@ -0,0 +1,239 @@
+import abc
+import bisect
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Latency buckets in seconds, from a cache hit to a slow database round trip.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _labels(names: Sequence[str], values: Sequence, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Metric(abc.ABC):
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), registry: Optional['Registry'] = None):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        (REGISTRY if registry is None else registry).register(self)
+
+    @abc.abstractmethod
+    def samples(self) -> List[str]:
+        pass
+
+    def render(self) -> str:
+        return '\n'.join([f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}'] + self.samples())
+
+def _read(values: Dict[Tuple, float], read: Optional[Callable]) -> Dict[Tuple, float]:
+    # `read()` returns a number, or a dict from label tuples to numbers.
+    if read is None:
+        return values
+    current = read()
+    return current if isinstance(current, dict) else {(): current}
+
+class Counter(Metric):
+    """A count that only goes up; with `read`, it is taken from an existing counter when scraped."""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), registry: Optional['Registry'] = None,
+                 read: Optional[Callable] = None):
+        super().__init__(name, help, labels, registry)
+        self.values: Dict[Tuple, float] = {}
+        self.read = read
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self.values.get(labels, 0)
+
+    def samples(self) -> List[str]:
+        return [f'{self.name}{_labels(self.label_names, key)} {value}' for key, value in _read(self.values, self.read).items()]
+
+class Gauge(Metric):
+    """A value that goes up and down; with `read`, it is computed when scraped instead."""
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), registry: Optional['Registry'] = None,
+                 read: Optional[Callable] = None):
+        super().__init__(name, help, labels, registry)
+        self.values: Dict[Tuple, float] = {}
+        self.read = read
+
+    def set(self, value: float, *labels):
+        self.values[labels] = value
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def samples(self) -> List[str]:
+        return [f'{self.name}{_labels(self.label_names, key)} {value}' for key, value in _read(self.values, self.read).items()]
+
+class Histogram(Metric):
+    """Counts observations per bucket; observe() is one bisect and two additions.
+
+    Buckets are stored per bucket and made cumulative only when scraped.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), registry: Optional['Registry'] = None,
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels, registry)
+        self.buckets = tuple(buckets)
+        self.series: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            # Per-bucket counts (the last one is +Inf), then the sum.
+            series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def time(self, *labels) -> 'Timer':
+        return Timer(self, labels)
+
+    def count(self, *labels) -> int:
+        series = self.series.get(labels)
+        return sum(series[:-1]) if series else 0
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, series in self.series.items():
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series):
+                total += count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound!r}"'
+                lines.append(f'{self.name}_bucket{_labels(self.label_names, key, le)} {total}')
+            lines.append(f'{self.name}_sum{_labels(self.label_names, key)} {series[-1]}')
+            lines.append(f'{self.name}_count{_labels(self.label_names, key)} {total}')
+        return lines
+
+class Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram: Histogram, labels: Tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+
+    def render(self) -> str:
+        # Prometheus text exposition format, version 0.0.4.
+        return '\n'.join(metric.render() for metric in self.metrics.values()) + '\n'
+
+REGISTRY = Registry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+class MetricsMiddleware:
+    """ASGI middleware timing every HTTP request by method, route template and status.
+
+    The route template (e.g. /games/{game_id}), not the raw path, keeps the
+    number of series bounded; requests matching no route share one label.
+    """
+
+    def __init__(self, app, histogram: Histogram):
+        self.app = app
+        self.histogram = histogram
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            route = scope.get('route')
+            self.histogram.observe(
+                time.perf_counter() - start, scope['method'], getattr(route, 'path', '<unmatched>'), status
+            )
+
+# Repository method -> (table, operation) for InstrumentedRepository.
+DB_CALLS = {
+    'get_user': ('users', 'select'),
+    'get_users': ('users', 'select'),
+    'insert_user': ('users', 'insert'),
+    'insert_users': ('users', 'insert'),
+    'update_user': ('users', 'update'),
+    'update_users': ('users', 'update'),
+    'top_users': ('users', 'select'),
+    'get_game': ('games', 'select'),
+    'insert_game': ('games', 'insert'),
+    'insert_games': ('games', 'insert'),
+    'update_game': ('games', 'update'),
+    'save_game_states': ('games', 'rpc'),
+    'list_games': ('games', 'select'),
+    'list_lobby': ('games', 'select'),
+    'export_games': ('games', 'select'),
+    'settle_games': ('games', 'rpc'),
+    'add_spectator': ('spectators', 'insert'),
+    'remove_spectator': ('spectators', 'delete'),
+}
+
+class InstrumentedRepository:
+    """Wraps a repository and times each database call by table, operation and outcome.
+
+    Placed under CachedRepository, so only calls that reach the database are timed.
+    """
+
+    def __init__(self, repo, histogram: Histogram):
+        self.repo = repo
+        self.histogram = histogram
+        for method, (table, operation) in DB_CALLS.items():
+            if hasattr(repo, method):
+                setattr(self, method, self._timed(getattr(repo, method), table, operation))
+
+    def __getattr__(self, name):
+        return getattr(self.repo, name)
+
+    def _timed(self, call, table: str, operation: str):
+        histogram = self.histogram
+
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            outcome = 'error'
+            try:
+                result = await call(*args, **kwargs)
+                outcome = 'ok'
+                return result
+            finally:
+                histogram.observe(time.perf_counter() - start, table, operation, outcome)
+
+        return timed
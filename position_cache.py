@@ -0,0 +1,98 @@
+import chess
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+from apply_move import parse_move
+
+def position_key(board: chess.Board) -> Hashable:
+    # The key python-chess itself compares for repetitions; ~20x cheaper than a Zobrist hash, and exact.
+    # It is private API, so requirements.txt pins the chess version it was checked against.
+    return board._transposition_key()
+
+class Position:
+    """What one position has taught us: moves by the text they were sent as, their SAN, and whether play is over.
+
+    Moves are learned as games play them, so a position costs no more to
+    enter than checking it for mate; `status` is 'checkmate', 'stalemate',
+    'insufficient_material' or None.
+    """
+
+    __slots__ = ('moves', 'san', 'status')
+
+    def __init__(self, board: chess.Board):
+        self.moves: Dict[str, chess.Move] = {}
+        self.san: Dict[chess.Move, str] = {}
+        if not any(board.generate_legal_moves()):
+            self.status = 'checkmate' if board.is_check() else 'stalemate'
+        elif board.is_insufficient_material():
+            self.status = 'insufficient_material'
+        else:
+            self.status = None
+
+class PositionCache:
+    """Bounded LRU of Positions shared by every resident game, keyed by `position_key`: a learned opening book.
+
+    Games replaying common openings find their moves already parsed and
+    checked, so applying them is a few dictionary lookups. Only positions
+    before ply `max_ply` are kept, since later ones rarely recur in another
+    game; positions seen least recently are evicted beyond `max_size`.
+    """
+
+    def __init__(self, max_size: int = 20000, max_ply: int = 40):
+        self.max_size = max_size
+        self.max_ply = max_ply
+        self.entries: 'OrderedDict[Hashable, Position]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.move_hits = 0
+        self.move_misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, board: chess.Board, key: Optional[Hashable] = None) -> Optional[Position]:
+        if board.ply() >= self.max_ply:
+            return None
+        key = position_key(board) if key is None else key
+        position = self.entries.get(key)
+        if position is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return position
+        self.misses += 1
+        position = self.entries[key] = Position(board)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return position
+
+    def move(self, board: chess.Board, text: str, position: Position) -> Tuple[chess.Move, str]:
+        """The legal move `text` (SAN or UCI) names on `board`, whose Position is `position`, and its SAN.
+
+        Raises InvalidMoveException like apply_move.parse_move.
+        """
+        move = position.moves.get(text)
+        if move is None:
+            self.move_misses += 1
+            move = position.moves[text] = parse_move(board, text)
+        else:
+            self.move_hits += 1
+        san = position.san.get(move)
+        if san is None:
+            san = position.san[move] = board.san(move)
+        return move, san
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        moves = self.move_hits + self.move_misses
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+            'move_hits': self.move_hits,
+            'move_misses': self.move_misses,
+            'move_hit_rate': round(self.move_hits / moves, 4) if moves else None
+        }
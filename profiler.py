@@ -0,0 +1,127 @@
+import contextvars
+import os
+import signal
+import threading
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+# The ASGI scope of the request being handled, set by ProfilingMiddleware.
+current_request: contextvars.ContextVar = contextvars.ContextVar('current_request', default=None)
+
+def request_label(scope: Optional[dict]) -> str:
+    if scope is None:
+        return '<background>'
+    route = getattr(scope.get('route'), 'path', None) or '<unmatched>'
+    return f"{scope.get('method', 'WS')} {route}"
+
+class SamplingProfiler:
+    """Statistical profiler: records the main thread's stack every `interval` seconds of CPU time.
+
+    SIGPROF interrupts the interpreter, whose handler walks the current frame
+    chain; with asyncio that chain runs through the awaiting coroutines, so a
+    sample inside broadcast_to_game shows make_move above it. Each sample is
+    attributed to the request being handled at that moment (see
+    ProfilingMiddleware), and to '<background>' for tasks outside requests.
+    Unix only, and it must be started from the main thread.
+    """
+
+    def __init__(self, interval: float = 0.001, max_depth: int = 64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples: Counter = Counter()
+        self.previous = None
+        self.running = False
+
+    def start(self):
+        if self.running:
+            return
+        if threading.current_thread() is not threading.main_thread():
+            raise RuntimeError('SamplingProfiler must be started from the main thread')
+        self.previous = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.running = True
+
+    def stop(self):
+        if not self.running:
+            return
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self.previous or signal.SIG_DFL)
+        self.running = False
+
+    def reset(self):
+        self.samples.clear()
+
+    def snapshot(self) -> List[Tuple[Tuple[str, tuple], int]]:
+        # list() copies in one step, so a sample arriving meanwhile cannot change the dict under iteration.
+        return list(self.samples.items())
+
+    def _sample(self, signum, frame):
+        stack = []
+        # The handler's caller is the frame that was interrupted.
+        while frame is not None and len(stack) < self.max_depth:
+            code = frame.f_code
+            stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+            frame = frame.f_back
+        self.samples[(request_label(current_request.get()), tuple(reversed(stack)))] += 1
+
+    @staticmethod
+    def _frame_name(frame: Tuple[str, int, str]) -> str:
+        filename, line, name = frame
+        return f'{os.path.basename(filename)}:{name}:{line}'
+
+    def collapsed(self, label: Optional[str] = None) -> str:
+        """Samples in the collapsed-stack format read by flamegraph.pl and speedscope."""
+        stacks: Dict[str, int] = Counter()
+        for (request, stack), count in self.snapshot():
+            if label is None or request == label:
+                stacks[';'.join([request] + [self._frame_name(frame) for frame in stack])] += count
+        return '\n'.join(f'{stack} {count}' for stack, count in sorted(stacks.items())) + '\n'
+
+    def top(self, limit: int = 20, label: Optional[str] = None, sort: str = 'self', path: Optional[str] = None) -> List[dict]:
+        """Functions by `sort`: 'self' (innermost frame of the sample) or 'total' (anywhere on the stack).
+
+        `path` keeps only functions from files under that directory, e.g. the app's own code.
+        """
+        total: Dict[Tuple, int] = Counter()
+        own: Dict[Tuple, int] = Counter()
+        samples = 0
+        for (request, stack), count in self.snapshot():
+            if label is not None and request != label:
+                continue
+            samples += count
+            for frame in set(stack):
+                total[frame] += count
+            if stack:
+                own[stack[-1]] += count
+        ranked = (own if sort == 'self' else total).most_common()
+        if path is not None:
+            ranked = [(frame, count) for frame, count in ranked if frame[0].startswith(path)]
+        return [{
+            'function': self._frame_name(frame),
+            'self': own.get(frame, 0),
+            'total': total[frame],
+            'self_pct': round(100 * own.get(frame, 0) / samples, 1),
+            'total_pct': round(100 * total[frame] / samples, 1)
+        } for frame, _ in ranked[:limit]]
+
+    def stats(self) -> dict:
+        requests: Dict[str, int] = Counter()
+        for (request, _), count in self.snapshot():
+            requests[request] += count
+        return {'interval': self.interval, 'samples': sum(requests.values()), 'requests': dict(requests.most_common())}
+
+class ProfilingMiddleware:
+    """ASGI middleware recording which request is running, for SamplingProfiler's samples."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] not in ('http', 'websocket'):
+            await self.app(scope, receive, send)
+            return
+        token = current_request.set(scope)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_request.reset(token)
@@ -0,0 +1,200 @@
+import argparse
+import asyncio
+import json
+import os
+from typing import List, Optional, Set
+
+class InProcessBus:
+    """Delivers events to the handlers subscribed in this process only."""
+
+    def __init__(self):
+        self.handlers = []
+
+    def subscribe(self, handler):
+        self.handlers.append(handler)
+
+    def publish(self, event: dict):
+        self._deliver(event)
+
+    def _deliver(self, event: dict):
+        # A failing handler is logged and skipped: the handlers after it, and the broker, still get the event.
+        for handler in self.handlers:
+            try:
+                handler(event)
+            except Exception as e:
+                print(f"Pub/sub handler {getattr(handler, '__name__', handler)} failed on a {event.get('kind')} event: {e}")
+
+    async def start(self):
+        pass
+
+    def is_connected(self) -> bool:
+        return True
+
+    async def flush(self):
+        pass
+
+    async def close(self):
+        pass
+
+class BrokerBus(InProcessBus):
+    """Shares events between processes through a broker started with `run_broker`.
+
+    Local handlers get each event immediately; it is also queued for the broker,
+    which relays it to every other connected process. `address` is
+    `unix:///path/to.sock` or `tcp://host:port`.
+    """
+
+    def __init__(self, address: str, reconnect_delay: float = 1.0):
+        super().__init__()
+        self.address = address
+        self.reconnect_delay = reconnect_delay
+        # Created by start(): the bus is built at import, before the server's loop exists,
+        # and on Python 3.9 asyncio primitives bind to the loop current when they are made.
+        self.outgoing: Optional[asyncio.Queue] = None
+        self.connected: Optional[asyncio.Event] = None
+        self.backlog: List[bytes] = []
+        self.task: Optional[asyncio.Task] = None
+
+    def publish(self, event: dict):
+        super().publish(event)
+        line = json.dumps(event, separators=(',', ':')).encode() + b'\n'
+        if self.outgoing is None:
+            self.backlog.append(line)
+        else:
+            self.outgoing.put_nowait(line)
+
+    async def start(self, timeout: float = 5.0):
+        self.outgoing = asyncio.Queue()
+        self.connected = asyncio.Event()
+        for line in self.backlog:
+            self.outgoing.put_nowait(line)
+        self.backlog = []
+        self.task = asyncio.create_task(self._run())
+        try:
+            await asyncio.wait_for(self.connected.wait(), timeout)
+        except asyncio.TimeoutError:
+            # Keep serving local connections; _run() keeps retrying the broker.
+            pass
+
+    def is_connected(self) -> bool:
+        return self.connected is not None and self.connected.is_set()
+
+    async def flush(self):
+        if self.outgoing is not None:
+            await self.outgoing.join()
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+
+    async def _run(self):
+        while True:
+            try:
+                reader, writer = await open_connection(self.address)
+            except OSError as e:
+                print(f"Cannot reach pub/sub broker at {self.address}: {e}")
+                await asyncio.sleep(self.reconnect_delay)
+                continue
+
+            self.connected.set()
+            sender = asyncio.create_task(self._send(writer))
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    self._dispatch(line)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                pass
+            finally:
+                sender.cancel()
+                writer.close()
+                self.connected.clear()
+            print(f"Lost connection to pub/sub broker at {self.address}, reconnecting")
+            await asyncio.sleep(self.reconnect_delay)
+
+    def _dispatch(self, line: bytes):
+        # One bad event or failing handler must not stop the reader: later events would silently go undelivered.
+        try:
+            event = json.loads(line)
+        except ValueError:
+            print(f"Skipping unreadable pub/sub event: {line[:100]!r}")
+            return
+        self._deliver(event)
+
+    async def _send(self, writer: asyncio.StreamWriter):
+        while True:
+            line = await self.outgoing.get()
+            writer.write(line)
+            await writer.drain()
+            self.outgoing.task_done()
+
+def parse_address(address: str):
+    if address.startswith('unix://'):
+        return 'unix', address[len('unix://'):]
+    if address.startswith('tcp://'):
+        host, port = address[len('tcp://'):].rsplit(':', 1)
+        return 'tcp', (host, int(port))
+    raise ValueError(f"Unsupported pub/sub address {address!r}")
+
+async def open_connection(address: str):
+    kind, target = parse_address(address)
+    if kind == 'unix':
+        return await asyncio.open_unix_connection(target, limit=2 ** 20)
+    return await asyncio.open_connection(*target, limit=2 ** 20)
+
+async def run_broker(address: str, max_buffer: int = 16 * 1024 * 1024):
+    """Relays every line a client sends to all the other clients.
+
+    A client whose unsent backlog exceeds `max_buffer` bytes is dropped rather
+    than allowed to hold up the others.
+    """
+    clients: Set[asyncio.StreamWriter] = set()
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        clients.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                for client in list(clients):
+                    if client is writer:
+                        continue
+                    if client.transport.get_write_buffer_size() > max_buffer:
+                        clients.discard(client)
+                        client.close()
+                        continue
+                    client.write(line)
+        except ConnectionError:
+            pass
+        finally:
+            clients.discard(writer)
+            writer.close()
+
+    kind, target = parse_address(address)
+    if kind == 'unix':
+        if os.path.exists(target):
+            os.unlink(target)
+        server = await asyncio.start_unix_server(handle, target, limit=2 ** 20)
+    else:
+        server = await asyncio.start_server(handle, *target, limit=2 ** 20)
+
+    print(f"Pub/sub broker listening on {address}")
+    async with server:
+        await server.serve_forever()
+
+def serve(address: str):
+    asyncio.run(run_broker(address))
+
+def create_bus():
+    address = os.getenv('PUBSUB_URL')
+    if address:
+        return BrokerBus(address)
+    return InProcessBus()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the pub/sub broker shared by the API workers.')
+    parser.add_argument('address', nargs='?', default=os.getenv('PUBSUB_URL', 'unix:///tmp/solanachess.sock'))
+    args = parser.parse_args()
+    serve(args.address)
@@ -0,0 +1,397 @@
+import asyncio
+import copy
+import heapq
+import os
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+from elo import new_ratings
+
+class RepositoryError(Exception):
+    pass
+
+class SupabaseRepository:
+    """Async data access for users, games and spectators.
+
+    All requests go through one pooled httpx.AsyncClient, so handlers await
+    the round trip instead of blocking the event loop on it.
+    """
+
+    def __init__(self, url: str, key: str, max_connections: int = 100, timeout: float = 10.0):
+        # Imported here so processes on the in-memory backend never load the Supabase client.
+        import httpx
+        from supabase import AsyncClient, AsyncClientOptions
+
+        self.http = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=timeout,
+            http2=True,
+        )
+        self.client = AsyncClient(url, key, AsyncClientOptions(httpx_client=self.http))
+
+    async def _execute(self, query):
+        import httpx
+        from postgrest.exceptions import APIError
+
+        try:
+            response = await query.execute()
+        except APIError as e:
+            raise RepositoryError(e.message)
+        except (httpx.HTTPError, OSError) as e:
+            # Unreachable, timed out or cut off: callers retry these like any other failed call.
+            raise RepositoryError(f"{type(e).__name__}: {e}")
+        return response.data
+
+    def _table(self, name: str):
+        return self.client.table(name)
+
+    # Users:
+    async def get_user(self, user_id: str) -> Optional[dict]:
+        rows = await self._execute(self._table('users').select('*').eq('id', user_id))
+        return rows[0] if rows else None
+
+    async def get_users(self, user_ids: List[str]) -> List[dict]:
+        return await self._execute(self._table('users').select('*').in_('id', user_ids))
+
+    async def insert_user(self, row: dict) -> dict:
+        rows = await self._execute(self._table('users').insert(row))
+        return rows[0]
+
+    async def insert_users(self, rows: List[dict]):
+        # Bulk insert in one statement; rows must all have the same keys.
+        await self._execute(self._table('users').insert(rows, returning='minimal'))
+
+    async def update_user(self, user_id: str, fields: dict):
+        await self._execute(self._table('users').update(fields).eq('id', user_id))
+
+    async def update_users(self, user_ids: List[str], fields: dict):
+        await self._execute(self._table('users').update(fields).in_('id', user_ids))
+
+    async def top_users(self, limit: int, offset: int = 0) -> List[dict]:
+        return await self._execute(
+            self._table('users').select('id, username, rating, wins, losses, draws')
+            .order('rating', desc=True).order('id').range(offset, offset + limit - 1)
+        )
+
+    # Games:
+    async def get_game(self, game_id: str) -> Optional[dict]:
+        rows = await self._execute(self._table('games').select('*').eq('game_id', game_id))
+        return rows[0] if rows else None
+
+    async def insert_game(self, row: dict) -> dict:
+        rows = await self._execute(self._table('games').insert(row))
+        return rows[0]
+
+    async def insert_games(self, rows: List[dict]):
+        await self._execute(self._table('games').insert(rows, returning='minimal'))
+
+    async def update_game(self, game_id: str, fields: dict, status: Optional[str] = None) -> bool:
+        # With `status`, only a row still in that status is updated; returns whether a row was.
+        query = self._table('games').update(fields).eq('game_id', game_id)
+        if status:
+            query = query.eq('status', status)
+        return bool(await self._execute(query))
+
+    async def save_game_states(self, states: Dict[str, dict], versions: Optional[Dict[str, int]] = None) -> List[str]:
+        # One round trip for every game changed since the last flush; see sql/save_game_states.sql.
+        return await self._execute(self.client.rpc('save_game_states', {'states': states, 'versions': versions})) or []
+
+    async def list_games(self, status: str, exclude_player_id: Optional[str] = None, limit: Optional[int] = None,
+                         offset: int = 0) -> List[dict]:
+        query = self._table('games').select('*').eq('status', status)
+        if exclude_player_id:
+            query = query.neq('player1_id', exclude_player_id)
+        if limit:
+            query = query.order('game_id').range(offset, offset + limit - 1)
+        return await self._execute(query)
+
+    async def export_games(self, after: Optional[Tuple[str, str]] = None, limit: int = 500, status: Optional[str] = None,
+                           player_id: Optional[str] = None, since: Optional[str] = None, until: Optional[str] = None) -> List[dict]:
+        # Keyset pagination on (created_at, game_id): a page starts after the last row of the one before,
+        # so it costs the same however deep into the table it is. since/until bound created_at (until exclusive).
+        query = self._table('games').select('game_id, player1_id, player2_id, status, bet, created_at, game_state')
+        if status:
+            query = query.eq('status', status)
+        if since:
+            query = query.gte('created_at', since)
+        if until:
+            query = query.lt('created_at', until)
+        conditions = []
+        if player_id:
+            conditions.append(f'or(player1_id.eq."{player_id}",player2_id.eq."{player_id}")')
+        if after:
+            created_at, game_id = after
+            conditions.append(f'or(created_at.gt."{created_at}",and(created_at.eq."{created_at}",game_id.gt."{game_id}"))')
+        if conditions:
+            # PostgREST takes a single `or` filter, so both conditions are nested in it.
+            query = query.or_(f"and({','.join(conditions)})")
+        return await self._execute(query.order('created_at').order('game_id').limit(limit))
+
+    async def list_lobby(self, min_rating: Optional[int] = None, max_rating: Optional[int] = None,
+                         exclude_player_id: Optional[str] = None, limit: Optional[int] = None, offset: int = 0) -> List[dict]:
+        # Pending games with their creator embedded, filtered on the creator's rating in one query.
+        query = self._table('games').select(
+            'game_id, player1_id, bet, created_at, creator:users!player1_id!inner(id, username, rating)'
+        ).eq('status', 'pending')
+        if min_rating is not None:
+            query = query.gte('creator.rating', min_rating)
+        if max_rating is not None:
+            query = query.lte('creator.rating', max_rating)
+        if exclude_player_id:
+            query = query.neq('player1_id', exclude_player_id)
+        query = query.order('created_at')
+        if limit:
+            query = query.range(offset, offset + limit - 1)
+        return await self._execute(query)
+
+    async def settle_games(self, results: List[dict]) -> List[dict]:
+        # One transaction for the whole batch; see sql/settle_games.sql.
+        return await self._execute(self.client.rpc('settle_games', {'results': results}))
+
+    # Spectators:
+    async def add_spectator(self, game_id: str, user_id: str):
+        await self._execute(self._table('spectators').insert({'game_id': game_id, 'user_id': user_id}))
+
+    async def remove_spectator(self, game_id: str, user_id: str):
+        await self._execute(self._table('spectators').delete().eq('game_id', game_id).eq('user_id', user_id))
+
+    async def close(self):
+        await self.http.aclose()
+
+class InMemoryRepository:
+    """Local stand-in for SupabaseRepository with the same interface.
+
+    `latency` (seconds) is awaited on every call to mimic a network round trip.
+    """
+
+    USER_DEFAULTS = {'status': 'online', 'wins': 0, 'losses': 0, 'draws': 0}
+    GAME_DEFAULTS = {'player2_id': None, 'game_state': None, 'version': 0}
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.users: Dict[str, dict] = {}
+        self.games: Dict[str, dict] = {}
+        self.spectators: List[dict] = []
+
+    async def _delay(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        else:
+            await asyncio.sleep(0)
+
+    # Users:
+    async def get_user(self, user_id: str) -> Optional[dict]:
+        await self._delay()
+        user = self.users.get(user_id)
+        return copy.deepcopy(user) if user else None
+
+    async def get_users(self, user_ids: List[str]) -> List[dict]:
+        await self._delay()
+        return [copy.deepcopy(self.users[uid]) for uid in user_ids if uid in self.users]
+
+    async def insert_user(self, row: dict) -> dict:
+        await self._delay()
+        if row['id'] in self.users:
+            raise RepositoryError(f"User {row['id']} already exists")
+        user = {**self.USER_DEFAULTS, **copy.deepcopy(row)}
+        self.users[user['id']] = user
+        return copy.deepcopy(user)
+
+    async def insert_users(self, rows: List[dict]):
+        await self._delay()
+        for row in rows:
+            if row['id'] in self.users:
+                raise RepositoryError(f"User {row['id']} already exists")
+        for row in rows:
+            self.users[row['id']] = {**self.USER_DEFAULTS, **copy.deepcopy(row)}
+
+    async def update_user(self, user_id: str, fields: dict):
+        await self._delay()
+        if user_id in self.users:
+            self.users[user_id].update(copy.deepcopy(fields))
+
+    async def update_users(self, user_ids: List[str], fields: dict):
+        await self._delay()
+        for user_id in user_ids:
+            if user_id in self.users:
+                self.users[user_id].update(copy.deepcopy(fields))
+
+    async def top_users(self, limit: int, offset: int = 0) -> List[dict]:
+        await self._delay()
+        users = sorted(self.users.values(), key=lambda u: (-u['rating'], u['id']))[offset:offset + limit]
+        return [{k: u.get(k) for k in ('id', 'username', 'rating', 'wins', 'losses', 'draws')} for u in users]
+
+    # Games:
+    async def get_game(self, game_id: str) -> Optional[dict]:
+        await self._delay()
+        game = self.games.get(game_id)
+        return copy.deepcopy(game) if game else None
+
+    async def insert_game(self, row: dict) -> dict:
+        await self._delay()
+        if row['game_id'] in self.games:
+            raise RepositoryError(f"Game {row['game_id']} already exists")
+        game = {**self.GAME_DEFAULTS, 'created_at': datetime.now(timezone.utc).isoformat(), **copy.deepcopy(row)}
+        self.games[game['game_id']] = game
+        return copy.deepcopy(game)
+
+    async def insert_games(self, rows: List[dict]):
+        await self._delay()
+        for row in rows:
+            if row['game_id'] in self.games:
+                raise RepositoryError(f"Game {row['game_id']} already exists")
+        created_at = datetime.now(timezone.utc).isoformat()
+        for row in rows:
+            self.games[row['game_id']] = {**self.GAME_DEFAULTS, 'created_at': created_at, **copy.deepcopy(row)}
+
+    async def update_game(self, game_id: str, fields: dict, status: Optional[str] = None) -> bool:
+        await self._delay()
+        game = self.games.get(game_id)
+        if not game or (status and game['status'] != status):
+            return False
+        game.update(copy.deepcopy(fields))
+        return True
+
+    async def save_game_states(self, states: Dict[str, dict], versions: Optional[Dict[str, int]] = None) -> List[str]:
+        # Mirrors sql/save_game_states.sql: games whose version moved on are not written but returned.
+        await self._delay()
+        conflicts = []
+        for game_id, game_state in states.items():
+            game = self.games.get(game_id)
+            if not game or (versions and game_id in versions and game['version'] != versions[game_id]):
+                conflicts.append(game_id)
+                continue
+            game['game_state'] = copy.deepcopy(game_state)
+            game['version'] += 1
+        return conflicts
+
+    async def list_games(self, status: str, exclude_player_id: Optional[str] = None, limit: Optional[int] = None,
+                         offset: int = 0) -> List[dict]:
+        await self._delay()
+        games = [
+            g for g in self.games.values()
+            if g['status'] == status and (not exclude_player_id or g['player1_id'] != exclude_player_id)
+        ]
+        if limit:
+            games = sorted(games, key=lambda g: g['game_id'])[offset:offset + limit]
+        return [copy.deepcopy(g) for g in games]
+
+    async def export_games(self, after: Optional[Tuple[str, str]] = None, limit: int = 500, status: Optional[str] = None,
+                           player_id: Optional[str] = None, since: Optional[str] = None, until: Optional[str] = None) -> List[dict]:
+        await self._delay()
+        # A generator, so a page holds `limit` rows whatever the number of games; the sort key is (created_at, game_id).
+        since = since and datetime.fromisoformat(since)
+        until = until and datetime.fromisoformat(until)
+        start = after and (datetime.fromisoformat(after[0]), after[1])
+        games = (
+            (datetime.fromisoformat(g['created_at']), g['game_id'], g) for g in self.games.values()
+            if (not status or g['status'] == status)
+            and (not player_id or player_id in (g['player1_id'], g['player2_id']))
+        )
+        page = heapq.nsmallest(limit, (
+            entry for entry in games
+            if (not since or entry[0] >= since) and (not until or entry[0] < until) and (not start or entry[:2] > start)
+        ), key=lambda entry: entry[:2])
+        return [copy.deepcopy(entry[2]) for entry in page]
+
+    async def list_lobby(self, min_rating: Optional[int] = None, max_rating: Optional[int] = None,
+                         exclude_player_id: Optional[str] = None, limit: Optional[int] = None, offset: int = 0) -> List[dict]:
+        await self._delay()
+        games = []
+        for g in sorted(self.games.values(), key=lambda g: g['created_at']):
+            creator = self.users.get(g['player1_id'])
+            if g['status'] != 'pending' or not creator or g['player1_id'] == exclude_player_id:
+                continue
+            if min_rating is not None and creator['rating'] < min_rating:
+                continue
+            if max_rating is not None and creator['rating'] > max_rating:
+                continue
+            games.append({
+                'game_id': g['game_id'],
+                'player1_id': g['player1_id'],
+                'bet': g['bet'],
+                'created_at': g['created_at'],
+                'creator': {k: creator[k] for k in ('id', 'username', 'rating')}
+            })
+        return games[offset:offset + limit] if limit else games[offset:]
+
+    async def settle_games(self, results: List[dict]) -> List[dict]:
+        # Mirrors sql/settle_games.sql; nothing is awaited between reads and writes, so the batch is atomic here too.
+        await self._delay()
+        outcome = []
+        for result in results:
+            game_id = result['game_id']
+            game = self.games.get(game_id)
+            if not game:
+                outcome.append({'game_id': game_id, 'status': 'not_found'})
+                continue
+            if game['status'] != 'in_progress':
+                outcome.append({'game_id': game_id, 'status': 'not_in_progress'})
+                continue
+            if 'version' in result and game['version'] != result['version']:
+                outcome.append({'game_id': game_id, 'status': 'conflict'})
+                continue
+
+            if result.get('is_draw'):
+                score1 = 0.5
+            elif result.get('winner_id') == game['player1_id']:
+                score1 = 1
+            elif result.get('winner_id') == game['player2_id']:
+                score1 = 0
+            else:
+                outcome.append({'game_id': game_id, 'status': 'invalid_winner'})
+                continue
+
+            player1 = self.users.get(game['player1_id'])
+            player2 = self.users.get(game['player2_id'])
+            if not player1 or not player2:
+                outcome.append({'game_id': game_id, 'status': 'players_not_found'})
+                continue
+
+            rating1, rating2 = new_ratings(player1['rating'], player2['rating'], score1)
+            for player, rating, score in ((player1, rating1, score1), (player2, rating2, 1 - score1)):
+                player['rating'] = rating
+                player['status'] = 'online'
+                player['wins'] += score == 1
+                player['losses'] += score == 0
+                player['draws'] += score == 0.5
+            game['status'] = 'completed'
+            game['version'] += 1
+            if result.get('game_state') is not None:
+                game['game_state'] = copy.deepcopy(result['game_state'])
+
+            outcome.append({
+                'game_id': game_id,
+                'status': 'completed',
+                'player1_id': player1['id'],
+                'player2_id': player2['id'],
+                'player1_username': player1['username'],
+                'player2_username': player2['username'],
+                'player1_rating': rating1,
+                'player2_rating': rating2,
+                'player1_score': score1
+            })
+        return outcome
+
+    # Spectators:
+    async def add_spectator(self, game_id: str, user_id: str):
+        await self._delay()
+        self.spectators.append({'game_id': game_id, 'user_id': user_id})
+
+    async def remove_spectator(self, game_id: str, user_id: str):
+        await self._delay()
+        self.spectators = [s for s in self.spectators if not (s['game_id'] == game_id and s['user_id'] == user_id)]
+
+    async def close(self):
+        pass
+
+def create_repository():
+    backend = os.getenv('DATA_BACKEND', 'supabase')
+    if backend == 'memory':
+        return InMemoryRepository(latency=float(os.getenv('MEMORY_BACKEND_LATENCY', '0')))
+    if backend == 'supabase':
+        return SupabaseRepository(
+            os.getenv('SUPABASE_URL'),
+            os.getenv('SUPABASE_KEY'),
+            max_connections=int(os.getenv('SUPABASE_MAX_CONNECTIONS', '100')),
+        )
+    raise ValueError(f"Unknown DATA_BACKEND {backend!r}")
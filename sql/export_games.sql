@@ -0,0 +1,5 @@
+-- Index behind the keyset pagination of game exports (export_games in
+-- repository.py): pages are read in (created_at, game_id) order, each
+-- starting after the last row of the one before, so every page is an
+-- index range scan however deep into the table it is.
+create index if not exists games_created_at_game_id_idx on games (created_at, game_id);
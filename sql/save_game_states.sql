@@ -0,0 +1,32 @@
+-- Stores the game_state of several games in one statement. Called through
+-- PostgREST by the live-game flush as
+-- rpc('save_game_states', {'states': {game_id: game_state, ...}, 'versions': {game_id: version, ...}}).
+--
+-- Every write increments games.version. A game listed in 'versions' is only
+-- written if its row still has that version, i.e. nobody else wrote it since
+-- it was loaded; the ids of games not written are returned.
+alter table games add column if not exists version integer not null default 0;
+
+drop function if exists save_game_states(jsonb);
+
+create or replace function save_game_states(states jsonb, versions jsonb default null)
+returns jsonb
+language plpgsql
+as $$
+declare
+    gid games.game_id%type;
+    state jsonb;
+    conflicts jsonb := '[]'::jsonb;
+begin
+    for gid, state in select key, value from jsonb_each(states)
+    loop
+        update games set game_state = state, version = version + 1
+        where game_id = gid
+          and (versions is null or not versions ? gid::text or version = (versions->>gid::text)::integer);
+        if not found then
+            conflicts := conflicts || to_jsonb(gid);
+        end if;
+    end loop;
+    return conflicts;
+end;
+$$;
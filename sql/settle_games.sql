@@ -0,0 +1,109 @@
+-- Settles finished games in one transaction: win/loss/draw counters, Elo
+-- ratings, player status and game status. Called through PostgREST as
+-- rpc('settle_games', {'results': [{'game_id', 'winner_id', 'is_draw', 'game_state'}, ...]}).
+-- 'game_state' is optional; when given it is stored with the final status.
+-- 'version' is optional too; when given, a game whose row has another
+-- version (see save_game_states.sql) is not settled but reported as 'conflict'.
+--
+-- Counters are incremented in place and game and player rows are locked
+-- (players in id order, to avoid deadlocks between concurrent calls), so
+-- concurrent settlements cannot lose updates. The Elo math matches
+-- elo.py: K = 32, new ratings truncated to integers.
+create or replace function settle_games(results jsonb)
+returns jsonb
+language plpgsql
+as $$
+declare
+    result jsonb;
+    gid games.game_id%type;
+    g games%rowtype;
+    p1 users%rowtype;
+    p2 users%rowtype;
+    score1 numeric;
+    expected1 numeric;
+    new_rating1 integer;
+    new_rating2 integer;
+    outcome jsonb := '[]'::jsonb;
+begin
+    for result in select value from jsonb_array_elements(results)
+    loop
+        gid := result->>'game_id';
+        select * into g from games where game_id = gid for update;
+
+        if not found then
+            outcome := outcome || jsonb_build_object('game_id', gid, 'status', 'not_found');
+            continue;
+        end if;
+
+        if g.status <> 'in_progress' then
+            outcome := outcome || jsonb_build_object('game_id', gid, 'status', 'not_in_progress');
+            continue;
+        end if;
+
+        if result ? 'version' and g.version <> (result->>'version')::integer then
+            outcome := outcome || jsonb_build_object('game_id', gid, 'status', 'conflict');
+            continue;
+        end if;
+
+        if coalesce((result->>'is_draw')::boolean, false) then
+            score1 := 0.5;
+        elsif result->>'winner_id' = g.player1_id::text then
+            score1 := 1;
+        elsif result->>'winner_id' = g.player2_id::text then
+            score1 := 0;
+        else
+            outcome := outcome || jsonb_build_object('game_id', gid, 'status', 'invalid_winner');
+            continue;
+        end if;
+
+        perform 1 from users where id in (g.player1_id, g.player2_id) order by id for update;
+        select * into p1 from users where id = g.player1_id;
+        select * into p2 from users where id = g.player2_id;
+
+        if p1.id is null or p2.id is null then
+            outcome := outcome || jsonb_build_object('game_id', gid, 'status', 'players_not_found');
+            continue;
+        end if;
+
+        expected1 := 1 / (1 + power(10::numeric, (p2.rating - p1.rating) / 400.0));
+        new_rating1 := trunc(p1.rating + 32 * (score1 - expected1));
+        new_rating2 := trunc(p2.rating + 32 * ((1 - score1) - (1 - expected1)));
+
+        update users set
+            rating = new_rating1,
+            status = 'online',
+            wins = wins + (score1 = 1)::int,
+            losses = losses + (score1 = 0)::int,
+            draws = draws + (score1 = 0.5)::int
+        where id = p1.id;
+
+        update users set
+            rating = new_rating2,
+            status = 'online',
+            wins = wins + (score1 = 0)::int,
+            losses = losses + (score1 = 1)::int,
+            draws = draws + (score1 = 0.5)::int
+        where id = p2.id;
+
+        update games set
+            status = 'completed',
+            game_state = coalesce(result->'game_state', game_state),
+            version = version + 1
+        where game_id = gid;
+
+        outcome := outcome || jsonb_build_object(
+            'game_id', gid,
+            'status', 'completed',
+            'player1_id', p1.id,
+            'player2_id', p2.id,
+            'player1_username', p1.username,
+            'player2_username', p2.username,
+            'player1_rating', new_rating1,
+            'player2_rating', new_rating2,
+            'player1_score', score1
+        );
+    end loop;
+
+    return outcome;
+end;
+$$;
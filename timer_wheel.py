@@ -0,0 +1,103 @@
+import asyncio
+import math
+import time
+from typing import Dict, Hashable, List, Tuple
+
+class TimerWheel:
+    """Hierarchical timing wheel: any number of timers, one task.
+
+    Level 0 has 256 slots of `tick` seconds; each further level has 64
+    slots, each spanning a whole turn of the level below (with tick=0.1:
+    25.6s, 27 min, 29 h, 77 days). Scheduling and cancelling are O(1);
+    timers in a higher level are moved down when the level below wraps.
+    Timers are keyed, so scheduling an existing key moves it. Deadlines are
+    wall-clock (time.time()) timestamps, so they can be stored and restored.
+    """
+
+    LEVEL_BITS = (8, 6, 6, 6)
+
+    def __init__(self, tick: float = 0.1, now: float = None):
+        self.tick = tick
+        self.origin = time.time() if now is None else now
+        self.current = 0
+        self.levels: List[List[Dict[Hashable, int]]] = [[{} for _ in range(1 << bits)] for bits in self.LEVEL_BITS]
+        self.timers: Dict[Hashable, Tuple[int, int, float]] = {}
+
+    def __len__(self):
+        return len(self.timers)
+
+    def __contains__(self, key: Hashable):
+        return key in self.timers
+
+    def deadline(self, key: Hashable):
+        timer = self.timers.get(key)
+        return timer[2] if timer else None
+
+    def schedule(self, key: Hashable, deadline: float):
+        self.cancel(key)
+        expires = max(self.current + 1, math.ceil((deadline - self.origin) / self.tick))
+        self._place(key, expires, deadline)
+
+    def _place(self, key: Hashable, expires: int, deadline: float):
+        delta = expires - self.current
+        shift = 0
+        for level, bits in enumerate(self.LEVEL_BITS):
+            if delta < (1 << (shift + bits)) or level == len(self.LEVEL_BITS) - 1:
+                slot = (min(expires, self.current + (1 << (shift + bits)) - 1) >> shift) & ((1 << bits) - 1)
+                self.levels[level][slot][key] = expires
+                self.timers[key] = (level, slot, deadline)
+                return
+            shift += bits
+
+    def cancel(self, key: Hashable) -> bool:
+        timer = self.timers.pop(key, None)
+        if timer is None:
+            return False
+        level, slot, _ = timer
+        del self.levels[level][slot][key]
+        return True
+
+    def advance(self, now: float = None) -> List[Hashable]:
+        """Moves the wheel up to `now` and returns the keys of the timers that expired."""
+        now = time.time() if now is None else now
+        target = math.floor((now - self.origin) / self.tick)
+        expired = []
+        while self.current < target:
+            if not self.timers:
+                # Nothing scheduled: jump straight to the target.
+                self.current = target
+                break
+            self.current += 1
+            self._cascade()
+            bucket = self.levels[0][self.current & ((1 << self.LEVEL_BITS[0]) - 1)]
+            for key in list(bucket):
+                if bucket[key] <= self.current:
+                    del bucket[key]
+                    del self.timers[key]
+                    expired.append(key)
+        return expired
+
+    def _cascade(self):
+        # When a level wraps, the timers of the next slot one level up are placed again, further down.
+        shift = 0
+        for level, bits in enumerate(self.LEVEL_BITS[:-1]):
+            shift += bits
+            if self.current & ((1 << shift) - 1):
+                return
+            upper_bits = self.LEVEL_BITS[level + 1]
+            slot = (self.current >> shift) & ((1 << upper_bits) - 1)
+            bucket = self.levels[level + 1][slot]
+            self.levels[level + 1][slot] = {}
+            for key, expires in bucket.items():
+                self._place(key, expires, self.timers[key][2])
+
+    async def run(self, on_expire):
+        """Advances every `tick` seconds and awaits `on_expire(keys)` with each batch of expired keys."""
+        while True:
+            await asyncio.sleep(self.tick)
+            expired = self.advance()
+            if expired:
+                try:
+                    await on_expire(expired)
+                except Exception as e:
+                    print(f"Failed to handle {len(expired)} expired timers: {e}")